@@ -1,27 +1,69 @@
+import os
+import tempfile
+from typing import Hashable
 from typing import List
+from typing import Optional
+from typing import Tuple
 
+import numpy as np
 import pandas as pd
+import plotly.graph_objects as go
 import streamlit as st
 
 from src.constants import *
 from src.dataset import generate_download_link
 from src.dataset import load_infusion_times
 from src.dataset import load_samples
+from src.dataset import memory_usage_mb
 from src.dataset import merge_samples_to_treatment
 from src.dataset import remove_patients_with_duplicate_treatments
 from src.diagnostics import DiagnoseTypes
 from src.diagnostics import DiagnosticClasses
+from src.export import detection_detail
+from src.export import export_to_file
+from src.export import FORMATS
+from src.export import iter_chunks
+from src.export import MIME_TYPES
+from src.instrumentation import events_frame
+from src.instrumentation import log_events
+from src.instrumentation import stage
+from src.instrumentation import start_run
+from src.partition import PCodePartition
+from src.phenotype import PhenotypeMatrix
+from src.registry import content_key
+from src.registry import SHARED_DATASETS
+from src.runner import PARALLEL
+from src.runner import start_detections
+from src.store import RESULTS_DB
+from src.store import results_key
+from src.store import ResultStore
+from src.streaming import load_samples_with_treatment
+from src.streaming import MEMORY_BUDGET_MB
 from src.visualization import beta_visualize_dme
+from src.visualization import Chart
+from src.visualization import CHARTS
+from src.visualization import LAZY_CHARTS
 from src.visualization import visualize_detected
+from src.visualization import visualize_co_occurrence
 from src.visualization import visualize_detected_by_patient
 from src.visualization import visualize_patient
 from src.visualization import visualize_summary_detection
+from src.visualization import visualize_sweep
+
+
+# events of each stage are logged as JSON lines for monitoring
+log_events()
+
+
+# detections of past runs, shared by sessions and app restarts, with MTX_RESULTS_DB set
+RESULTS = ResultStore(RESULTS_DB) if RESULTS_DB else None
 
 
 def main():
+    start_run()
     initialize_app_info()
     samples_df_buffer = st.sidebar.file_uploader(
-        "Choose your samples file", type=["xlsx"]
+        "Choose your samples file", type=["xlsx", "csv"]
     )
     infusion_times_buffer = st.sidebar.file_uploader(
         "Choose your infusion times file", type=["xlsx"]
@@ -31,8 +73,23 @@ def main():
         st.info("Please specify samples and infusion time files in the sidebar")
         return
 
-    samples_df = load_samples(samples_df_buffer)
-    infusion_times = load_infusion_times(infusion_times_buffer)
+    # keeps memory bounded while parsing, at the cost of a slower first load
+    streaming = st.sidebar.checkbox("Read samples in chunks (large exports)")
+    selected_diagnostics = st.sidebar.multiselect(
+        "Choose the diagnostics you want to study",
+        options=range(0, len(DiagnosticClasses)),
+        format_func=lambda i: DiagnosticClasses[i].name,
+    )
+
+    # streamed samples are read back only for the P_CODE of the selected diagnostics,
+    # all of them when one of the diagnostics reads every sample
+    codes = None
+    classes = [DiagnosticClasses[i] for i in selected_diagnostics]
+    if streaming and len(classes) != 0 and all(len(c.CODES) != 0 for c in classes):
+        codes = sorted({code for cls in classes for code in cls.CODES})
+
+    infusion_times, unparsed_infusion_times = load_infusion_times(infusion_times_buffer)
+    preview_unparsed_rows(unparsed_infusion_times, "infusion times")
 
     # Careful ! Maybe some NOPHO_NR have duplicate INFNO at different dates.
     # Let's just filter them for now and log them in console
@@ -40,59 +97,121 @@ def main():
     clean_infusion_times = remove_patients_with_duplicate_treatments(infusion_times)
 
     # Merge samples to treatment times and define treatment number
-    samples_with_treatment_no = merge_samples_to_treatment(
-        samples_df, clean_infusion_times
+    untyped_memory_mb = None
+
+    def merge_samples():
+        nonlocal untyped_memory_mb
+        if streaming:
+            return load_samples_with_treatment(
+                samples_df_buffer, clean_infusion_times, MEMORY_BUDGET_MB, codes
+            )
+        samples_df, unparsed_samples = load_samples(samples_df_buffer)
+        samples_with_treatment_no, untyped_memory_mb = merge_samples_to_treatment(
+            samples_df, clean_infusion_times
+        )
+        return samples_with_treatment_no, unparsed_samples
+
+    # sessions uploading the same files and reading them the same way
+    # share one read-only copy of samples with treatment
+    session = session_id()
+    dataset = content_key(
+        f"samples_with_treatment-streamed={streaming}"
+        + ("" if codes is None else "-codes=" + "-".join(codes)),
+        samples_df_buffer,
+        infusion_times_buffer,
+    )
+    samples_with_treatment_no, unparsed_samples = SHARED_DATASETS.acquire(
+        dataset, session, merge_samples, n_frames=2
     )
+    SHARED_DATASETS.release(session, keep=[dataset])
+    preview_unparsed_rows(unparsed_samples, "samples")
+    preview_memory_usage(samples_with_treatment_no, untyped_memory_mb)
     preview_sample(
         samples_with_treatment_no[samples_with_treatment_no[INFUSION_NO].notnull()]
     )
 
+    all_samples = SHARED_DATASETS.derive(
+        dataset, "partition", lambda: PCodePartition(samples_with_treatment_no)
+    )
+
     # Filter by INFNO - treatment number when some are selected
     selected_treatments_to_filter = st.multiselect(
         "Select treatment no (INFNO) to filter by:", range(1, 9)
     )
     if len(selected_treatments_to_filter) == 0:
-        df = samples_with_treatment_no.copy()
+        samples = all_samples
     else:
-        df = samples_with_treatment_no[
-            samples_with_treatment_no[INFUSION_NO].isin(selected_treatments_to_filter)
-        ].copy()
+        samples = all_samples.memoize(
+            ("INFNO filter", tuple(selected_treatments_to_filter)),
+            lambda: all_samples.filter(
+                samples_with_treatment_no[INFUSION_NO].isin(
+                    selected_treatments_to_filter
+                )
+            ),
+        )
 
-    selected_diagnostics = st.sidebar.multiselect(
-        "Choose the diagnostics you want to study",
-        options=range(0, len(DiagnosticClasses)),
-        format_func=lambda i: DiagnosticClasses[i].name,
+    # charts of collapsed sections are not built, expanders do not tell whether they are open,
+    # each section then has a checkbox to draw its chart
+    lazy = st.sidebar.checkbox(
+        "Build charts only in opened sections", value=LAZY_CHARTS
+    )
+    samples_key = results_key(
+        dataset, selected_treatments_to_filter, streamed=streaming
     )
 
     with st.beta_expander("DEBUG: check DME graphs"):
         select_nopho_nr = st.selectbox(
-            "Select patient ID", df.loc[df[P_CODE] == "NPU02739", PATIENT_ID].unique()
-        )
-        st.plotly_chart(
-            beta_visualize_dme(df, select_nopho_nr), use_container_width=True
+            "Select patient ID",
+            samples.get("NPU02739", [PATIENT_ID])[PATIENT_ID].unique(),
         )
-
-    diagnostics = init_diagnostics(df, selected_diagnostics)
-    run_diagnostics(diagnostics)
-
+        if is_opened("DME debug", lazy):
+            show_chart(
+                CHARTS.get(
+                    (samples_key, "DME debug", select_nopho_nr),
+                    lambda: beta_visualize_dme(samples, select_nopho_nr),
+                ),
+                "DME debug",
+            )
+
+    with stage("run_diagnostics", rows_in=len(samples)):
+        diagnostics = run_diagnostics(samples, selected_diagnostics, samples_key)
+
+    # per patient results of all diagnostics, read by summaries and exports
+    with stage("phenotype") as record:
+        phenotype = PhenotypeMatrix(diagnostics)
+        record.rows_out = len(phenotype.patients)
     if len(selected_diagnostics) != 0:
-        visualize_summary(diagnostics)
-        generate_download(diagnostics)
+        visualize_summary(phenotype, lazy)
+        generate_download(phenotype, diagnostics)
 
-    for diagnostic_data in diagnostics:
-        visualize_diagnostic_samples(diagnostic_data)
+    for i, diagnostic_data in enumerate(diagnostics):
+        visualize_diagnostic_samples(diagnostic_data, samples_key, lazy)
+        visualize_diagnostic_sweep(samples, diagnostic_data)
 
-        detected_positive_patient_ids = diagnostic_data.get_detected_ids()
+        detected_positive_patient_ids = phenotype.detected_ids(i)
         if len(detected_positive_patient_ids) == 0:
             continue
 
         visualize_diagnostic_positive_samples(
-            diagnostic_data, detected_positive_patient_ids
+            diagnostic_data, detected_positive_patient_ids, samples_key, lazy
+        )
+        visualize_diagnostic_patient(
+            diagnostic_data, detected_positive_patient_ids, samples_key, lazy
         )
-        visualize_diagnostic_patient(diagnostic_data, detected_positive_patient_ids)
 
         st.markdown("---")
 
+    show_instrumentation_panel()
+
+
+def session_id() -> str:
+    """Identifier of the Streamlit session running this script"""
+    try:
+        from streamlit.report_thread import get_report_ctx
+    except ImportError:  # Streamlit >= 1.4
+        from streamlit.runtime.scriptrunner import get_script_run_ctx as get_report_ctx
+    return get_report_ctx().session_id
+
 
 def initialize_app_info():
     """Write Streamlit main panel and sidebar titles + tab info"""
@@ -110,47 +229,180 @@ def preview_sample(df: pd.DataFrame):
         st.dataframe(df.sample(100))
 
 
+def preview_memory_usage(df: pd.DataFrame, untyped_memory_mb: Optional[float]):
+    """Memory of samples with treatment, and before their columns were cast to SAMPLES_SCHEMA"""
+    message = f"Samples in memory : {memory_usage_mb(df):.1f} MB"
+    if untyped_memory_mb is not None:
+        message += f" ({untyped_memory_mb:.1f} MB before typing)"
+    st.sidebar.markdown(message)
+
+
+def preview_unparsed_rows(df: pd.DataFrame, file_name: str):
+    """Warn about rows whose dates could not be parsed, they are left out of the computations"""
+    if len(df) == 0:
+        return
+    st.warning(f"{len(df)} rows of {file_name} have dates that could not be parsed")
+    with st.beta_expander(f"Rows of {file_name} with unparsed dates"):
+        st.dataframe(df)
+
+
 def init_diagnostics(
-    df: pd.DataFrame, list_diagnostic_indices: List[int]
+    samples: PCodePartition, list_diagnostic_indices: List[int]
 ) -> List[DiagnoseTypes]:
     """For each index in list_diagnostic_indices, initialize an instance of Diagnostic class with the data"""
     return [
-        DiagnosticClasses[selected_diagnostic_index](df)
+        DiagnosticClasses[selected_diagnostic_index](samples)
         for selected_diagnostic_index in list_diagnostic_indices
     ]
 
 
-def run_diagnostics(list_diagnostics: List[DiagnoseTypes]):
-    """For each diagnostic instance, link Streamlit parameters in sidebar sliders to internal processing state
-    Then run diagnostic logic to build DETECTION column
+def run_diagnostics(
+    samples: PCodePartition, list_diagnostic_indices: List[int], dataset: str
+) -> List[DiagnoseTypes]:
+    """For each selected diagnostic, link Streamlit parameters in sidebar sliders to internal processing state
+    Then run diagnostic logic to build DETECTION column, diagnostics run concurrently in worker processes,
+    started from their class name and parameters while the diagnostics are built in this process.
+    Detections already stored for the dataset and parameters are read back from the results store instead.
+    """
+    classes = [DiagnosticClasses[i] for i in list_diagnostic_indices]
+    params = [diagnostic_class.params_in_sidebar() for diagnostic_class in classes]
+    parallel = st.sidebar.checkbox("Run diagnostics in parallel", value=PARALLEL)
+    tasks = [
+        (diagnostic_class.__name__, diagnostic_params)
+        for diagnostic_class, diagnostic_params in zip(classes, params)
+        if RESULTS is None
+        or not RESULTS.has(dataset, diagnostic_class.__name__, diagnostic_params)
+    ]
+    pending = start_detections(samples, tasks, parallel=parallel)
+
+    with stage("init_diagnostics", rows_in=len(samples)):
+        diagnostics = init_diagnostics(samples, list_diagnostic_indices)
+    for diagnostic_data, diagnostic_params in zip(diagnostics, params):
+        diagnostic_data.set_params(**diagnostic_params)
+    if RESULTS is None:
+        pending.collect(diagnostics)
+        return diagnostics
+    not_stored = RESULTS.restore(dataset, diagnostics)
+    pending.collect(not_stored)
+    # written by a thread of the store, this run does not wait for it
+    RESULTS.save_in_background(dataset, not_stored)
+    return diagnostics
+
+
+def visualize_summary(phenotype: PhenotypeMatrix, lazy: bool):
+    show_chart(visualize_summary_detection(phenotype), "summary")
+    if len(phenotype.names) > 1:
+        with st.beta_expander("Visualize patients positive to several diagnostics"):
+            if is_opened("co_occurrence", lazy):
+                show_chart(visualize_co_occurrence(phenotype), "co_occurrence")
+
+
+def is_opened(section: str, lazy: bool) -> bool:
+    """Whether the chart of a section is built: always without lazy, else once the checkbox of the section is ticked.
+    Expanders do not tell whether they are open, the checkbox stands for it.
+    """
+    return not lazy or st.checkbox("Draw chart", key=f"{section}_draw")
+
+
+def chart_key(dataset: str, diagnostic: DiagnoseTypes, *args: Hashable) -> Tuple:
+    """Key of a chart of diagnostic in CHARTS, its data only depends on the dataset and the parameters"""
+    params = tuple(sorted(diagnostic.get_params().items()))
+    return (dataset, type(diagnostic).__name__, params) + args
+
+
+def show_chart(chart: Chart, name: str):
+    """Display an Altair chart, or a Plotly figure used by charts with many points.
+    Drawing is recorded as a stage, it includes serializing the chart for the browser.
     """
-    for diagnostic_data in list_diagnostics:
-        diagnostic_data.update_params_in_sidebar()
-        diagnostic_data.run_detection()
+    with stage(f"draw {name}"):
+        if isinstance(chart, go.Figure):
+            st.plotly_chart(chart, use_container_width=True)
+        else:
+            st.altair_chart(chart, use_container_width=True)
 
 
-def visualize_summary(diagnostics: List[DiagnoseTypes]):
-    st.altair_chart(visualize_summary_detection(diagnostics), use_container_width=True)
+def show_instrumentation_panel():
+    """Sidebar table of time, rows and change of traced memory of each stage of this run, and of cache lookups"""
+    if not st.sidebar.checkbox("Show timings of this run"):
+        return
+    events = events_frame().drop(columns="run")
+    stages = events[events["kind"] == "stage"]
+    st.sidebar.markdown(f"Time in stages : {stages['seconds'].sum():.2f} s")
+    if stages["traced_memory_change_mb"].notna().any():
+        st.sidebar.markdown(
+            "traced_memory_change_mb : change of memory traced in the whole process "
+            "during the stage, allocations of other sessions included"
+        )
+    st.sidebar.dataframe(events)
 
 
-def visualize_diagnostic_samples(diagnostic_data: DiagnoseTypes):
+def visualize_diagnostic_samples(
+    diagnostic_data: DiagnoseTypes, dataset: str, lazy: bool
+):
     st.header(diagnostic_data.name)
     with st.beta_expander("Visualize all samples"):
-        st.altair_chart(visualize_detected(diagnostic_data), use_container_width=True)
+        name = f"{diagnostic_data.name} all samples"
+        if is_opened(name, lazy):
+            chart = CHARTS.get(
+                chart_key(dataset, diagnostic_data, "all samples"),
+                lambda: visualize_detected(diagnostic_data),
+            )
+            show_chart(chart, name)
+
+
+def visualize_diagnostic_sweep(samples: PCodePartition, diagnostic_data: DiagnoseTypes):
+    """Number of positive patients over the range of two parameters, others fixed at their slider value"""
+    if len(diagnostic_data.PARAMS) == 0:
+        return
+    with st.beta_expander(
+        "Visualize number of positive patients over parameters range"
+    ):
+        if not st.checkbox("Compute", key=f"{diagnostic_data.name}_sweep"):
+            return
+        # the sweep does not depend on slider values, compute it once per dataset
+        sweep = samples.memoize(("sweep", diagnostic_data.name), diagnostic_data.sweep)
+        params = [param.name for param in diagnostic_data.PARAMS]
+        x = st.selectbox(
+            "Parameter on x axis", params, key=f"{diagnostic_data.name}_sweep_x"
+        )
+        y = st.selectbox(
+            "Parameter on y axis",
+            [None] + [p for p in params if p != x],
+            index=1 if len(params) > 1 else 0,
+            key=f"{diagnostic_data.name}_sweep_y",
+        )
+        for param in params:
+            if param in [x, y]:
+                continue
+            values = sweep[param].unique()
+            current = values[np.abs(values - getattr(diagnostic_data, param)).argmin()]
+            sweep = sweep[sweep[param] == current]
+        show_chart(visualize_sweep(sweep, x, y), f"{diagnostic_data.name} sweep")
 
 
 def visualize_diagnostic_positive_samples(
-    diagnostic_data: DiagnoseTypes, detected_patient_ids: List[str]
+    diagnostic_data: DiagnoseTypes,
+    detected_patient_ids: List[str],
+    dataset: str,
+    lazy: bool,
 ):
     with st.beta_expander("Visualize all positive samples"):
-        st.altair_chart(
-            visualize_detected_by_patient(diagnostic_data, detected_patient_ids),
-            use_container_width=True,
-        )
+        name = f"{diagnostic_data.name} positive samples"
+        if is_opened(name, lazy):
+            chart = CHARTS.get(
+                chart_key(dataset, diagnostic_data, "positive samples"),
+                lambda: visualize_detected_by_patient(
+                    diagnostic_data, detected_patient_ids
+                ),
+            )
+            show_chart(chart, name)
 
 
 def visualize_diagnostic_patient(
-    diagnostic_data: DiagnoseTypes, detected_patient_ids: List[str]
+    diagnostic_data: DiagnoseTypes,
+    detected_patient_ids: List[str],
+    dataset: str,
+    lazy: bool,
 ):
     with st.beta_expander("Visualize samples for a specific patient"):
         selected_patient_id = st.selectbox(
@@ -158,30 +410,60 @@ def visualize_diagnostic_patient(
             detected_patient_ids,
             key=f"{diagnostic_data.name}_patient_id_slider",
         )
-        st.altair_chart(
-            visualize_patient(diagnostic_data, selected_patient_id),
-            use_container_width=True,
-        )
-
-
-def generate_download(diagnostics: List[DiagnoseTypes]):
-    all_dfs = (
-        pd.concat([d.data[[PATIENT_ID, DETECTION]] for d in diagnostics])
-        .groupby(PATIENT_ID)[DETECTION]
-        .agg("max")
-        .reset_index()
-        .rename(columns={DETECTION: "PHONOTYPE"})
-    )
-    all_dfs["PHONOTYPE"] = all_dfs["PHONOTYPE"].astype(int)
+        name = f"{diagnostic_data.name} patient"
+        if is_opened(name, lazy):
+            chart = CHARTS.get(
+                chart_key(dataset, diagnostic_data, "patient", selected_patient_id),
+                lambda: visualize_patient(diagnostic_data, selected_patient_id),
+            )
+            show_chart(chart, name)
+
+
+def generate_download(phenotype: PhenotypeMatrix, diagnostics: List[DiagnoseTypes]):
+    all_dfs = phenotype.phenotype()
+    n_positive = int(all_dfs["PHONOTYPE"].sum())
     st.markdown(
         f"""
     * Number of patients in diagnostics : {len(all_dfs)}
-    * Number of patients with positive phenotype : {len(all_dfs[all_dfs['PHONOTYPE'] == 1])}
-    * Number of patients with negative phenotype : {len(all_dfs[all_dfs['PHONOTYPE'] == 0])}
+    * Number of patients with positive phenotype : {n_positive}
+    * Number of patients with negative phenotype : {len(all_dfs) - n_positive}
     """
     )
-    with st.beta_expander("Generate download link"):
-        st.markdown(generate_download_link(all_dfs), unsafe_allow_html=True)
+    with st.beta_expander("Export results"):
+        tables = ["PHONOTYPE per patient"]
+        if hasattr(st, "download_button"):
+            tables.append("Detection per sample")
+        else:
+            # this Streamlit version can only link to data encoded in the page, too large per sample
+            st.info("mtx-phenotype exports detections per sample without the app")
+        table = st.radio("Table", tables)
+        fmt = st.selectbox("Format", FORMATS, index=FORMATS.index("csv.gz"))
+        # results are only serialized when asked, not on every rerun
+        if not st.button("Prepare export"):
+            return
+        if table == "PHONOTYPE per patient":
+            frames, file_name = iter_chunks(all_dfs), "phenotype"
+        else:
+            frames, file_name = detection_detail(diagnostics), "detections"
+        file_name = f"{file_name}.{fmt}"
+        # chunks are written to a file as they are serialized, not joined in memory
+        fd, path = tempfile.mkstemp(prefix="mtx-export-", suffix=f"-{file_name}")
+        os.close(fd)
+        try:
+            export_to_file(frames, path, fmt)
+            with open(path, "rb") as f:
+                if hasattr(st, "download_button"):
+                    st.download_button(
+                        f"Download {file_name}", f, file_name, mime=MIME_TYPES[fmt]
+                    )
+                else:
+                    # one row per patient, small enough for a link with the file encoded in the page
+                    st.markdown(
+                        generate_download_link(f.read(), file_name, MIME_TYPES[fmt]),
+                        unsafe_allow_html=True,
+                    )
+        finally:
+            os.remove(path)
 
 
 if __name__ == "__main__":
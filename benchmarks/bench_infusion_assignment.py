@@ -0,0 +1,122 @@
+"""Benchmark infusion assignment: row-wise apply against the vectorized merge_asof engine.
+
+    python -m benchmarks.bench_infusion_assignment --patients 2000 --samples-per-patient 200
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.processing import assign_infusions
+
+
+def make_cohort(n_patients: int, samples_per_patient: int, n_infusions: int, seed=0):
+    """Random samples and infusion times, infusions every 14 days starting at day 7"""
+    rng = np.random.default_rng(seed)
+    patient_ids = np.arange(n_patients) + 1000
+
+    infusion_times = pd.DataFrame(
+        {
+            PATIENT_ID: np.repeat(patient_ids, n_infusions),
+            INFUSION_NO: np.tile(np.arange(1, n_infusions + 1), n_patients).astype(str),
+            INF_STARTDATE: pd.Timestamp("2020-01-01")
+            + pd.to_timedelta(
+                np.tile(7 + 14 * np.arange(n_infusions), n_patients), unit="D"
+            )
+            + pd.to_timedelta(
+                rng.integers(0, 24 * 60, n_patients * n_infusions), unit="m"
+            ),
+        }
+    )
+
+    n_samples = n_patients * samples_per_patient
+    samples = pd.DataFrame(
+        {
+            PATIENT_ID: np.repeat(patient_ids, samples_per_patient),
+            SAMPLE_TIME: pd.Timestamp("2020-01-01")
+            + pd.to_timedelta(
+                rng.integers(0, (14 * n_infusions + 14) * 24 * 60, n_samples), unit="m"
+            ),
+        }
+    )
+    return samples, infusion_times
+
+
+def legacy_assign_infusions(samples: pd.DataFrame, infusion_times: pd.DataFrame):
+    """Previous implementation: wide pivot merge then a row-wise apply over infusions "1".."8" """
+    pivot_infusion_times = infusion_times.pivot(
+        index=PATIENT_ID, columns=INFUSION_NO, values=INF_STARTDATE
+    ).reset_index()
+    df = samples.merge(pivot_infusion_times, on=PATIENT_ID, how="left", indicator=True)
+    df["_merge"] = df["_merge"].astype(str)
+
+    def date_to_treatment_no(s: pd.Series):
+        if s["_merge"] == "left_only":
+            return [None, None, None]
+        for infusion in ["8", "7", "6", "5", "4", "3", "2", "1"]:
+            if (
+                infusion in s
+                and not pd.isnull(s[infusion])
+                and s[SAMPLE_TIME] >= s[infusion]
+            ):
+                return [int(infusion), s[infusion], s[SAMPLE_TIME] - s[infusion]]
+        if not pd.isnull(s["1"]) and s[SAMPLE_TIME] < s["1"]:
+            return [0, s["1"], s[SAMPLE_TIME] - s["1"]]
+        return [None, None, None]
+
+    res = df.apply(date_to_treatment_no, axis=1, result_type="expand")
+    res.columns = [INFUSION_NO, INF_STARTDATE, DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE]
+    res[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE] = np.floor(
+        pd.to_timedelta(res[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE])
+        / np.timedelta64(1, "h")
+    )
+    return res
+
+
+def timeit(fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--patients", type=int, default=500)
+    parser.add_argument("--samples-per-patient", type=int, default=200)
+    parser.add_argument("--infusions", type=int, default=8)
+    parser.add_argument(
+        "--skip-legacy", action="store_true", help="Only time the vectorized engine"
+    )
+    args = parser.parse_args()
+
+    samples, infusion_times = make_cohort(
+        args.patients, args.samples_per_patient, args.infusions
+    )
+    print(f"{len(samples)} samples, {len(infusion_times)} infusions")
+
+    vectorized, t_vectorized = timeit(assign_infusions, samples, infusion_times)
+    print(f"vectorized : {t_vectorized:8.3f} s")
+
+    if args.skip_legacy:
+        return
+    legacy, t_legacy = timeit(legacy_assign_infusions, samples, infusion_times)
+    print(f"row-wise   : {t_legacy:8.3f} s  (x{t_legacy / t_vectorized:.0f})")
+
+    if args.infusions <= 8:
+        pd.testing.assert_series_equal(
+            vectorized[INFUSION_NO],
+            legacy[INFUSION_NO].astype(float),
+            check_names=False,
+        )
+        pd.testing.assert_series_equal(
+            vectorized[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE],
+            legacy[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE],
+            check_names=False,
+        )
+        print("results are identical")
+
+
+if __name__ == "__main__":
+    main()
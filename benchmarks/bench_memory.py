@@ -0,0 +1,102 @@
+"""Peak memory allocated by each stage of the detection pipeline, measured with tracemalloc.
+
+    python -m benchmarks.bench_memory --rows 1000000 --save memory.json
+    python -m benchmarks.bench_memory --rows 1000000 --baseline memory.json --tolerance 0.1
+
+With --baseline, exits with an error when a stage allocates more than its baseline peak plus tolerance.
+"""
+import argparse
+import json
+import sys
+import tracemalloc
+from typing import Callable, Dict, Tuple
+
+import pandas as pd
+
+from benchmarks.bench_parallel import make_merged_samples
+from src.constants import *
+from src.dataset import cast_to_schema
+from src.diagnostics import DiagnosticClasses
+from src.partition import PCodePartition
+from src.visualization import visualize_detected
+from src.visualization import visualize_detected_by_patient
+from src.visualization import visualize_patient
+
+
+def traced(fn: Callable, *args) -> Tuple[object, float]:
+    """Result of fn(*args) and the peak memory in MB it allocated"""
+    tracemalloc.start()
+    try:
+        res = fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return res, peak / 1024 / 1024
+
+
+def run_stages(merged: pd.DataFrame) -> Dict[str, float]:
+    peaks = {}
+    typed, peaks["cast_to_schema"] = traced(cast_to_schema, merged)
+    all_samples, peaks["partition"] = traced(PCodePartition, typed)
+    samples, peaks["filter INFNO"] = traced(
+        all_samples.filter, typed[INFUSION_NO].isin([1, 2, 3])
+    )
+
+    for cls in DiagnosticClasses:
+        diagnostic, peaks[f"{cls.__name__} init"] = traced(cls, samples)
+        _, peaks[f"{cls.__name__} detection"] = traced(diagnostic.run_detection)
+
+        def charts():
+            ids = diagnostic.get_detected_ids()
+            visualize_detected(diagnostic)
+            visualize_detected_by_patient(diagnostic, ids)
+            if len(ids) != 0:
+                visualize_patient(diagnostic, ids[0])
+
+        _, peaks[f"{cls.__name__} charts"] = traced(charts)
+    return peaks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--save", help="Write peaks per stage to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of peaks per stage to compare to")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative increase over the baseline peak considered a regression",
+    )
+    args = parser.parse_args()
+
+    merged = make_merged_samples(args.rows, args.patients)
+    fingerprint = pd.util.hash_pandas_object(merged).sum()
+    peaks = run_stages(merged)
+    assert pd.util.hash_pandas_object(merged).sum() == fingerprint, "input mutated"
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print(f"{'stage':<24} {'peak (MB)':>10} {'baseline':>10}")
+    for stage, peak in peaks.items():
+        reference = baseline.get(stage)
+        print(
+            f"{stage:<24} {peak:>10.1f} {'-' if reference is None else f'{reference:.1f}':>10}"
+        )
+        if reference is not None and peak > reference * (1 + args.tolerance) + 1:
+            regressions.append(stage)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(peaks, f, indent=2)
+    if regressions:
+        sys.exit(f"Peak memory regression in stages: {regressions}")
+
+
+if __name__ == "__main__":
+    main()
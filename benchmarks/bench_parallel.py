@@ -0,0 +1,80 @@
+"""Benchmark running all diagnostics serially against the process pool runner.
+
+    python -m benchmarks.bench_parallel --rows 5000000 --workers 1 2 4 8
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from src import cache
+from src.constants import *
+from src.diagnostics import DiagnosticClasses
+from src.partition import PCodePartition
+from src.runner import run_detections
+
+P_CODES = {
+    "NPU02902": 1.0,
+    "NPU19748": 80,
+    "NPU19651": 40,
+    "NPU01684": 0.5,
+    "NPU01370": 30,
+    "NPU18016": 60,
+    "NPU03568": 15,
+    "NPU19652": 200,
+    "NPU19653": 60,
+    "DNK05451": 300,
+    "NPU02739": 10,
+}
+
+
+def make_merged_samples(n_rows: int, n_patients: int, seed=0) -> pd.DataFrame:
+    """Random samples as after merge_samples_to_treatment, 6 hours apart at most"""
+    rng = np.random.default_rng(seed)
+    p_code = rng.choice(list(P_CODES), n_rows)
+    hour_diff = rng.integers(-48, 14 * 24, n_rows)
+    return pd.DataFrame(
+        {
+            PATIENT_ID: rng.integers(0, n_patients, n_rows),
+            SAMPLE_TIME: pd.Timestamp("2020-01-01")
+            + pd.to_timedelta(6 * rng.integers(0, 365 * 4, n_rows), unit="h"),
+            P_CODE: p_code,
+            VALUE: rng.exponential(1, n_rows) * pd.Series(p_code).map(P_CODES),
+            REF_PATIENT: "<8,0",
+            INFUSION_NO: np.where(hour_diff < 0, 0, rng.integers(1, 9, n_rows)).astype(
+                float
+            ),
+            DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE: hour_diff.astype(float),
+            SEX: 1,
+            MP6_STOP: 0.0,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 7])
+    args = parser.parse_args()
+
+    cache.CACHE_DIR = tempfile.mkdtemp()
+    samples = PCodePartition(make_merged_samples(args.rows, args.patients))
+
+    print(f"{'workers':>8} {'first run (s)':>14} {'rerun (s)':>10}")
+    for n_workers in args.workers:
+        timings = []
+        for _ in range(2):
+            diagnostics = [cls(samples) for cls in DiagnosticClasses]
+            start = time.perf_counter()
+            run_detections(
+                samples, diagnostics, parallel=n_workers > 1, max_workers=n_workers
+            )
+            timings.append(time.perf_counter() - start)
+        print(f"{n_workers:>8} {timings[0]:>14.2f} {timings[1]:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Time and peak memory of each stage of the pipeline, on synthetic cohorts of increasing size.
+
+    python -m benchmarks.bench_stages --rows 10000 1000000 20000000 --save stages.json
+
+Stages follow the app: load, dedupe, merge_samples_to_treatment, partition, each run_detection,
+summary and export. Cohorts are written once to --data-dir by src.synthetic and reused by later runs.
+Timings include the overhead of tracemalloc, use --no-memory for timings alone.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Dict, Tuple
+
+from benchmarks.bench_memory import traced
+from src.constants import *
+from src.dataset import drop_patients_with_duplicate_treatments
+from src.dataset import merge_samples_to_treatment
+from src.dataset import read_infusion_times
+from src.dataset import read_samples
+from src.diagnostics import DiagnosticClasses
+from src.export import detection_detail
+from src.export import export_chunks
+from src.partition import PCodePartition
+from src.phenotype import PhenotypeMatrix
+from src.synthetic import ANALYTES
+from src.synthetic import write_cohort
+
+
+def measure(fn: Callable, *args, memory: bool = True) -> Tuple[object, float, float]:
+    """Result of fn(*args), seconds it took and peak memory in MB it allocated, NaN without memory"""
+    start = time.perf_counter()
+    if memory:
+        res, peak = traced(fn, *args)
+    else:
+        res, peak = fn(*args), float("nan")
+    return res, time.perf_counter() - start, peak
+
+
+def export_detail(diagnostics) -> int:
+    return sum(
+        len(block) for block in export_chunks(detection_detail(diagnostics), "csv.gz")
+    )
+
+
+def run_stages(paths: Dict[str, str], memory: bool) -> Dict[str, Tuple[float, float]]:
+    stages = {}
+
+    def stage(name, fn, *args):
+        res, seconds, peak = measure(fn, *args, memory=memory)
+        stages[name] = (seconds, peak)
+        return res
+
+    (samples, _) = stage("load samples", read_samples, paths["samples"])
+    (infusion_times, _) = stage(
+        "load infusion times", read_infusion_times, paths["infusion_times"]
+    )
+    (infusion_times, _) = stage(
+        "dedupe", drop_patients_with_duplicate_treatments, infusion_times
+    )
+    (merged, _) = stage("merge", merge_samples_to_treatment, samples, infusion_times)
+    del samples
+    all_samples = stage("partition", PCodePartition, merged)
+    treated = stage(
+        "filter INFNO", all_samples.filter, merged[INFUSION_NO].isin([1, 2, 3])
+    )
+
+    diagnostics = []
+    for cls in DiagnosticClasses:
+        diagnostic = stage(f"{cls.__name__} init", cls, treated)
+        stage(f"{cls.__name__} detection", diagnostic.run_detection)
+        diagnostics.append(diagnostic)
+
+    def summary():
+        phenotype = PhenotypeMatrix(diagnostics)
+        return phenotype.summary(), phenotype.phenotype()
+
+    stage("summary", summary)
+    stage("export", export_detail, diagnostics)
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 1_000_000, 20_000_000]
+    )
+    parser.add_argument("--samples-per-analyte", type=int, default=40)
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "mtx-bench"),
+        help="Folder of the synthetic cohorts",
+    )
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory")
+    parser.add_argument(
+        "--save", help="Write seconds and peak MB per stage to this JSON file"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for n_rows in args.rows:
+        n_patients = max(n_rows // (args.samples_per_analyte * len(ANALYTES)), 1)
+        folder = os.path.join(
+            args.data_dir, f"patients-{n_patients}-samples-{args.samples_per_analyte}"
+        )
+        paths = {
+            "samples": os.path.join(folder, "samples.csv"),
+            "infusion_times": os.path.join(folder, "infusion_times.xlsx"),
+        }
+        if not all(os.path.exists(path) for path in paths.values()):
+            print(f"writing cohort of {n_patients} patients to {folder}")
+            paths = write_cohort(
+                folder,
+                n_patients=n_patients,
+                samples_per_analyte=args.samples_per_analyte,
+            )
+
+        stages = run_stages(paths, memory=not args.no_memory)
+        results[str(n_rows)] = {
+            name: {"seconds": seconds, "peak_mb": peak}
+            for name, (seconds, peak) in stages.items()
+        }
+        print(f"\n{n_rows} rows, {n_patients} patients")
+        print(f"{'stage':<24} {'time (s)':>10} {'peak (MB)':>10}")
+        for name, (seconds, peak) in stages.items():
+            print(f"{name:<24} {seconds:>10.2f} {peak:>10.1f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark streak detection: groupby/shift/cumsum/merge pipeline against the NumPy run-length kernel.
+
+    python -m benchmarks.bench_streaks --rows 1000000 10000000 50000000 --legacy-max-rows 10000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.processing import is_streak_longer_than_duration
+
+
+def make_detections(n_rows: int, n_patients: int, seed=0) -> pd.DataFrame:
+    """Random detections, one sample every 6 hours per patient on average"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            PATIENT_ID: rng.integers(0, n_patients, n_rows),
+            SAMPLE_TIME: pd.Timestamp("2020-01-01")
+            + pd.to_timedelta(
+                rng.integers(0, 6 * 60 * max(n_rows // n_patients, 1), n_rows), unit="m"
+            ),
+            # long streaks of successive equal detections
+            DETECTION: rng.random(n_rows) < 0.8,
+        }
+    )
+
+
+def legacy_is_streak_longer_than_duration(
+    df, column_variable, column_patient_id, column_date, longer_than_n_hours
+):
+    """Previous implementation: streak ids with groupby shift + cumsum, then aggregate and merge back"""
+    data = df.copy()
+    sorted_data = data.sort_values([column_patient_id, column_date])
+    sorted_data["shifted"] = sorted_data.groupby(column_patient_id)[
+        column_variable
+    ].shift(1)
+    sorted_data["start_of_streak"] = sorted_data[column_variable].ne(
+        sorted_data["shifted"]
+    )
+    data["streak_id"] = sorted_data.groupby(column_patient_id)[
+        "start_of_streak"
+    ].cumsum()
+
+    group_streaks_by_patient = (
+        data.groupby([column_patient_id, "streak_id"])[[column_date, column_variable]]
+        .agg(
+            min_date=(column_date, "min"),
+            max_date=(column_date, "max"),
+            is_streak_positive=(column_variable, "first"),
+        )
+        .reset_index()
+    )
+    group_streaks_by_patient["streak_duration"] = (
+        group_streaks_by_patient["max_date"] - group_streaks_by_patient["min_date"]
+    ) / np.timedelta64(1, "h")
+    group_streaks_by_patient[column_variable] = (
+        group_streaks_by_patient["streak_duration"] > longer_than_n_hours
+    ) & group_streaks_by_patient["is_streak_positive"]
+
+    res = (
+        data.reset_index()
+        .merge(
+            group_streaks_by_patient, on=[column_patient_id, "streak_id"], how="left"
+        )
+        .set_index("index")
+    )
+    return res[f"{column_variable}_x"] & res[f"{column_variable}_y"]
+
+
+def timeit(fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[1_000_000, 10_000_000, 50_000_000]
+    )
+    parser.add_argument("--patients", type=int, default=5000)
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument(
+        "--legacy-max-rows",
+        type=int,
+        default=10_000_000,
+        help="Skip the previous implementation above this size, it needs several times the memory",
+    )
+    args = parser.parse_args()
+
+    print(f"{'rows':>12} {'kernel (s)':>12} {'legacy (s)':>12} {'speedup':>8}")
+    for n_rows in args.rows:
+        df = make_detections(n_rows, args.patients)
+        args_streak = (df, DETECTION, PATIENT_ID, SAMPLE_TIME, args.hours)
+        kernel, t_kernel = timeit(is_streak_longer_than_duration, *args_streak)
+
+        if n_rows > args.legacy_max_rows:
+            print(f"{n_rows:>12} {t_kernel:>12.2f} {'-':>12} {'-':>8}")
+            continue
+        legacy, t_legacy = timeit(legacy_is_streak_longer_than_duration, *args_streak)
+        assert (kernel.to_numpy() == legacy.to_numpy()).all()
+        print(
+            f"{n_rows:>12} {t_kernel:>12.2f} {t_legacy:>12.2f} {t_legacy / t_kernel:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
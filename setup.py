@@ -35,5 +35,6 @@ setup(
     description="",
     python_requires=">=3.7",
     long_description=readme(),
+    entry_points={"console_scripts": ["mtx-phenotype=src.cli:main"]},
     # install_requires=requirements(),
 )
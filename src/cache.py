@@ -0,0 +1,155 @@
+"""Persistent cache of parsed input files.
+
+Uploaded files are identified by the hash of their bytes, the parsed dataframes are stored
+as uncompressed Feather (Arrow IPC) files so a re-upload of the same export is a memory-mapped read.
+
+    MTX_CACHE_DIR=/data/mtx_cache MTX_CACHE_MAX_SIZE_MB=2048 streamlit run app.py
+"""
+import hashlib
+import os
+import time
+from typing import BinaryIO, Callable, List, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from src.instrumentation import record_cache_lookup
+
+# Bump when parsing logic changes so older entries are not read back
+CACHE_VERSION = 2
+
+CACHE_DIR = os.environ.get(
+    "MTX_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mtx_app")
+)
+CACHE_MAX_SIZE_MB = float(os.environ.get("MTX_CACHE_MAX_SIZE_MB", 4096))
+CACHE_MAX_AGE_DAYS = float(os.environ.get("MTX_CACHE_MAX_AGE_DAYS", 30))
+# files of parsed entries start with it, other modules writing to CACHE_DIR manage their own files
+ENTRY_PREFIX = "parsed-"
+
+FileSource = Union[str, BinaryIO]
+Frames = Union[pd.DataFrame, Tuple[pd.DataFrame, ...]]
+
+
+def file_hash(source: FileSource) -> str:
+    """Hash the bytes of a path or a file-like object (Streamlit UploadedFile, BytesIO...)"""
+    h = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    elif hasattr(source, "getvalue"):
+        h.update(source.getvalue())
+    else:
+        position = source.tell()
+        for block in iter(lambda: source.read(1 << 20), b""):
+            h.update(block)
+        source.seek(position)
+    return h.hexdigest()
+
+
+def _entry_paths(key: str, n_frames: int) -> List[str]:
+    return [
+        os.path.join(CACHE_DIR, f"{ENTRY_PREFIX}{key}.{i}.feather")
+        for i in range(n_frames)
+    ]
+
+
+def cached_parse(
+    source: FileSource,
+    kind: str,
+    parse: Callable[[FileSource], Frames],
+    n_frames: int = 1,
+) -> Frames:
+    """Return parse(source), read from disk when the same bytes were already parsed.
+
+    Parameters
+    ----------
+    source
+        Path or file-like object to parse
+
+    kind
+        Name of the parser, part of the cache key so one file parsed two ways does not collide
+
+    parse
+        Function returning a dataframe, or a tuple of n_frames dataframes
+
+    n_frames
+        Number of dataframes returned by parse
+
+    Returns
+    -------
+    Frames
+        Output of parse, with a default RangeIndex
+    """
+    if not CACHE_DIR:
+        return parse(source)
+
+    key = f"{kind}-v{CACHE_VERSION}-{file_hash(source)}"
+    paths = _entry_paths(key, n_frames)
+    if all(os.path.exists(p) for p in paths):
+        try:
+            frames = tuple(
+                feather.read_table(p, memory_map=True).to_pandas() for p in paths
+            )
+            for p in paths:
+                os.utime(p)
+            record_cache_lookup(f"disk {kind}", hit=True)
+            return frames[0] if n_frames == 1 else frames
+        except OSError:
+            pass  # corrupted or concurrently evicted entry, parse again
+
+    record_cache_lookup(f"disk {kind}", hit=False)
+    frames = parse(source)
+    frames = (frames,) if n_frames == 1 else tuple(frames)
+    frames = tuple(df.reset_index(drop=True) for df in frames)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for df, path in zip(frames, paths):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            feather.write_feather(df, tmp_path, compression="uncompressed")
+            os.replace(tmp_path, path)
+        except (pa.ArrowException, OSError):
+            # eg. object columns mixing numbers and strings, keep the result uncached
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    evict()
+
+    return frames[0] if n_frames == 1 else frames
+
+
+def evict(
+    max_size_mb: float = CACHE_MAX_SIZE_MB,
+    max_age_days: float = CACHE_MAX_AGE_DAYS,
+    prefix: str = ENTRY_PREFIX,
+) -> None:
+    """Remove entries unused for max_age_days, then least recently used entries above max_size_mb.
+
+    Only files of CACHE_DIR starting with prefix are entries, other files are left to their module.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if not name.startswith(prefix) or not name.endswith((".feather", ".parquet")):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    now = time.time()
+    total_size = sum(size for _, size, _ in entries)
+    for last_used, size, path in sorted(entries):
+        too_old = now - last_used > max_age_days * 24 * 3600
+        too_big = total_size > max_size_mb * 1024 * 1024
+        if not (too_old or too_big):
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
@@ -0,0 +1,335 @@
+"""Run diagnostics on exported files without Streamlit, for unattended phenotyping of the cohort.
+
+    mtx-phenotype --samples samples.xlsx --infusion-times infusion_times.xlsx \\
+        --params params.json --diagnostics Diagnose1 DME --output-dir results/
+
+The parameter file is a JSON object of parameters per diagnostic class name,
+missing parameters take the default value of their slider in the app:
+
+    {"Diagnose1": {"param_concentration": 0.5, "param_days": 10}, "DME": {"threshold_mtx_48h": 5.0}}
+
+Use --print-params to get the full parameter file with default values.
+"""
+import argparse
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Sequence
+
+from src.cache import cached_parse
+from src.constants import *
+from src.dataset import assign_samples_to_treatment
+from src.dataset import cast_to_schema
+from src.dataset import drop_patients_with_duplicate_treatments
+from src.dataset import read_infusion_times
+from src.dataset import memory_usage_mb
+from src.dataset import read_samples
+from src.diagnostics import DIAGNOSTICS_BY_NAME
+from src.diagnostics import DiagnoseTypes
+from src.export import export_to_file
+from src.export import FORMATS
+from src.export import iter_chunks
+from src.incremental import apply_delta
+from src.incremental import PhenotypingState
+from src.incremental import settings
+from src.instrumentation import is_tracing_memory
+from src.instrumentation import start_run
+from src.partition import PCodePartition
+from src.phenotype import PhenotypeMatrix
+from src.registry import content_key
+from src.runner import PARALLEL
+from src.runner import run_detections
+from src.store import results_key
+from src.store import ResultStore
+from src.streaming import read_samples_with_treatment
+from src.streaming import stream_samples_to_treatment
+
+logger = logging.getLogger(__name__)
+
+
+def read_codes(diagnostic_names: Sequence[str]) -> Optional[List[str]]:
+    """P_CODE read by the diagnostics, None when one of them reads every sample"""
+    codes = set()
+    for name in diagnostic_names:
+        if len(DIAGNOSTICS_BY_NAME[name].CODES) == 0:
+            return None
+        codes.update(DIAGNOSTICS_BY_NAME[name].CODES)
+    return sorted(codes)
+
+
+def default_params() -> Dict[str, Dict[str, Any]]:
+    """Parameters of every diagnostic with their default value, in the format of the parameter file"""
+    return {
+        name: {param.name: param.value for param in cls.PARAMS}
+        for name, cls in DIAGNOSTICS_BY_NAME.items()
+    }
+
+
+def run_phenotyping(
+    samples: PCodePartition,
+    diagnostic_names: Sequence[str],
+    params: Optional[Dict[str, Dict[str, Any]]] = None,
+    parallel: bool = PARALLEL,
+    store: Optional[ResultStore] = None,
+    dataset: str = "",
+) -> List[DiagnoseTypes]:
+    """Initialize and run diagnostics by class name, with their parameters from params.
+    With a store, detections stored for the dataset key and parameters are read back instead of run.
+    """
+    params = params or {}
+    unknown = set(diagnostic_names) | set(params)
+    unknown -= set(DIAGNOSTICS_BY_NAME)
+    if len(unknown) != 0:
+        raise ValueError(
+            f"Unknown diagnostics {sorted(unknown)}, choose among {list(DIAGNOSTICS_BY_NAME)}"
+        )
+
+    diagnostics = []
+    for name in diagnostic_names:
+        diagnostic = DIAGNOSTICS_BY_NAME[name](samples)
+        diagnostic.set_params(**params.get(name, {}))
+        diagnostics.append(diagnostic)
+    if store is None:
+        run_detections(samples, diagnostics, parallel=parallel)
+        return diagnostics
+    pending = store.restore(dataset, diagnostics)
+    run_detections(samples, pending, parallel=parallel)
+    store.save(dataset, pending)
+    return diagnostics
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="mtx-phenotype",
+        description="Run diagnostics on samples and infusion times exports",
+    )
+    parser.add_argument("--samples", help="File with blood samples (xlsx or csv)")
+    parser.add_argument("--infusion-times", help="File with infusion times (xlsx)")
+    parser.add_argument(
+        "--params", help="JSON file with parameters per diagnostic class name"
+    )
+    parser.add_argument(
+        "--diagnostics",
+        nargs="+",
+        choices=list(DIAGNOSTICS_BY_NAME),
+        default=list(DIAGNOSTICS_BY_NAME),
+        help="Diagnostics to run, all by default",
+    )
+    parser.add_argument(
+        "--treatments",
+        nargs="+",
+        type=int,
+        help="Only keep samples of these treatment numbers (INFNO)",
+    )
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=float,
+        help="Read samples in chunks processed within this memory, "
+        "samples with their treatment are written to the output folder "
+        "and only those of the P_CODE read by the diagnostics are read back",
+    )
+    parser.add_argument(
+        "--serial",
+        action="store_true",
+        help="Run diagnostics one after another instead of in worker processes",
+    )
+    parser.add_argument("--output-dir", default=".", help="Folder to write results to")
+    parser.add_argument(
+        "--state-dir",
+        help="Folder keeping samples, infusion times and detections of this run, "
+        "updated by later runs with --append",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="--samples, and --infusion-times when given, are delta exports: only patients "
+        "with new samples or infusions are processed again and spliced into --state-dir",
+    )
+    parser.add_argument(
+        "--results-db",
+        help="SQLite file of detections of previous runs, read back for the same "
+        "exports and parameters and completed with the detections of this run",
+    )
+    parser.add_argument(
+        "--format", choices=FORMATS, default="csv", help="Format of the result files"
+    )
+    parser.add_argument(
+        "--print-params",
+        action="store_true",
+        help="Print the parameter file with default values and exit",
+    )
+    args = parser.parse_args(argv)
+    if args.print_params:
+        return args
+    if args.append and (args.samples is None or args.state_dir is None):
+        parser.error("--append requires --samples and --state-dir")
+    if not args.append and (args.samples is None or args.infusion_times is None):
+        parser.error("--samples and --infusion-times are required")
+    return args
+
+
+def run_on_exports(
+    args: argparse.Namespace, params: Dict[str, Dict[str, Any]]
+) -> List[DiagnoseTypes]:
+    """Diagnostics run on whole exports, their state written to --state-dir when given"""
+    infusion_times, unparsed_infusion_times = cached_parse(
+        args.infusion_times, "infusion_times", read_infusion_times, n_frames=2
+    )
+    clean_infusion_times, removed_ids = drop_patients_with_duplicate_treatments(
+        infusion_times
+    )
+    if len(removed_ids) != 0:
+        logger.warning(
+            f"Patients have duplicate number treatments in infusion times "
+            f"and were removed: {removed_ids}"
+        )
+
+    if args.memory_budget_mb is not None:
+        path, unparsed_samples = stream_samples_to_treatment(
+            args.samples,
+            clean_infusion_times,
+            os.path.join(args.output_dir, "samples_with_treatment.parquet"),
+            args.memory_budget_mb,
+        )
+        # only the samples diagnostics read come back in memory
+        samples_with_treatment_no = read_samples_with_treatment(
+            path, read_codes(args.diagnostics)
+        )
+    else:
+        samples_df, unparsed_samples = cached_parse(
+            args.samples, "samples", read_samples, n_frames=2
+        )
+        samples_with_treatment_no = assign_samples_to_treatment(
+            samples_df, clean_infusion_times
+        )
+        if is_tracing_memory():
+            logger.info(
+                f"Samples in memory before typing: {memory_usage_mb(samples_with_treatment_no):.1f} MB"
+            )
+        samples_with_treatment_no = cast_to_schema(samples_with_treatment_no)
+    logger.info(
+        f"Samples in memory: {memory_usage_mb(samples_with_treatment_no):.1f} MB"
+    )
+    for df, file_name in [
+        (unparsed_samples, "samples"),
+        (unparsed_infusion_times, "infusion times"),
+    ]:
+        if len(df) != 0:
+            logger.warning(
+                f"{len(df)} rows of {file_name} have dates that could not be parsed"
+            )
+
+    samples = PCodePartition(samples_with_treatment_no)
+    if args.treatments:
+        samples = samples.filter(
+            samples_with_treatment_no[INFUSION_NO].isin(args.treatments)
+        )
+
+    store, dataset = None, ""
+    if args.results_db is not None:
+        store = ResultStore(args.results_db)
+        dataset = results_key(
+            content_key("samples_with_treatment", args.samples, args.infusion_times),
+            args.treatments or (),
+            streamed=args.memory_budget_mb is not None,
+        )
+    diagnostics = run_phenotyping(
+        samples,
+        args.diagnostics,
+        params,
+        parallel=PARALLEL and not args.serial,
+        store=store,
+        dataset=dataset,
+    )
+
+    if args.state_dir is not None:
+        PhenotypingState(
+            samples_with_treatment_no,
+            clean_infusion_times,
+            {type(d).__name__: d.data for d in diagnostics},
+            settings(args.diagnostics, params, args.treatments or ()),
+        ).write(args.state_dir)
+    return diagnostics
+
+
+def append_delta(
+    args: argparse.Namespace, params: Dict[str, Dict[str, Any]]
+) -> List[DiagnoseTypes]:
+    """Diagnostics of --state-dir updated with the delta exports, with the settings of the state"""
+    state = PhenotypingState.read(args.state_dir)
+    if settings(args.diagnostics, params, args.treatments or ()) != state.settings:
+        raise ValueError(
+            f"{args.state_dir} was computed with other diagnostics, parameters or treatments, "
+            f"run without --append to compute it again"
+        )
+    delta_samples, unparsed_samples = cached_parse(
+        args.samples, "samples", read_samples, n_frames=2
+    )
+    delta_infusion_times = None
+    if args.infusion_times is not None:
+        delta_infusion_times, _ = cached_parse(
+            args.infusion_times, "infusion_times", read_infusion_times, n_frames=2
+        )
+    if len(unparsed_samples) != 0:
+        logger.warning(
+            f"{len(unparsed_samples)} rows of samples have dates that could not be parsed"
+        )
+
+    state, affected = apply_delta(
+        state,
+        delta_samples,
+        delta_infusion_times,
+        parallel=PARALLEL and not args.serial,
+    )
+    logger.info(
+        f"{len(affected)} patients with new samples or infusions processed again"
+    )
+    state.write(args.state_dir)
+    return state.diagnostics()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    if args.print_params:
+        print(json.dumps(default_params(), indent=2))
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    start_run()
+    params = {}
+    if args.params is not None:
+        with open(args.params) as f:
+            params = json.load(f)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.append:
+        diagnostics = append_delta(args, params)
+    else:
+        diagnostics = run_on_exports(args, params)
+
+    phenotype_matrix = PhenotypeMatrix(diagnostics)
+    phenotype = phenotype_matrix.phenotype()
+    export_to_file(
+        iter_chunks(phenotype),
+        os.path.join(args.output_dir, f"phenotype.{args.format}"),
+        args.format,
+    )
+    for i, diagnostic in enumerate(diagnostics):
+        export_to_file(
+            iter_chunks(diagnostic.data),
+            os.path.join(
+                args.output_dir,
+                f"detections_{type(diagnostic).__name__}.{args.format}",
+            ),
+            args.format,
+        )
+        logger.info(
+            f"{diagnostic.name}: {len(phenotype_matrix.detected_ids(i))} positive patients"
+        )
+    logger.info(
+        f"{int(phenotype['PHONOTYPE'].sum())} of {len(phenotype)} patients with positive phenotype"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@ PATIENT_ID = "NOPHO_NR"
 VALUE = "INTERNAL_REPLY_NUM"
 REF_PATIENT = "REFTEXT"
 
+SAMPLE_TIME_FORMAT = "%d/%m/%Y %H.%M"
+
 ########################################################################
 # Infusion times file
 ########################################################################
@@ -27,3 +29,18 @@ MP6_STOP = "MP6_POST_STOP"
 ########################################################################
 DETECTION = "detection"
 DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE = "HOUR_DIFF_SAMPLE_INF"
+ANCHOR = "anchor"
+
+########################################################################
+# Types of samples with treatment, applied once at ingest
+########################################################################
+SAMPLES_SCHEMA = {
+    PATIENT_ID: "int32",
+    P_CODE: "category",
+    REF_PATIENT: "category",
+    VALUE: "float32",
+    INFUSION_NO: "Int8",
+    DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE: "Int32",
+    SEX: "Int8",
+    MP6_STOP: "float32",
+}
@@ -1,130 +1,188 @@
 import base64
 from datetime import datetime
 from io import StringIO
+from typing import Optional, Set, Tuple
 
 import pandas as pd
 import streamlit as st
 
+from src.cache import cached_parse
 from src.constants import *
+from src.instrumentation import instrumented
+from src.instrumentation import is_tracing_memory
+from src.instrumentation import record_cache_miss
+from src.processing import assign_infusions
 
 
+@instrumented("load_samples")
+def load_samples(xlsx_file_buffer: StringIO) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Load file with blood samples, parsed once per file content thanks to the disk cache.
+    Not cached in memory, the app holds samples with treatment once for all sessions in SHARED_DATASETS.
+    """
+    return cached_parse(xlsx_file_buffer, "samples", read_samples, n_frames=2)
+
+
+@instrumented("load_infusion_times", cached=True)
 @st.cache
-def load_samples(xlsx_file_buffer: StringIO) -> pd.DataFrame:
-    """Load file with blood samples"""
+def load_infusion_times(
+    xlsx_file_buffer: StringIO,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Load file with infusion times, parsed once per file content thanks to the disk cache"""
+    record_cache_miss()
+    return cached_parse(
+        xlsx_file_buffer, "infusion_times", read_infusion_times, n_frames=2
+    )
 
-    def date_parser(d):
-        return datetime.strptime(d, "%d/%m/%Y %H.%M")
 
-    df = pd.read_excel(
-        xlsx_file_buffer,
-        parse_dates=[SAMPLE_TIME],
-        date_parser=date_parser,
+def parse_timestamps(raw: pd.Series, fmt: str) -> pd.Series:
+    """Parse a column of timestamps in bulk with a fixed format, unparsable values become NaT.
+
+    Cells already stored as dates by Excel are kept as is.
+    """
+    if pd.api.types.is_datetime64_any_dtype(raw):
+        return raw
+    parsed = pd.to_datetime(raw.astype(str), format=fmt, errors="coerce")
+
+    # only the few failed cells are inspected one by one
+    failed = parsed.isnull() & raw.notnull()
+    if failed.any():
+        is_date = raw[failed].map(lambda v: isinstance(v, datetime))
+        parsed[is_date[is_date].index] = pd.to_datetime(raw[is_date[is_date].index])
+    return parsed
+
+
+def is_csv(file_source) -> bool:
+    """Whether a path or an uploaded file is a CSV export, otherwise it is read as xlsx"""
+    name = (
+        file_source
+        if isinstance(file_source, str)
+        else getattr(file_source, "name", "")
     )
-    df = df.dropna(subset=[PATIENT_ID])
-    df[PATIENT_ID] = df[PATIENT_ID].astype(int)
-    df = df.drop(columns=["Unnamed: 0"])
-    return df
+    return str(name).lower().endswith(".csv")
 
 
-@st.cache
-def load_infusion_times(xlsx_file_buffer: StringIO) -> pd.DataFrame:
-    """Load file with infusion times"""
+def read_samples(xlsx_file_buffer: StringIO) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Parse file with blood samples, xlsx or CSV
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame]
+        Samples, and the rows whose SAMPLE_TIME could not be parsed, left out of the samples
+    """
+    if is_csv(xlsx_file_buffer):
+        df = pd.read_csv(xlsx_file_buffer, dtype={SAMPLE_TIME: object})
+    else:
+        df = pd.read_excel(xlsx_file_buffer, dtype={SAMPLE_TIME: object})
+    return clean_samples(df)
+
+
+def clean_samples(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Drop samples without patient and parse SAMPLE_TIME, of a whole file or of a chunk of it
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame]
+        Samples, and the rows whose SAMPLE_TIME could not be parsed, left out of the samples
+    """
+    df = df.dropna(subset=[PATIENT_ID])
+    df[PATIENT_ID] = df[PATIENT_ID].astype(int)
+    # index column written by pandas in the xlsx exports
+    df = df.drop(columns=["Unnamed: 0"], errors="ignore")
+
+    sample_time = parse_timestamps(df[SAMPLE_TIME], SAMPLE_TIME_FORMAT)
+    unparsed = sample_time.isnull()
+    rejected = df[unparsed].astype({SAMPLE_TIME: str})
+    df = df[~unparsed].assign(**{SAMPLE_TIME: sample_time[~unparsed]})
+    return df, rejected
+
+
+def read_infusion_times(
+    xlsx_file_buffer: StringIO,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Parse file with infusion times
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame]
+        Infusion times, and the rows whose start date or hour could not be parsed.
+        Those rows are kept in infusion times with a missing INF_STARTDATE.
+    """
     mtx_infusion_time = pd.read_excel(
         xlsx_file_buffer,
         usecols=[PATIENT_ID, INFUSION_NO, SEX, MP6_STOP, INF_STARTDATE, INF_STARTHOUR],
     )
-    # Cheat: we extract the hour from INF_STARTHOUR
-    # and inject this hour into INF_STARTDATE which has an hour of 00:00:00
-    mtx_infusion_time[INF_STARTDATE] = (
-        mtx_infusion_time[INF_STARTDATE].dt.strftime("%d-%m-%Y")
-        + " "
-        + mtx_infusion_time[INF_STARTHOUR]
+    # INF_STARTDATE has an hour of 00:00:00, the hour of infusion is in INF_STARTHOUR
+    start_date = pd.to_datetime(
+        mtx_infusion_time[INF_STARTDATE], errors="coerce"
+    ).dt.normalize()
+    start_hour = pd.to_timedelta(
+        mtx_infusion_time[INF_STARTHOUR].astype(str), errors="coerce"
     )
-    mtx_infusion_time[INF_STARTDATE] = pd.to_datetime(
-        mtx_infusion_time[INF_STARTDATE], format="%d-%m-%Y %H:%M:%S"
+    unparsed = start_date.isnull() | start_hour.isnull()
+    rejected = mtx_infusion_time[unparsed].astype(
+        {INF_STARTDATE: str, INF_STARTHOUR: str}
     )
+
+    mtx_infusion_time[INF_STARTDATE] = start_date + start_hour
     mtx_infusion_time = mtx_infusion_time.drop([INF_STARTHOUR], axis=1)
     mtx_infusion_time[PATIENT_ID] = mtx_infusion_time[PATIENT_ID].astype(int)
     mtx_infusion_time[INFUSION_NO] = mtx_infusion_time[INFUSION_NO].astype(str)
 
-    return mtx_infusion_time
+    return mtx_infusion_time, rejected
 
 
+def drop_patients_with_duplicate_treatments(
+    infusion_times: pd.DataFrame,
+) -> Tuple[pd.DataFrame, Set[int]]:
+    """Some patients have repeated INFNO treatment numbers, let's remove those patients for now
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, Set[int]]
+        Infusion times without those patients, and their ids
+    """
+    duplicated = infusion_times.duplicated([PATIENT_ID, INFUSION_NO], keep=False)
+    ids_with_duplicate_treatments = set(infusion_times.loc[duplicated, PATIENT_ID])
+    return (
+        infusion_times[~infusion_times[PATIENT_ID].isin(ids_with_duplicate_treatments)],
+        ids_with_duplicate_treatments,
+    )
+
+
+@instrumented("remove_patients_with_duplicate_treatments", cached=True)
 @st.cache(suppress_st_warning=True)
 def remove_patients_with_duplicate_treatments(
     infusion_times: pd.DataFrame,
 ) -> pd.DataFrame:
-    """Some patients have repeated INFNO treatment numbers, let's remove those patients for now"""
-    df = infusion_times.copy()
-    count_treatment_per_id = (
-        df[PATIENT_ID].astype(str) + "_" + df[INFUSION_NO]
-    ).value_counts()
-    ids_with_duplicate_treatments = {
-        s.split("_")[0]
-        for s in count_treatment_per_id[count_treatment_per_id > 1].index.values
-    }
+    """Same as drop_patients_with_duplicate_treatments, removed patients are shown in a warning"""
+    record_cache_miss()
+    df, ids_with_duplicate_treatments = drop_patients_with_duplicate_treatments(
+        infusion_times
+    )
     if len(ids_with_duplicate_treatments) != 0:
         st.warning(
             f"Patients have duplicate number treatments in infusion times "
             f"and were removed: {ids_with_duplicate_treatments}"
         )
-    return df[~df[PATIENT_ID].isin(ids_with_duplicate_treatments)]
+    return df
 
 
-@st.cache
-def merge_samples_to_treatment(samples_df, infusion_times_df):
+def assign_samples_to_treatment(
+    samples_df: pd.DataFrame, infusion_times_df: pd.DataFrame
+) -> pd.DataFrame:
+    """Add INFUSION_NO, INF_STARTDATE, HOUR_DIFF, SEX and MP6_STOP of the treatment of each sample"""
+    duplicated = infusion_times_df.duplicated([PATIENT_ID, INFUSION_NO])
+    if duplicated.any():
+        raise ValueError(
+            f"Patients {sorted(set(infusion_times_df.loc[duplicated, PATIENT_ID]))} have duplicate "
+            f"treatments in infusion times, drop them with drop_patients_with_duplicate_treatments"
+        )
     # Now that infusion times have no duplicates
-    # We can pivot the infusion times dataset to make it easier to join to samples
-    # Numeric columns are now INFNO: number of treatment
-    pivot_infusion_times = infusion_times_df.pivot(
-        index=PATIENT_ID, columns=INFUSION_NO, values=INF_STARTDATE
-    ).reset_index()
-
-    samples_with_infusion_times = samples_df.merge(
-        pivot_infusion_times, on=PATIENT_ID, how="left", indicator=True
-    )
-    samples_with_infusion_times["_merge"] = samples_with_infusion_times[
-        "_merge"
-    ].astype(str)
-
-    def date_to_treatment_no(s: pd.Series):
-        if s["_merge"] == "left_only":
-            return [None, None, None]
-        elif not pd.isnull(s["8"]) and s[SAMPLE_TIME] >= s["8"]:
-            return [8, s["8"], s[SAMPLE_TIME] - s["8"]]
-        elif not pd.isnull(s["7"]) and s[SAMPLE_TIME] >= s["7"]:
-            return [7, s["7"], s[SAMPLE_TIME] - s["7"]]
-        elif not pd.isnull(s["6"]) and s[SAMPLE_TIME] >= s["6"]:
-            return [6, s["6"], s[SAMPLE_TIME] - s["6"]]
-        elif not pd.isnull(s["5"]) and s[SAMPLE_TIME] >= s["5"]:
-            return [5, s["5"], s[SAMPLE_TIME] - s["5"]]
-        elif not pd.isnull(s["4"]) and s[SAMPLE_TIME] >= s["4"]:
-            return [4, s["4"], s[SAMPLE_TIME] - s["4"]]
-        elif not pd.isnull(s["3"]) and s[SAMPLE_TIME] >= s["3"]:
-            return [3, s["3"], s[SAMPLE_TIME] - s["3"]]
-        elif not pd.isnull(s["2"]) and s[SAMPLE_TIME] >= s["2"]:
-            return [2, s["2"], s[SAMPLE_TIME] - s["2"]]
-        elif not pd.isnull(s["1"]) and s[SAMPLE_TIME] >= s["1"]:
-            return [1, s["1"], s[SAMPLE_TIME] - s["1"]]
-        elif not pd.isnull(s["1"]) and s[SAMPLE_TIME] < s["1"]:
-            return [0, s["1"], s[SAMPLE_TIME] - s["1"]]
-        else:
-            return [None, None, None]
-
-    # TODO: this apply method is probably the slowest of the app, can we vectorize this ?
-    samples_with_infusion_times[
-        [INFUSION_NO, INF_STARTDATE, DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE]
-    ] = samples_with_infusion_times.apply(
-        date_to_treatment_no, axis=1, result_type="expand"
-    )
-    samples_with_infusion_times[
-        DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE
-    ] = samples_with_infusion_times[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE].astype(
-        "timedelta64[h]"
+    # each sample is assigned the last infusion started before it, per patient
+    samples_with_infusion_times = samples_df.join(
+        assign_infusions(samples_df, infusion_times_df)
     )
 
-    samples_with_infusion_times = samples_with_infusion_times.drop(columns=["_merge"])
-
     # integrate MP6_stop and SEX separately so we can filter inaccurate data
     sex_per_patient = infusion_times_df.loc[
         infusion_times_df[SEX] != 0, [PATIENT_ID, SEX]
@@ -146,7 +204,33 @@ def merge_samples_to_treatment(samples_df, infusion_times_df):
     return samples_with_infusion_times
 
 
-def generate_download_link(df: pd.DataFrame) -> str:
-    csv_file = df.to_csv(index=False, sep=";")
-    b64 = base64.b64encode(csv_file.encode()).decode()
-    return f'<a href="data:file/csv;base64,{b64}">Download CSV File</a> (right-click and save as &lt;some_name&gt;.csv)'
+def cast_to_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """Cast columns of samples with treatment to the compact types of SAMPLES_SCHEMA"""
+    return df.astype({c: t for c, t in SAMPLES_SCHEMA.items() if c in df.columns})
+
+
+def memory_usage_mb(df: pd.DataFrame) -> float:
+    return df.memory_usage(deep=True).sum() / 1024 / 1024
+
+
+@instrumented("merge_samples_to_treatment")
+def merge_samples_to_treatment(
+    samples_df, infusion_times_df
+) -> Tuple[pd.DataFrame, Optional[float]]:
+    """Samples with their treatment in the types of SAMPLES_SCHEMA, and their memory in MB before typing.
+
+    The memory before typing scans every string, it is only measured while tracing memory, None otherwise.
+    """
+    samples_with_infusion_times = assign_samples_to_treatment(
+        samples_df, infusion_times_df
+    )
+    untyped_memory_mb = None
+    if is_tracing_memory():
+        untyped_memory_mb = memory_usage_mb(samples_with_infusion_times)
+    return cast_to_schema(samples_with_infusion_times), untyped_memory_mb
+
+
+def generate_download_link(data: bytes, file_name: str, mime: str) -> str:
+    """Link embedding data, for Streamlit versions without st.download_button"""
+    b64 = base64.b64encode(data).decode()
+    return f'<a href="data:{mime};base64,{b64}" download="{file_name}">Download {file_name}</a> (right-click and save as {file_name})'
@@ -3,13 +3,24 @@
 They expose Streamlit sliders to update their diagnostic detection
 """
 from abc import ABC, abstractmethod
-from typing import List, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
 from src.constants import *
-from src.processing import is_streak_longer_than_duration
+from src.instrumentation import instrumented
+from src.partition import PCodePartition
+from src.processing import count_above
+from src.processing import SegmentIndex
+from src.processing import StreakIndex
+from src.rules import AllOf
+from src.rules import AnyOf
+from src.rules import Compare
+from src.rules import compile_rule
+from src.rules import Param
+from src.rules import Rule
 
 
 class AbstractDiagnose(ABC):
@@ -17,20 +28,65 @@ class AbstractDiagnose(ABC):
     It's a component which links Streamlit sliders to it's data and diagnostic logic.
     """
 
+    # Parameters of the diagnostic logic, independent from Streamlit so they can be set in batch
+    PARAMS: List[Param] = []
+    # P_CODE read by the diagnostic, diagnostics reading the same codes share their sorted samples
+    CODES: List[str] = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # time and rows of every detection are recorded, whoever runs it
+        if "run_detection" in cls.__dict__:
+            cls.run_detection = instrumented(f"{cls.__name__}.run_detection")(
+                cls.run_detection
+            )
+
     def __init__(self):
         """For each diagnostic we'd like to only store the necessary subset of data."""
         self.data: pd.DataFrame = pd.DataFrame()
+        self.set_params()
+
+    def set_params(self, **params: Any) -> None:
+        """Set parameters by name, parameters not given take their default value"""
+        unknown = set(params) - {p.name for p in self.PARAMS}
+        if len(unknown) != 0:
+            raise ValueError(f"Unknown parameters for {self.name}: {sorted(unknown)}")
+        for param in self.PARAMS:
+            setattr(self, param.name, params.get(param.name, param.value))
+
+    def get_params(self) -> Dict[str, Any]:
+        return {param.name: getattr(self, param.name) for param in self.PARAMS}
 
-    @abstractmethod
     def update_params_in_sidebar(self) -> None:
         """This method displays/updates Streamlit sliders inside the Streamlit sidebar.
-        Those should be linked to the diagnostic processing logic
+        Those are linked to the diagnostic processing logic through set_params
         """
-        pass
+        self.set_params(**self.params_in_sidebar())
+
+    @classmethod
+    def params_in_sidebar(cls) -> Dict[str, Any]:
+        """Display Streamlit sliders of PARAMS inside the sidebar and return their values,
+        before the diagnostic is built
+        """
+        if len(cls.PARAMS) == 0:
+            return {}
+        st.sidebar.markdown(f"**Parameters for {cls.name}**")
+        return {
+            param.name: st.sidebar.slider(
+                param.label,
+                min_value=param.min_value,
+                max_value=param.max_value,
+                value=param.value,
+                step=param.step,
+                format=param.format,
+                key=param.key,
+            )
+            for param in cls.PARAMS
+        }
 
     @abstractmethod
     def run_detection(self) -> None:
-        """Compute detections given Streamlit slider params
+        """Compute detections given the diagnostic params
 
         This function is stateful and computes the DETECTION column to self.data.
         This column contains the diagnostic result as a boolean value.
@@ -52,69 +108,122 @@ class AbstractDiagnose(ABC):
         detected_positive_patient_ids = d.loc[d[DETECTION] == 1, PATIENT_ID].tolist()
         return detected_positive_patient_ids
 
+    def sweep(self, grid: Optional[Dict[str, Sequence[float]]] = None) -> pd.DataFrame:
+        """Number of positive patients for every combination of parameters, evaluated in one batch.
 
-class Diagnose1(AbstractDiagnose):
-    name: str = "Neutropenia (NPU02902) Neutrofilocytter"
+        Parameters
+        ----------
+        grid
+            Values to evaluate for each parameter, missing parameters use every step of their slider
 
-    def __init__(self, df: pd.DataFrame):
+        Returns
+        -------
+        pd.DataFrame
+            One column per parameter and a positive_patients column, one row per combination
+        """
+        grid = grid or {}
+        grid = {
+            param.name: np.asarray(grid.get(param.name, param.grid()))
+            for param in self.PARAMS
+        }
+        positive_patients = np.asarray(self._count_positive_patients(**grid)).ravel()
+        if len(grid) == 0:
+            return pd.DataFrame({"positive_patients": positive_patients})
+        index = pd.MultiIndex.from_product(list(grid.values()), names=list(grid))
+        return pd.DataFrame(
+            {"positive_patients": positive_patients}, index=index
+        ).reset_index()
+
+    def _count_positive_patients(self, **grid: np.ndarray) -> np.ndarray:
+        """Number of positive patients, with one axis per parameter of PARAMS.
+
+        Runs detection for each combination, diagnostics override it with a batch evaluation.
+        """
+        params, data = self.get_params(), self.data
+        counts = np.zeros(tuple(len(values) for values in grid.values()), dtype=int)
+        try:
+            for index in np.ndindex(*counts.shape):
+                self.set_params(**{name: grid[name][i] for name, i in zip(grid, index)})
+                self.run_detection()
+                if DETECTION in self.data.columns:
+                    counts[index] = len(self.get_detected_ids())
+        finally:
+            self.set_params(**params)
+            self.data = data
+        return counts
+
+
+class RuleDiagnose(AbstractDiagnose):
+    """Diagnostic declared by the Rule in RULE (see src.rules), its sliders are the parameters of the rule"""
+
+    RULE: Rule
+
+    def __init_subclass__(cls, **kwargs):
+        if "RULE" in cls.__dict__:
+            cls.name = cls.RULE.name
+            cls.PARAMS = list(cls.RULE.params)
+            cls.PLAN = compile_rule(cls.RULE)
+            cls.CODES = list(cls.PLAN.codes)
+            if "run_detection" not in cls.__dict__:
+                # recorded under the name of each diagnostic
+                cls.run_detection = cls._detect_rule
+        super().__init_subclass__(**kwargs)
+
+    def __init__(self, samples: PCodePartition):
         super().__init__()
-        self.data: pd.DataFrame = df.loc[
-            df[P_CODE] == "NPU02902",
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, SEX, MP6_STOP],
-        ]
-        self.param_concentration = st.empty
-        self.param_days = st.empty
-
-    def update_params_in_sidebar(self):
-        st.sidebar.markdown(f"**Parameters for {self.name}**")
-        self.param_concentration = st.sidebar.slider(
-            "Concentration NPU02902 < threshold",
-            min_value=0.0,
-            max_value=10.0,
-            value=0.5,
-            step=0.1,
-            format="%.1f x10^9 /L",
-            key="D1c",
-        )
-        self.param_days = st.sidebar.slider(
-            "> Number of days",
-            min_value=0,
-            max_value=30,
-            value=10,
-            step=1,
-            format="%d days",
-            key="D1d",
+        self.evaluator = self.PLAN.evaluator(samples)
+        self.data: pd.DataFrame = self.evaluator.data
+
+    def _detect_rule(self) -> None:
+        self.data = self.data.assign(
+            **{DETECTION: self.evaluator.detect(self.get_params())}
         )
 
-    def run_detection(self):
-        self.data[DETECTION] = self.data[VALUE] < self.param_concentration
-        self.data[DETECTION] = is_streak_longer_than_duration(
-            self.data, DETECTION, PATIENT_ID, SAMPLE_TIME, 24 * self.param_days
-        ).astype(bool)
+    def _count_positive_patients(self, **grid: np.ndarray) -> np.ndarray:
+        return self.evaluator.count_positive_patients(grid)
+
+
+class Diagnose1(RuleDiagnose):
+    RULE = Rule(
+        "Neutropenia (NPU02902) Neutrofilocytter",
+        Compare(
+            "NPU02902",
+            "<",
+            "param_concentration",
+            duration="param_days",
+            hours_per_unit=24,
+        ),
+        params=[
+            Param(
+                "param_concentration",
+                "Concentration NPU02902 < threshold",
+                min_value=0.0,
+                max_value=10.0,
+                value=0.5,
+                step=0.1,
+                format="%.1f x10^9 /L",
+                key="D1c",
+            ),
+            Param(
+                "param_days",
+                "> Number of days",
+                min_value=0,
+                max_value=30,
+                value=10,
+                step=1,
+                format="%d days",
+                key="D1d",
+            ),
+        ],
+    )
 
 
 class Diagnose2(AbstractDiagnose):
     name: str = "Severe infection (NPU19748)"
-
-    def __init__(self, df: pd.DataFrame):
-        super().__init__()
-        self.data: pd.DataFrame = df.loc[
-            df[P_CODE] == "NPU19748",
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, REF_PATIENT, INFUSION_NO, SEX, MP6_STOP],
-        ]
-        # clean REFTEXT which is mostly <8,0 to transform to 8.0
-        # TODO : not checking how clean is the data !
-        self.data[REF_PATIENT] = (
-            self.data[REF_PATIENT]
-            .apply(lambda n: n.replace("<", "").replace(",", "."))
-            .astype(float)
-        )
-        self.param_concentration = st.empty
-        self.param_days = st.empty
-
-    def update_params_in_sidebar(self):
-        st.sidebar.markdown(f"**Parameters for {self.name}**")
-        self.param_concentration = st.sidebar.slider(
+    CODES = ["NPU19748"]
+    PARAMS = [
+        Param(
+            "param_concentration",
             "Concentration NPU19748 > threshold",
             min_value=0,
             max_value=400,
@@ -122,8 +231,9 @@ class Diagnose2(AbstractDiagnose):
             step=10,
             format="%d mg/L",
             key="D2c",
-        )
-        self.param_days = st.sidebar.slider(
+        ),
+        Param(
+            "param_days",
             "Days",
             min_value=0,
             max_value=180,
@@ -131,37 +241,78 @@ class Diagnose2(AbstractDiagnose):
             step=1,
             format="%d days",
             key="D2d",
+        ),
+    ]
+
+    def __init__(self, samples: PCodePartition):
+        super().__init__()
+        self.data: pd.DataFrame = samples.get(
+            "NPU19748",
+            [
+                PATIENT_ID,
+                SAMPLE_TIME,
+                P_CODE,
+                VALUE,
+                REF_PATIENT,
+                INFUSION_NO,
+                SEX,
+                MP6_STOP,
+            ],
+        )
+        # clean REFTEXT which is mostly <8,0 to transform to 8.0
+        # TODO : not checking how clean is the data !
+        self.data[REF_PATIENT] = (
+            self.data[REF_PATIENT]
+            .apply(lambda n: n.replace("<", "").replace(",", "."))
+            .astype(float)
+        )
+        # CRP samples are sorted by patient and date once, for every diagnostic reading them
+        self.analyte = samples.analyte("NPU19748")
+        self.elevated_streaks: StreakIndex = samples.memoize(
+            ("streaks above REFTEXT", "NPU19748"),
+            lambda: StreakIndex.from_analyte(
+                self.analyte,
+                (self.data[VALUE] - self.data[REF_PATIENT]).to_numpy(),
+            ),
         )
 
     def run_detection(self) -> None:
         # CRP > threshold
-        detection1 = self.data[[PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE]].copy()
-        detection1[DETECTION] = self.data[VALUE] > self.param_concentration
+        above_concentration = self.data[VALUE] > self.param_concentration
 
-        # or CRP > reftext for consecutive days
+        # or CRP > reftext for consecutive days, VALUE - REFTEXT > 0 is VALUE > REFTEXT
         # TODO : check "elevated" same as > reftext
-        detection2 = self.data[
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, REF_PATIENT]
-        ].copy()
-        detection2[DETECTION] = detection2[VALUE] > detection2[REF_PATIENT]
-        detection2[DETECTION] = is_streak_longer_than_duration(
-            detection2, DETECTION, PATIENT_ID, SAMPLE_TIME, 24 * self.param_days
+        elevated_for_days = self.elevated_streaks.detect(
+            0, 24 * self.param_days, below=False
         )
 
-        self.data[DETECTION] = (detection1[DETECTION] | detection2[DETECTION]).astype(
-            bool
+        self.data[DETECTION] = (above_concentration | elevated_for_days).astype(bool)
+
+    def _count_positive_patients(self, param_concentration, param_days):
+        # CRP > REFTEXT streaks do not depend on the concentration threshold
+        longest_elevated_streak = self.elevated_streaks.longest_positive_streak(
+            0, below=False
         )
+        # one value per patient of self.elevated_streaks.patients
+        max_value = self.analyte.max_per_patient()
+        counts = []
+        for concentration in param_concentration:
+            above_concentration = max_value > concentration
+            counts.append(
+                above_concentration.sum()
+                + count_above(
+                    longest_elevated_streak[~above_concentration], 24 * param_days
+                )
+            )
+        return np.stack(counts)
 
 
 class Diagnose3(AbstractDiagnose):
     name: str = "Neutropenia with infection"
 
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, samples: PCodePartition):
         super().__init__()
-        self.data: pd.DataFrame = df
-
-    def update_params_in_sidebar(self):
-        pass
+        self.data: pd.DataFrame = samples.data
 
     def run_detection(self) -> None:
         pass
@@ -170,230 +321,251 @@ class Diagnose3(AbstractDiagnose):
         pass
 
 
-class Diagnose4(AbstractDiagnose):
-    name: str = "Severe hepatic effects elevated liver enzyme (NPU19651)"
-
-    def __init__(self, df: pd.DataFrame):
-        super().__init__()
-        self.data: pd.DataFrame = df.loc[
-            df[P_CODE].isin(["NPU19651", "NPU01684", "NPU01370"]),
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, SEX, MP6_STOP],
-        ]
-        self.param_concentration_liver = st.empty
-        self.param_concentration_koagulation = st.empty
-        self.param_concentration_bilirubin = st.empty
-
-    def update_params_in_sidebar(self):
-        st.sidebar.markdown(f"**Parameters for {self.name}**")
-        self.param_concentration_liver = st.sidebar.slider(
-            "Concentration NPU19651 > threshold",
-            min_value=0,
-            max_value=100,
-            value=45,
-            step=1,
-            format="%d U/I",
-            key="D4l",
-        )
-        self.param_concentration_koagulation = st.sidebar.slider(
-            "Ratio affected NPU01684 < threshold",
-            min_value=0.0,
-            max_value=1.0,
-            value=0.4,
-            step=0.11,
-            key="D4l",
-        )
-        self.param_concentration_bilirubin = st.sidebar.slider(
-            "Concentration NPU01370 > threshold",
-            min_value=0,
-            max_value=100,
-            value=40,
-            step=1,
-            format="%d μm",
-            key="D4l",
-        )
-
-    def run_detection(self) -> None:
-        # study NPU19651
-        detection1 = self.data.loc[
-            self.data[P_CODE] == "NPU19651",
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE],
-        ].copy()
-        detection1[DETECTION] = detection1[VALUE] > self.param_concentration_liver
-        detection1 = detection1[[PATIENT_ID, SAMPLE_TIME, DETECTION]]
-
-        # study NPU01684 or NPU01370
-        detection2 = self.data.loc[
-            self.data[P_CODE].isin(["NPU01684", "NPU01370"]),
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE],
-        ].copy()
-        detection2 = detection2.pivot_table(
-            index=[PATIENT_ID, SAMPLE_TIME], columns=P_CODE, values=VALUE
-        ).reset_index()
-        detection2[DETECTION] = (
-            detection2["NPU01684"] < self.param_concentration_koagulation
-        ) | (detection2["NPU01370"] > self.param_concentration_bilirubin)
-        detection2 = detection2[[PATIENT_ID, SAMPLE_TIME, DETECTION]]
-
-        # merge detections, positive if positive for both detection1 and detection2 at same date
-        detection = detection1.merge(
-            detection2, on=[PATIENT_ID, SAMPLE_TIME], how="outer"
+class Diagnose4(RuleDiagnose):
+    # positive if positive for both NPU19651 and NPU01684 or NPU01370 drawn within the tolerance
+    RULE = Rule(
+        "Severe hepatic effects elevated liver enzyme (NPU19651)",
+        AllOf(
+            [
+                Compare("NPU19651", ">", "param_concentration_liver"),
+                AnyOf(
+                    [
+                        Compare("NPU01684", "<", "param_concentration_koagulation"),
+                        Compare("NPU01370", ">", "param_concentration_bilirubin"),
+                    ]
+                ),
+            ]
+        ),
+        params=[
+            Param(
+                "param_concentration_liver",
+                "Concentration NPU19651 > threshold",
+                min_value=0,
+                max_value=100,
+                value=45,
+                step=1,
+                format="%d U/I",
+                key="D4l",
+            ),
+            Param(
+                "param_concentration_koagulation",
+                "Ratio affected NPU01684 < threshold",
+                min_value=0.0,
+                max_value=1.0,
+                value=0.4,
+                step=0.11,
+                key="D4k",
+            ),
+            Param(
+                "param_concentration_bilirubin",
+                "Concentration NPU01370 > threshold",
+                min_value=0,
+                max_value=100,
+                value=40,
+                step=1,
+                format="%d μm",
+                key="D4b",
+            ),
+            Param(
+                "param_tolerance_hours",
+                "Hours between paired samples <= tolerance",
+                min_value=0,
+                max_value=12,
+                value=0,
+                step=1,
+                format="%d h",
+                key="D4h",
+            ),
+        ],
+        window_hours="param_tolerance_hours",
+    )
+
+    def _count_positive_patients(
+        self,
+        param_concentration_liver,
+        param_concentration_koagulation,
+        param_concentration_bilirubin,
+        param_tolerance_hours,
+    ):
+        counts = np.zeros(
+            (
+                len(param_concentration_liver),
+                len(param_concentration_koagulation),
+                len(param_concentration_bilirubin),
+                len(param_tolerance_hours),
+            ),
+            dtype=int,
         )
-        detection[DETECTION] = detection[f"{DETECTION}_x"] & detection[f"{DETECTION}_y"]
-        detection = detection[[PATIENT_ID, SAMPLE_TIME, DETECTION]]
-
-        # merge back to data
-        self.data = self.data.merge(detection, on=[PATIENT_ID, SAMPLE_TIME], how="left")
-        self.data[DETECTION] = self.data[DETECTION].astype(bool)
+        for h, tolerance_hours in enumerate(param_tolerance_hours):
+            # one threshold at a time on the lowest and highest value per patient,
+            # instead of evaluating the rule for every combination
+            alignment = self.evaluator.alignment(tolerance_hours)
+            aligned = pd.DataFrame(
+                {
+                    PATIENT_ID: alignment.patients,
+                    "NPU19651": alignment.values("NPU19651"),
+                    "NPU01684": alignment.values("NPU01684"),
+                    "NPU01370": alignment.values("NPU01370"),
+                }
+            )
+            for i, liver in enumerate(param_concentration_liver):
+                per_patient = (
+                    aligned[aligned["NPU19651"] > liver]
+                    .groupby(PATIENT_ID)
+                    .agg(koagulation=("NPU01684", "min"), bilirubin=("NPU01370", "max"))
+                )
+                koagulation = per_patient["koagulation"].to_numpy()
+                bilirubin = per_patient["bilirubin"].to_numpy()
+                for j, threshold_koagulation in enumerate(
+                    param_concentration_koagulation
+                ):
+                    positive = koagulation < threshold_koagulation
+                    counts[i, j, :, h] = positive.sum() + count_above(
+                        bilirubin[~positive], param_concentration_bilirubin
+                    )
+        return counts
 
 
 class Diagnose5(AbstractDiagnose):
     name: str = "Post-treatment toxicity in high-risk ALL"
 
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, samples: PCodePartition):
         super().__init__()
-        self.data: pd.DataFrame = df
-
-    def update_params_in_sidebar(self):
-        pass
+        self.data: pd.DataFrame = samples.data
 
     def run_detection(self) -> None:
         pass
 
 
-class Diagnose6(AbstractDiagnose):
-    name: str = "Renal toxicity (NPU18016)"
-
-    def __init__(self, df: pd.DataFrame):
-        super().__init__()
-        self.data: pd.DataFrame = df.loc[
-            df[P_CODE] == "NPU18016",
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, SEX, MP6_STOP],
-        ]
-        self.param_concentration = st.empty
-
-    def update_params_in_sidebar(self):
-        st.sidebar.markdown(f"**Parameters for {self.name}**")
-        self.param_concentration = st.sidebar.slider(
-            "Concentration NPU18016 > threshold",
-            min_value=0,
-            max_value=1000,
-            value=150,
-            step=10,
-            format="%d μmol/L",
-            key="D6c",
-        )
-
-    def run_detection(self) -> None:
-        self.data[DETECTION] = (self.data[VALUE] > self.param_concentration).astype(
-            bool
-        )
+class Diagnose6(RuleDiagnose):
+    RULE = Rule(
+        "Renal toxicity (NPU18016)",
+        Compare("NPU18016", ">", "param_concentration"),
+        params=[
+            Param(
+                "param_concentration",
+                "Concentration NPU18016 > threshold",
+                min_value=0,
+                max_value=1000,
+                value=150,
+                step=10,
+                format="%d μmol/L",
+                key="D6c",
+            )
+        ],
+    )
 
 
 class Diagnose7(AbstractDiagnose):
     name: str = "Plasma albumin and creatinine"
 
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, samples: PCodePartition):
         super().__init__()
-        self.data: pd.DataFrame = df
-
-    def update_params_in_sidebar(self):
-        pass
+        self.data: pd.DataFrame = samples.data
 
     def run_detection(self) -> None:
         pass
 
 
-class Diagnose8(AbstractDiagnose):
-    name: str = "Thrombocytopenia (NPU03568)"
-
-    def __init__(self, df: pd.DataFrame):
-        super().__init__()
-        self.data: pd.DataFrame = df.loc[
-            df[P_CODE] == "NPU03568",
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, SEX, MP6_STOP],
-        ]
-        self.param_concentration = st.empty
-        self.param_hours = st.empty
-
-    def update_params_in_sidebar(self):
-        st.sidebar.markdown(f"**Parameters for {self.name}**")
-        self.param_concentration = st.sidebar.slider(
-            "Concentration NPU03568 < threshold",
-            min_value=0.0,
-            max_value=50.0,
-            value=10.0,
-            step=0.1,
-            format="%.1f x10^9 /L",
-            key="D8c",
-        )
-        self.param_hours = st.sidebar.slider(
-            "> Number of hours",
-            min_value=24,
-            max_value=24 * 5,
-            value=24 * 3,
-            step=1,
-            format="%d hours",
-            key="D8h",
-        )
-
-    def run_detection(self) -> None:
-        self.data[DETECTION] = self.data[VALUE] < self.param_concentration
-        self.data[DETECTION] = is_streak_longer_than_duration(
-            self.data, DETECTION, PATIENT_ID, SAMPLE_TIME, self.param_hours
-        ).astype(bool)
-
-
-class Diagnose9(AbstractDiagnose):
-    name: str = "Pankreatit"
-
-    def __init__(self, df: pd.DataFrame):
-        super().__init__()
-        self.data: pd.DataFrame = df.loc[
-            df[P_CODE].isin(["NPU19652", "NPU19653", "DNK05451", "NPU19748"]),
-            [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, SEX, MP6_STOP],
-        ].dropna(subset=[VALUE])
-
-        self.param_times = st.empty
-
-    def update_params_in_sidebar(self):
-        st.sidebar.markdown(f"**Parameters for {self.name}**")
-        self.param_times = st.sidebar.slider(
-            "Threshold times over normal value",
-            min_value=1.0,
-            max_value=6.0,
-            value=3.0,
-            step=0.2,
-            format="x%.1f",
-            key="D9t",
-        )
-
-    def run_detection(self) -> None:
-        detection = (
-            self.data.copy()
-            .pivot_table(index=[PATIENT_ID, SAMPLE_TIME], columns=P_CODE, values=VALUE)
-            .reset_index()
-        )
-
-        NPU19652_normal_limit = 120
-        NPU19653_normal_limit = 36
-        DNK05451_normal_limit = 190
-        NPU19748_normal_limit = 100
-
-        detection[DETECTION] = (
-            (detection["NPU19652"] > NPU19652_normal_limit * self.param_times)
-            | (detection["NPU19653"] > NPU19653_normal_limit * self.param_times)
-            | (detection["DNK05451"] > DNK05451_normal_limit * self.param_times)
-        ) & (detection["NPU19748"] > NPU19748_normal_limit)
+class Diagnose8(RuleDiagnose):
+    RULE = Rule(
+        "Thrombocytopenia (NPU03568)",
+        Compare("NPU03568", "<", "param_concentration", duration="param_hours"),
+        params=[
+            Param(
+                "param_concentration",
+                "Concentration NPU03568 < threshold",
+                min_value=0.0,
+                max_value=50.0,
+                value=10.0,
+                step=0.1,
+                format="%.1f x10^9 /L",
+                key="D8c",
+            ),
+            Param(
+                "param_hours",
+                "> Number of hours",
+                min_value=24,
+                max_value=24 * 5,
+                value=24 * 3,
+                step=1,
+                format="%d hours",
+                key="D8h",
+            ),
+        ],
+    )
+
+
+# normal limits of pancreatic enzymes, positive above a number of times the limit
+PANCREATIC_NORMAL_LIMITS: Dict[str, float] = {
+    "NPU19652": 120,
+    "NPU19653": 36,
+    "DNK05451": 190,
+}
+
+
+class Diagnose9(RuleDiagnose):
+    # a pancreatic enzyme over its limit along with NPU19748 (CRP) over 100
+    RULE = Rule(
+        "Pankreatit",
+        AllOf(
+            [
+                AnyOf(
+                    [
+                        Compare(code, ">", "param_times", scale=limit)
+                        for code, limit in PANCREATIC_NORMAL_LIMITS.items()
+                    ]
+                ),
+                Compare("NPU19748", ">", 100),
+            ]
+        ),
+        params=[
+            Param(
+                "param_times",
+                "Threshold times over normal value",
+                min_value=1.0,
+                max_value=6.0,
+                value=3.0,
+                step=0.2,
+                format="x%.1f",
+                key="D9t",
+            ),
+            Param(
+                "param_tolerance_hours",
+                "Hours between paired samples <= tolerance",
+                min_value=0,
+                max_value=12,
+                value=0,
+                step=1,
+                format="%d h",
+                key="D9h",
+            ),
+        ],
+        anchor="NPU19748",
+        window_hours="param_tolerance_hours",
+        dropna=True,
+    )
+
+
+class TreatmentCriteria(NamedTuple):
+    """Maximum per treatment (PATIENT_ID, INFUSION_NO) of the value each DME criteria compares to its threshold,
+    NaN when no sample of the treatment is concerned by the criteria
+    """
 
-        detection = detection[[PATIENT_ID, SAMPLE_TIME, DETECTION]]
-        self.data = self.data.merge(detection, on=[PATIENT_ID, SAMPLE_TIME], how="left")
-        self.data[DETECTION] = self.data[DETECTION].astype(bool)
+    segments: SegmentIndex
+    first_treatment_of_patient: np.ndarray
+    crea_increase: np.ndarray
+    crea_fold: np.ndarray
+    mtx_36h: np.ndarray
+    mtx_42h: np.ndarray
+    mtx_48h: np.ndarray
 
 
 class DME(AbstractDiagnose):
     name: str = "DME"
     CREA_code: str = "NPU18016"
     MTX_code: str = "NPU02739"
+    CODES = [CREA_code, MTX_code]
 
     THRESHOLD_CREA_INCREASE_FROM_PREV_SAMPLE = (
         0.3 * 88.42
@@ -402,14 +574,62 @@ class DME(AbstractDiagnose):
     THRESHOLD_MTX_36H = 20.0
     THRESHOLD_MTX_42H = 10.0
     THRESHOLD_MTX_48H = 5.0
+    PARAMS = [
+        Param(
+            "threshold_crea_previous_sample",
+            "Select threshold CREA increase compared to previous sample",
+            0.0,
+            5 * THRESHOLD_CREA_INCREASE_FROM_PREV_SAMPLE,
+            THRESHOLD_CREA_INCREASE_FROM_PREV_SAMPLE,
+        ),
+        Param(
+            "threshold_crea_above_baseline",
+            "Select threshold CREA increase fold above baseline",
+            0.0,
+            5 * THRESHOLD_CREA_INCREASE_ABOVE_BASELINE,
+            THRESHOLD_CREA_INCREASE_ABOVE_BASELINE,
+        ),
+        Param(
+            "threshold_mtx_36h",
+            "Select threshold MTX between 36h - 42h",
+            0.0,
+            5 * THRESHOLD_MTX_36H,
+            THRESHOLD_MTX_36H,
+        ),
+        Param(
+            "threshold_mtx_42h",
+            "Select threshold MTX between 42h - 48h",
+            0.0,
+            5 * THRESHOLD_MTX_42H,
+            THRESHOLD_MTX_42H,
+        ),
+        Param(
+            "threshold_mtx_48h",
+            "Select threshold MTX after 48h",
+            0.0,
+            5 * THRESHOLD_MTX_48H,
+            THRESHOLD_MTX_48H,
+        ),
+    ]
 
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, samples: PCodePartition):
         super().__init__()
+        # sorted samples and maxima of criteria per treatment do not depend on thresholds,
+        # they are computed once per partition and moving a slider only compares one value per treatment
+        self.data, self.treatments = samples.memoize(
+            "DME treatments", lambda: self._treatment_criteria(samples)
+        )
 
-        self.data: pd.DataFrame = (
-            df.loc[
-                (df[P_CODE].isin([self.CREA_code, self.MTX_code]))
-                & (df[INFUSION_NO].notnull()),
+    @classmethod
+    def _treatment_criteria(
+        cls, samples: PCodePartition
+    ) -> Tuple[pd.DataFrame, TreatmentCriteria]:
+        """Samples of patients with a baseline CREA, with their baseline and previous value,
+        and the maximum per treatment of the value each criteria compares to its threshold.
+        """
+        data = (
+            samples.get(
+                [cls.CREA_code, cls.MTX_code],
                 [
                     PATIENT_ID,
                     SAMPLE_TIME,
@@ -420,134 +640,134 @@ class DME(AbstractDiagnose):
                     SEX,
                     MP6_STOP,
                 ],
-            ]
-            .dropna(subset=[VALUE])
+            )
+            .dropna(subset=[VALUE, INFUSION_NO])
             .sort_values([PATIENT_ID, P_CODE, SAMPLE_TIME])
         )
-
-        self.threshold_crea_previous_sample = st.empty
-        self.threshold_crea_above_baseline = st.empty
-        self.threshold_mtx_36h = st.empty
-        self.threshold_mtx_42h = st.empty
-        self.threshold_mtx_48h = st.empty
-
-    def update_params_in_sidebar(self):
-        st.sidebar.markdown(f"**Parameters for {self.name}**")
-        self.threshold_crea_previous_sample = st.sidebar.slider(
-            "Select threshold CREA increase compared to previous sample",
-            0.0,
-            5 * self.THRESHOLD_CREA_INCREASE_FROM_PREV_SAMPLE,
-            self.THRESHOLD_CREA_INCREASE_FROM_PREV_SAMPLE,
+        patient = data[PATIENT_ID].to_numpy()
+        infusion = data[INFUSION_NO].to_numpy(dtype=int)
+        is_crea_code = (data[P_CODE] == cls.CREA_code).to_numpy()
+        hours = data[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE].to_numpy(
+            dtype=float, na_value=np.nan
         )
-        self.threshold_crea_above_baseline = st.sidebar.slider(
-            "Select threshold CREA increase fold above baseline",
-            0.0,
-            5 * self.THRESHOLD_CREA_INCREASE_ABOVE_BASELINE,
-            self.THRESHOLD_CREA_INCREASE_ABOVE_BASELINE,
+        values = data[VALUE].to_numpy()
+
+        # for baseline CREA, we take all samples before first infusion time, which is INFNO = 0
+        # then patients have multiple values so we take the closest to first infusion,
+        # the first one in time when several are as close
+        before_infusions = np.flatnonzero(is_crea_code & (infusion == 0))
+        per_patient = SegmentIndex(patient[before_infusions])
+        closest = hours[before_infusions] == per_patient.broadcast(
+            per_patient.max(hours[before_infusions])
         )
-        self.threshold_mtx_36h = st.sidebar.slider(
-            "Select threshold MTX between 36h - 42h",
-            0.0,
-            5 * self.THRESHOLD_MTX_36H,
-            self.THRESHOLD_MTX_36H,
+        _, first_closest = np.unique(
+            per_patient.segment_of_row[closest], return_index=True
         )
-        self.threshold_mtx_42h = st.sidebar.slider(
-            "Select threshold MTX between 42h - 48h",
-            0.0,
-            5 * self.THRESHOLD_MTX_42H,
-            self.THRESHOLD_MTX_42H,
+        baseline_rows = before_infusions[np.flatnonzero(closest)[first_closest]]
+
+        # patients without baseline CREA are left out
+        with_baseline = np.isin(patient, patient[baseline_rows])
+        baseline_crea = values[baseline_rows][
+            np.searchsorted(patient[baseline_rows], patient[with_baseline])
+        ]
+        data = data[with_baseline].reset_index(drop=True)
+        patient, infusion, values = (
+            patient[with_baseline],
+            infusion[with_baseline],
+            values[with_baseline],
         )
-        self.threshold_mtx_48h = st.sidebar.slider(
-            "Select threshold MTX after 48h",
-            0.0,
-            5 * self.THRESHOLD_MTX_48H,
-            self.THRESHOLD_MTX_48H,
+        is_crea_code, hours = is_crea_code[with_baseline], hours[with_baseline]
+
+        # For criteria one, previous sample of the same patient, treatment number and p_code
+        prev_value = SegmentIndex(patient, is_crea_code, infusion).previous(values)
+        data["baseline_crea"] = baseline_crea
+        data["prev_value"] = prev_value
+
+        is_crea = (infusion != 0) & is_crea_code
+        is_mtx = (infusion != 0) & ~is_crea_code
+        missing = np.array(np.nan, dtype=prev_value.dtype)
+        treatments = SegmentIndex(patient, infusion)
+        treatment_patients = treatments.first(patient)
+        return (
+            data,
+            TreatmentCriteria(
+                treatments,
+                np.flatnonzero(
+                    np.append(True, treatment_patients[1:] != treatment_patients[:-1])
+                ),
+                # Criteria 1 : Increase in plasma creatinine by > 0.3 compared to previous sample
+                treatments.max(np.where(is_crea, values - prev_value, missing)),
+                # Criteria 2 : Increase of 1.5 fold above baseline
+                treatments.max(np.where(is_crea, values / baseline_crea, missing)),
+                # Criteria 3 : between 36 and 42 hours > 20 µM
+                treatments.max(
+                    np.where(is_mtx & (hours >= 36) & (hours < 42), values, missing)
+                ),
+                # Criteria 4 : between 42 and 48 hours > 10 µM
+                treatments.max(
+                    np.where(is_mtx & (hours >= 42) & (hours < 48), values, missing)
+                ),
+                # Criteria 5 : longer than 48 hours > 3 µM
+                treatments.max(np.where(is_mtx & (hours > 48), values, missing)),
+            ),
         )
 
     def run_detection(self) -> None:
+        # TODO: Hmmm the intersection of critera 1-2 with criteria 3-4-5 is null, no luck for fact checking
 
-        # for baseline CREA, we take all samples before first infusion time, which is INFNO = 0
-        # then patients have multiple values so we take the closest to first infusion
-        # which is max value of difference time to infusion
-        baseline_crea = self.data.loc[
-            (self.data[P_CODE] == self.CREA_code) & (self.data[INFUSION_NO] == 0),
-            [PATIENT_ID, VALUE, DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE],
-        ]
-        baseline_crea = baseline_crea.loc[
-            baseline_crea.groupby(PATIENT_ID)[
-                DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE
-            ].idxmax(),
-            [PATIENT_ID, VALUE],
-        ].rename(columns={VALUE: "baseline_crea"})
-        self.data = self.data.merge(baseline_crea, on=PATIENT_ID)
-
-        # For criteria one, need to shift the data so previous sample is in current sample
-        # by patient, treatment number and p_code
-        self.data["prev_value"] = self.data.groupby([PATIENT_ID, INFUSION_NO, P_CODE])[
-            VALUE
-        ].shift()
-
-        # Criteria 1 : Increase in plasma creatinine by > 0.3 compared to previous sample
-        criteria_one = (
-            (self.data[INFUSION_NO] != 0)
-            & (self.data[P_CODE] == self.CREA_code)
-            & (self.data["prev_value"].notnull())
-            & (
-                self.data[VALUE] - self.data["prev_value"]
-                > self.threshold_crea_previous_sample
-            )
+        # a treatment is positive for a criteria when one of its samples is
+        treatments = self.treatments
+        crea_criteria = (
+            treatments.crea_increase > self.threshold_crea_previous_sample
+        ) | (treatments.crea_fold > self.threshold_crea_above_baseline)
+        mtx_criteria = (
+            (treatments.mtx_36h > self.threshold_mtx_36h)
+            | (treatments.mtx_42h > self.threshold_mtx_42h)
+            | (treatments.mtx_48h > self.threshold_mtx_48h)
         )
-
-        # Criteria 2 : Increase of 1.5 fold above baseline
-        criteria_two = (
-            (self.data[INFUSION_NO] != 0)
-            & (self.data[P_CODE] == self.CREA_code)
-            & (
-                self.data[VALUE] / self.data["baseline_crea"]
-                > self.threshold_crea_above_baseline
-            )
+        self.data = self.data.assign(
+            **{DETECTION: treatments.segments.broadcast(crea_criteria & mtx_criteria)}
         )
 
-        # Criteria 3 : between 36 and 42 hours > 20 µM
-        criteria_three = (
-            (self.data[INFUSION_NO] != 0)
-            & (self.data[P_CODE] == self.MTX_code)
-            & (self.data[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE] >= 36)
-            & (self.data[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE] < 42)
-            & (self.data[VALUE] > self.threshold_mtx_36h)
+    def _count_positive_patients(
+        self,
+        threshold_crea_previous_sample,
+        threshold_crea_above_baseline,
+        threshold_mtx_36h,
+        threshold_mtx_42h,
+        threshold_mtx_48h,
+    ):
+        treatments = self.treatments
+
+        def above(values, thresholds):
+            thresholds = thresholds.astype(np.result_type(values.dtype, np.float32))
+            return values[:, None] > thresholds[None, :]
+
+        crea_criteria = (
+            above(treatments.crea_increase, threshold_crea_previous_sample)[:, :, None]
+            | above(treatments.crea_fold, threshold_crea_above_baseline)[:, None, :]
         )
-
-        # Criteria 4 : between 42 and 48 hours > 10 µM
-        criteria_four = (
-            (self.data[INFUSION_NO] != 0)
-            & (self.data[P_CODE] == self.MTX_code)
-            & (self.data[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE] >= 42)
-            & (self.data[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE] < 48)
-            & (self.data[VALUE] > self.threshold_mtx_42h)
-        )
-
-        # Criteria 5 : longer than 48 hours > 3 µM
-        criteria_five = (
-            (self.data[INFUSION_NO] != 0)
-            & (self.data[P_CODE] == self.MTX_code)
-            & (self.data[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE] > 48)
-            & (self.data[VALUE] > self.threshold_mtx_48h)
+        mtx_criteria = (
+            above(treatments.mtx_36h, threshold_mtx_36h)[:, :, None, None]
+            | above(treatments.mtx_42h, threshold_mtx_42h)[:, None, :, None]
+            | above(treatments.mtx_48h, threshold_mtx_48h)[:, None, None, :]
         )
-
-        # TODO: Hmmm the intersection of critera 1-2 with criteria 3-4-5 is null, no luck for fact checking
-        # st.write((criteria_one | criteria_two).value_counts())
-        # st.write((criteria_three | criteria_four | criteria_five).value_counts())
-        # st.write(((criteria_one | criteria_two) & (criteria_three | criteria_four | criteria_five)).value_counts())
-
-        # to do the intersection we need to merge both criterias for treatment number
-        sample_with_positive_criteria = self.data[[PATIENT_ID, INFUSION_NO]]
-        sample_with_positive_criteria["crea_criteria"] = (criteria_one | criteria_two)
-        sample_with_positive_criteria["mtx_criteria"] = (criteria_three | criteria_four | criteria_five)
-        treatment_with_positive_critera = sample_with_positive_criteria.groupby([PATIENT_ID, INFUSION_NO]).max().reset_index()
-        treatment_with_positive_critera[DETECTION] = treatment_with_positive_critera["crea_criteria"] & treatment_with_positive_critera["mtx_criteria"]
-        treatment_with_positive_critera = treatment_with_positive_critera.drop(["crea_criteria", "mtx_criteria"], axis=1)
-        self.data = self.data.merge(treatment_with_positive_critera, on=[PATIENT_ID, INFUSION_NO], how="left")
-        self.data[DETECTION] = self.data[DETECTION].astype(bool)
+        shape = crea_criteria.shape[1:] + mtx_criteria.shape[1:]
+        if len(treatments.segments) == 0:
+            return np.zeros(shape, dtype=int)
+
+        # one CREA threshold at a time to bound memory to treatments x rest of the grid
+        counts = np.zeros(shape, dtype=int)
+        for i in range(shape[0]):
+            positive_treatment = (
+                crea_criteria[:, i, :, None, None, None]
+                & mtx_criteria[:, None, :, :, :]
+            )
+            positive_patient = np.logical_or.reduceat(
+                positive_treatment, treatments.first_treatment_of_patient, axis=0
+            )
+            counts[i] = positive_patient.sum(axis=0)
+        return counts
 
 
 # choose classes to expose to main app
@@ -563,3 +783,4 @@ DiagnosticClasses = [
 DiagnoseTypes = Union[
     Diagnose1, Diagnose2, Diagnose4, Diagnose6, Diagnose8, Diagnose9, DME
 ]
+DIAGNOSTICS_BY_NAME = {cls.__name__: cls for cls in DiagnosticClasses}
@@ -0,0 +1,120 @@
+"""Export results in chunks, as CSV, gzip-compressed CSV or Parquet.
+
+Exports are generators of bytes built from an iterator of dataframes, so the per-sample detail
+of all diagnostics is never held in memory as one table nor as one uncompressed file.
+
+    with open("detections.csv.gz", "wb") as f:
+        for block in export_chunks(detection_detail(diagnostics), "csv.gz"):
+            f.write(block)
+"""
+import zlib
+from typing import Iterable, Iterator, List, Sequence
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.constants import *
+from src.diagnostics import DiagnoseTypes
+
+FORMATS = ["csv", "csv.gz", "parquet"]
+MIME_TYPES = {
+    "csv": "text/csv",
+    "csv.gz": "application/gzip",
+    "parquet": "application/octet-stream",
+}
+CHUNK_ROWS = 100_000
+CSV_SEPARATOR = ";"
+
+# columns of the per-sample detail, common to all diagnostics
+DETAIL_COLUMNS = [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, DETECTION]
+
+
+def iter_chunks(
+    df: pd.DataFrame, chunk_rows: int = CHUNK_ROWS
+) -> Iterator[pd.DataFrame]:
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start : start + chunk_rows]
+
+
+def detection_detail(
+    diagnostics: Sequence[DiagnoseTypes], chunk_rows: int = CHUNK_ROWS
+) -> Iterator[pd.DataFrame]:
+    """Detection of each sample of each diagnostic, chunk by chunk, with the name of the diagnostic"""
+    for diagnostic in diagnostics:
+        for chunk in iter_chunks(diagnostic.data, chunk_rows):
+            detail = chunk.reindex(columns=DETAIL_COLUMNS)
+            detail.insert(0, "diagnostic", diagnostic.name)
+            yield detail
+
+
+def _csv_chunks(frames: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    header = True
+    for frame in frames:
+        yield frame.to_csv(index=False, header=header, sep=CSV_SEPARATOR).encode()
+        header = False
+
+
+def _gzip_chunks(blocks: Iterable[bytes]) -> Iterator[bytes]:
+    # wbits=31 writes a gzip header, the output can be opened as a .gz file
+    compressor = zlib.compressobj(wbits=31)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class _BlockSink:
+    """Writable file collecting bytes written by Parquet until they are yielded"""
+
+    def __init__(self):
+        self.blocks: List[bytes] = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.blocks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.blocks)
+        self.blocks = []
+        return data
+
+
+def _parquet_chunks(frames: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    """One row group per dataframe, bytes are yielded once their row group is written"""
+    sink = _BlockSink()
+    writer = None
+    for frame in frames:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+    yield sink.drain()
+
+
+def export_chunks(frames: Iterable[pd.DataFrame], fmt: str) -> Iterator[bytes]:
+    """Bytes of the file with the rows of frames in format fmt, one of FORMATS"""
+    if fmt == "csv":
+        return _csv_chunks(frames)
+    if fmt == "csv.gz":
+        return _gzip_chunks(_csv_chunks(frames))
+    if fmt == "parquet":
+        return _parquet_chunks(frames)
+    raise ValueError(f"Unknown export format {fmt}, choose among {FORMATS}")
+
+
+def export_to_file(frames: Iterable[pd.DataFrame], path: str, fmt: str) -> None:
+    with open(path, "wb") as f:
+        for block in export_chunks(frames, fmt):
+            f.write(block)
@@ -0,0 +1,231 @@
+"""Update the results of a previous run with a delta export, reprocessing only the patients it changes.
+
+The state of a run is kept in a folder of Parquet files: samples with their treatment, infusion times,
+the data with detections of each diagnostic, and the settings it ran with. A delta samples file, and
+optionally a delta infusion times file, may repeat rows of the previous exports: only new samples,
+and infusions new or changed for a patient and INFUSION_NO, make a patient affected. A sample with
+another value for the same patient, time and P_CODE corrects the previous one and replaces it. Samples of affected
+patients are assigned to their treatment again and go through the diagnostics, their rows replace theirs
+in the state. Every diagnostic detects samples from the samples of the same patient, so the other rows
+are the same as a full run would compute.
+
+    state = PhenotypingState.read("state/")
+    state, affected = apply_delta(state, delta_samples, delta_infusion_times)
+    state.write("state/")
+"""
+import json
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.dataset import assign_samples_to_treatment
+from src.dataset import cast_to_schema
+from src.dataset import drop_patients_with_duplicate_treatments
+from src.diagnostics import DIAGNOSTICS_BY_NAME
+from src.diagnostics import DiagnoseTypes
+from src.partition import PCodePartition
+from src.runner import PARALLEL
+from src.runner import run_detections
+
+# a sample of a delta export with the same values is the same sample
+SAMPLE_KEY = [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE]
+# with the same values of these only, it is a correction of the previous sample
+SAMPLE_ID = [PATIENT_ID, SAMPLE_TIME, P_CODE]
+INFUSION_KEY = [PATIENT_ID, INFUSION_NO]
+# columns added to samples by assign_samples_to_treatment
+TREATMENT_COLUMNS = [
+    INFUSION_NO,
+    INF_STARTDATE,
+    DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE,
+    SEX,
+    MP6_STOP,
+]
+
+
+def settings(
+    diagnostic_names: Sequence[str],
+    params: Optional[Dict[str, Dict[str, Any]]] = None,
+    treatments: Sequence[int] = (),
+) -> Dict[str, Any]:
+    """Every parameter of the diagnostics run, default values included, and the treatments they ran on"""
+    params = params or {}
+    resolved = {}
+    for name in diagnostic_names:
+        values = {p.name: p.value for p in DIAGNOSTICS_BY_NAME[name].PARAMS}
+        values.update(params.get(name, {}))
+        resolved[name] = {k: float(v) for k, v in values.items()}
+    return {"params": resolved, "treatments": sorted(int(t) for t in treatments)}
+
+
+class PhenotypingState(NamedTuple):
+    """Results of a run, updated by apply_delta"""
+
+    samples: pd.DataFrame
+    infusion_times: pd.DataFrame
+    # data with DETECTION of each diagnostic, by class name
+    detections: Dict[str, pd.DataFrame]
+    settings: Dict[str, Any]
+
+    @classmethod
+    def read(cls, folder: str) -> "PhenotypingState":
+        with open(os.path.join(folder, "settings.json")) as f:
+            state_settings = json.load(f)
+        return cls(
+            pd.read_parquet(os.path.join(folder, "samples_with_treatment.parquet")),
+            pd.read_parquet(os.path.join(folder, "infusion_times.parquet")),
+            {
+                name: pd.read_parquet(
+                    os.path.join(folder, f"detections_{name}.parquet")
+                )
+                for name in state_settings["params"]
+            },
+            state_settings,
+        )
+
+    def write(self, folder: str) -> None:
+        """Write the state to folder, settings last so an interrupted write is not read back as complete"""
+        os.makedirs(folder, exist_ok=True)
+        settings_path = os.path.join(folder, "settings.json")
+        if os.path.exists(settings_path):
+            os.remove(settings_path)
+        frames = [
+            (self.samples, "samples_with_treatment"),
+            (self.infusion_times, "infusion_times"),
+        ] + [(data, f"detections_{name}") for name, data in self.detections.items()]
+        for df, name in frames:
+            path = os.path.join(folder, f"{name}.parquet")
+            df.reset_index(drop=True).to_parquet(f"{path}.tmp", index=False)
+            os.replace(f"{path}.tmp", path)
+        with open(settings_path, "w") as f:
+            json.dump(self.settings, f, indent=2)
+
+    def diagnostics(self) -> List[DiagnoseTypes]:
+        """Diagnostics with the detections of the state, for PhenotypeMatrix and exports"""
+        diagnostics = []
+        empty = PCodePartition(self.samples.iloc[:0])
+        for name, data in self.detections.items():
+            diagnostic = DIAGNOSTICS_BY_NAME[name](empty)
+            diagnostic.set_params(**self.settings["params"][name])
+            diagnostic.data = data
+            diagnostics.append(diagnostic)
+        return diagnostics
+
+
+def _not_in(df: pd.DataFrame, other: pd.DataFrame, on: List[str]) -> np.ndarray:
+    """Mask of the rows of df without a row of other with the same values of on"""
+    keys = other[on].drop_duplicates()
+    merged = df[on].merge(keys, on=on, how="left", indicator=True)
+    return (merged["_merge"] == "left_only").to_numpy()
+
+
+def update_infusion_times(
+    previous: pd.DataFrame, delta: pd.DataFrame
+) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Infusion times with the rows of delta replacing those of the same patient and INFUSION_NO
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, np.ndarray]
+        Infusion times without duplicate treatments, and patients with new or changed infusions
+    """
+    delta = delta[previous.columns]
+    changed = delta[_not_in(delta, previous, list(previous.columns))]
+    kept = previous[_not_in(previous, changed, INFUSION_KEY)]
+    infusion_times, _ = drop_patients_with_duplicate_treatments(
+        pd.concat([kept, changed], ignore_index=True)
+    )
+    return infusion_times, changed[PATIENT_ID].unique()
+
+
+def _run_on_patients(
+    samples: pd.DataFrame, state_settings: Dict[str, Any], parallel: bool
+) -> List[DiagnoseTypes]:
+    partition = PCodePartition(samples)
+    if len(state_settings["treatments"]) != 0:
+        partition = partition.filter(
+            samples[INFUSION_NO].isin(state_settings["treatments"])
+        )
+    diagnostics = []
+    for name, params in state_settings["params"].items():
+        diagnostic = DIAGNOSTICS_BY_NAME[name](partition)
+        diagnostic.set_params(**params)
+        diagnostics.append(diagnostic)
+    run_detections(partition, diagnostics, parallel=parallel)
+    return diagnostics
+
+
+def _splice(
+    previous: pd.DataFrame, new: pd.DataFrame, affected: np.ndarray
+) -> pd.DataFrame:
+    """Rows of previous not of affected patients, followed by new, in the types of SAMPLES_SCHEMA"""
+    kept = previous[~previous[PATIENT_ID].isin(affected)]
+    return cast_to_schema(pd.concat([kept, new], ignore_index=True))
+
+
+def apply_delta(
+    state: PhenotypingState,
+    delta_samples: pd.DataFrame,
+    delta_infusion_times: Optional[pd.DataFrame] = None,
+    parallel: bool = PARALLEL,
+) -> Tuple[PhenotypingState, np.ndarray]:
+    """State updated with delta exports, with the settings of state.
+
+    Parameters
+    ----------
+    state
+        State of the previous run
+
+    delta_samples
+        Samples as returned by read_samples, may repeat samples of the previous exports
+
+    delta_infusion_times
+        Infusion times as returned by read_infusion_times, may repeat rows of the previous exports
+
+    Returns
+    -------
+    Tuple[PhenotypingState, np.ndarray]
+        Updated state, and patients whose samples were assigned and detected again
+    """
+    infusion_times, affected = state.infusion_times, np.array([], dtype=int)
+    if delta_infusion_times is not None:
+        infusion_times, affected = update_infusion_times(
+            state.infusion_times, delta_infusion_times
+        )
+
+    # compared in the types of the state, so values read again are equal,
+    # to the previous samples of the patients of the delta only
+    previous = state.samples[state.samples[PATIENT_ID].isin(delta_samples[PATIENT_ID])]
+    typed_delta = cast_to_schema(delta_samples)
+    is_new = _not_in(typed_delta, previous, SAMPLE_KEY)
+    new_samples = delta_samples[is_new]
+    affected = np.union1d(affected, new_samples[PATIENT_ID].unique()).astype(int)
+
+    # previous samples of affected patients go through treatment assignment again with the new ones,
+    # except those corrected by a new sample
+    previous_samples = state.samples[state.samples[PATIENT_ID].isin(affected)]
+    not_corrected = _not_in(previous_samples, typed_delta[is_new], SAMPLE_ID)
+    previous_samples = (
+        previous_samples[not_corrected]
+        .drop(columns=TREATMENT_COLUMNS, errors="ignore")
+        .astype({PATIENT_ID: new_samples[PATIENT_ID].dtype})
+    )
+    samples = pd.concat([previous_samples, new_samples], ignore_index=True)
+    samples_with_treatment = cast_to_schema(
+        assign_samples_to_treatment(samples, infusion_times)
+    )
+
+    diagnostics = _run_on_patients(samples_with_treatment, state.settings, parallel)
+    detections = {
+        type(d).__name__: _splice(state.detections[type(d).__name__], d.data, affected)
+        for d in diagnostics
+    }
+    updated = PhenotypingState(
+        _splice(state.samples, samples_with_treatment, affected),
+        infusion_times.reset_index(drop=True),
+        detections,
+        state.settings,
+    )
+    return updated, affected
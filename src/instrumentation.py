@@ -0,0 +1,207 @@
+"""Record wall time, rows in and out and change of traced memory of each stage of a run of the app.
+
+Each stage, and each hit or miss of a cache, is kept as an Event of the current run and logged as
+one JSON line on the "mtx.instrumentation" logger, for monitoring:
+
+    {"run": "3f2a...", "name": "merge_samples_to_treatment", "kind": "stage", "seconds": 1.52, ...}
+
+Functions are instrumented with a decorator, blocks of code with a context manager:
+
+    @instrumented("load_samples", cached=True)
+    @st.cache
+    def load_samples(buffer):
+        record_cache_miss()
+        ...
+
+    with stage("init diagnostics", rows_in=len(samples)) as record:
+        diagnostics = ...
+        record.rows_out = len(diagnostics)
+
+Memory is only measured with tracemalloc running, see trace_memory or MTX_TRACE_MEMORY=1. It is the change
+of memory traced in the whole process while the stage runs: it includes what threads of other sessions
+allocate meanwhile, and is negative when the stage frees more than it allocates.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from typing import Any
+from typing import Callable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+import pandas as pd
+
+logger = logging.getLogger("mtx.instrumentation")
+
+TRACE_MEMORY = os.environ.get("MTX_TRACE_MEMORY", "0") == "1"
+
+STAGE = "stage"
+CACHE_HIT = "cache_hit"
+CACHE_MISS = "cache_miss"
+
+
+class Event(NamedTuple):
+    """A stage or a cache lookup of a run"""
+
+    run: str
+    name: str
+    kind: str
+    seconds: Optional[float] = None
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    # change of memory traced in the whole process, other sessions included
+    traced_memory_change_mb: Optional[float] = None
+
+
+class StageRecord:
+    """Measures of a stage being run, rows_out can be set by the instrumented block"""
+
+    def __init__(self, name: str, rows_in: Optional[int]):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out: Optional[int] = None
+        self.cache_missed = False
+
+
+# each Streamlit session runs in its own thread, its events are not mixed with other sessions
+_local = threading.local()
+
+
+def _state() -> threading.local:
+    if not hasattr(_local, "events"):
+        _local.run = uuid.uuid4().hex
+        _local.events = []
+        _local.stages = []
+    return _local
+
+
+def trace_memory() -> None:
+    """Start tracing memory of the process, never stopped by a run as sessions of the app share it"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def is_tracing_memory() -> bool:
+    """Whether memory is measured, costly measures are only taken then"""
+    return tracemalloc.is_tracing()
+
+
+def start_run() -> str:
+    """Forget the events of the previous run of this thread, tracing memory with MTX_TRACE_MEMORY=1"""
+    state = _state()
+    state.run = uuid.uuid4().hex
+    state.events = []
+    state.stages = []
+    if TRACE_MEMORY:
+        trace_memory()
+    return state.run
+
+
+def events() -> List[Event]:
+    """Events of the current run of this thread, in the order they ended"""
+    return list(_state().events)
+
+
+def events_frame() -> pd.DataFrame:
+    return pd.DataFrame(events(), columns=Event._fields)
+
+
+def _record(event: Event) -> None:
+    _state().events.append(event)
+    logger.info(json.dumps({k: v for k, v in event._asdict().items() if v is not None}))
+
+
+def log_events() -> None:
+    """Write events as JSON lines on stderr, only those of this module's logger, once per process"""
+    if len(logger.handlers) == 0:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    # not written again by handlers of the root logger
+    logger.propagate = False
+
+
+def count_rows(obj: Any) -> Optional[int]:
+    """Rows of a dataframe or partition, of the data of a diagnostic, or of the first item of a tuple"""
+    if isinstance(obj, tuple) and len(obj) != 0:
+        return count_rows(obj[0])
+    if isinstance(obj, (pd.DataFrame, pd.Series)) or hasattr(obj, "positions"):
+        return len(obj)
+    if isinstance(getattr(obj, "data", None), pd.DataFrame):
+        return len(obj.data)
+    return None
+
+
+@contextmanager
+def stage(name: str, rows_in: Optional[int] = None) -> Iterator[StageRecord]:
+    """Record wall time, rows and change of traced memory of the block as a stage named name"""
+    state = _state()
+    record = StageRecord(name, rows_in)
+    state.stages.append(record)
+    traced_before = None
+    if tracemalloc.is_tracing():
+        traced_before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        traced_change_mb = None
+        if traced_before is not None and tracemalloc.is_tracing():
+            traced_change = tracemalloc.get_traced_memory()[0] - traced_before
+            traced_change_mb = traced_change / 1024 / 1024
+        state.stages.pop()
+        _record(
+            Event(
+                state.run,
+                name,
+                STAGE,
+                seconds,
+                record.rows_in,
+                record.rows_out,
+                traced_change_mb,
+            )
+        )
+
+
+def record_cache_miss() -> None:
+    """Mark the innermost stage as computed, called from the body of a cached function"""
+    stages = _state().stages
+    if len(stages) != 0:
+        stages[-1].cache_missed = True
+
+
+def record_cache_lookup(name: str, hit: bool) -> None:
+    """Record a hit or a miss of a cache outside of a stage, eg. the disk cache of parsed files"""
+    _record(Event(_state().run, name, CACHE_HIT if hit else CACHE_MISS))
+
+
+def instrumented(name: str, cached: bool = False) -> Callable:
+    """Decorator recording each call as a stage, rows in are the rows of the first argument.
+
+    With cached, the decorated function is a cache whose body calls record_cache_miss,
+    each call also records a cache hit or miss.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name, count_rows(args[0]) if args else None) as record:
+                res = fn(*args, **kwargs)
+                record.rows_out = count_rows(res if res is not None else args[0])
+            if cached:
+                record_cache_lookup(name, hit=not record.cache_missed)
+            return res
+
+        return wrapper
+
+    return decorator
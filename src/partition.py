@@ -0,0 +1,133 @@
+"""Index of the merged samples by analyte (P_CODE).
+
+Built once after merge_samples_to_treatment, so each diagnostic gets its analytes
+in O(subset) instead of scanning the whole frame. Filtered partitions keep row positions
+into the same frame instead of a filtered copy of it.
+
+    samples = PCodePartition(samples_with_treatment_no)
+    neutrophils = samples.get("NPU02902", [PATIENT_ID, SAMPLE_TIME, VALUE])
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.processing import AnalyteIndex
+
+# structures memoized per partition, the least recently used are dropped beyond this number
+MEMO_MAX_ENTRIES = int(os.environ.get("MTX_MEMO_MAX_ENTRIES", 64))
+
+
+class PCodePartition:
+    """Row positions in source grouped by P_CODE: rows of a code are order[start:stop]"""
+
+    def __init__(self, data: pd.DataFrame):
+        # frame the positions refer to, never modified
+        self.source: pd.DataFrame = data
+        # positions of the rows of the partition in source, None for all rows
+        self._rows: Optional[np.ndarray] = None
+
+        codes, uniques = pd.factorize(data[P_CODE], sort=True)
+        # stable sort keeps rows of a same P_CODE in their original order
+        self._order: np.ndarray = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes + 1, minlength=len(uniques) + 1)
+        offsets = np.cumsum(counts)
+        self._slices: Dict[str, Tuple[int, int]] = {
+            code: (offsets[i], offsets[i + 1]) for i, code in enumerate(uniques)
+        }
+        self._memo: "OrderedDict[Hashable, Any]" = OrderedDict()
+        # partitions are shared by the sessions of the app, in threads
+        self._memo_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.source) if self._rows is None else len(self._rows)
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """Rows of the partition, only copied from source for filtered partitions"""
+        if self._rows is None:
+            return self.source
+        return self.memoize("data", lambda: self.source.iloc[self._rows])
+
+    @property
+    def codes(self) -> List[str]:
+        """P_CODEs present in data, sorted"""
+        return list(self._slices)
+
+    def positions(self, p_codes: Union[str, List[str]]) -> np.ndarray:
+        """Positions in source of the rows with one of p_codes, in ascending order"""
+        if isinstance(p_codes, str):
+            p_codes = [p_codes]
+        slices = [self._slices[c] for c in p_codes if c in self._slices]
+        if len(slices) == 0:
+            return np.array([], dtype=np.intp)
+        positions = np.concatenate([self._order[start:stop] for start, stop in slices])
+        if len(slices) > 1:
+            positions.sort()
+        return positions
+
+    def get(
+        self, p_codes: Union[str, List[str]], columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """Same as data.loc[data[P_CODE].isin(p_codes), columns], without scanning data"""
+        positions = self.positions(p_codes)
+        if columns is None:
+            columns = list(self.source.columns)
+        # a take per column is faster than iloc on rows and columns
+        return pd.DataFrame(
+            {column: self.source[column].array.take(positions) for column in columns},
+            index=self.source.index[positions],
+        )
+
+    def analyte(self, p_code: str) -> AnalyteIndex:
+        """Samples of p_code sorted by patient and date, shared by every diagnostic reading p_code"""
+        return self.memoize(
+            ("analyte", p_code),
+            lambda: AnalyteIndex(
+                self.get(p_code, [PATIENT_ID, SAMPLE_TIME, VALUE]), p_code
+            ),
+        )
+
+    def memoize(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        """Return build(), computed only once per partition and key.
+
+        Used for structures derived from the partition which stay valid while the partition lives,
+        like samples of an analyte sorted for streak detection. Only the MEMO_MAX_ENTRIES most recently
+        used are kept, others are built again when asked.
+        """
+        with self._memo_lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+        value = build()
+        with self._memo_lock:
+            self._memo[key] = value
+            while len(self._memo) > MEMO_MAX_ENTRIES:
+                self._memo.popitem(last=False)
+        return value
+
+    def filter(self, mask: Union[pd.Series, np.ndarray]) -> "PCodePartition":
+        """New partition over data[mask], reusing the grouping and source instead of copying them"""
+        mask = np.asarray(mask, dtype=bool)
+        rows = np.flatnonzero(mask) if self._rows is None else self._rows[mask]
+        in_source = np.zeros(len(self.source), dtype=bool)
+        in_source[rows] = True
+        kept = in_source[self._order]
+
+        partition = PCodePartition.__new__(PCodePartition)
+        partition.source = self.source
+        partition._rows = rows
+        partition._memo = OrderedDict()
+        partition._memo_lock = threading.Lock()
+        partition._order = self._order[kept]
+        kept_before = np.concatenate([[0], np.cumsum(kept)])
+        partition._slices = {
+            code: (kept_before[start], kept_before[stop])
+            for code, (start, stop) in self._slices.items()
+            if kept_before[stop] > kept_before[start]
+        }
+        return partition
@@ -0,0 +1,83 @@
+"""Phenotype of each patient for each diagnostic, built once after detection.
+
+Each patient has two bitsets, one bit per diagnostic: tested (it has samples in the diagnostic data)
+and positive (one of its samples was detected). Summaries, detected ids, the PHONOTYPE export
+and co-occurrences are then read from two arrays of integers aligned with the patients.
+
+    phenotype = PhenotypeMatrix(diagnostics)
+    phenotype.detected_ids(0)
+    phenotype.count_positive_to_all([0, 1])  # eg. neutropenia and infection
+"""
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.diagnostics import DiagnoseTypes
+
+
+class PhenotypeMatrix:
+    """Bitsets of tested and positive diagnostics per patient, in the order of the diagnostics given"""
+
+    def __init__(self, diagnostics: Sequence[DiagnoseTypes]):
+        if len(diagnostics) > 64:
+            raise ValueError("At most 64 diagnostics fit in the bitsets")
+        self.names: List[str] = [diagnostic.name for diagnostic in diagnostics]
+        self.patients: np.ndarray = np.unique(
+            np.concatenate(
+                [diagnostic.data[PATIENT_ID].to_numpy() for diagnostic in diagnostics]
+                or [np.array([], dtype=int)]
+            )
+        )
+        self.tested: np.ndarray = np.zeros(len(self.patients), dtype=np.uint64)
+        self.positive: np.ndarray = np.zeros(len(self.patients), dtype=np.uint64)
+
+        for i, diagnostic in enumerate(diagnostics):
+            bit = np.uint64(1 << i)
+            rows = np.searchsorted(
+                self.patients, diagnostic.data[PATIENT_ID].to_numpy()
+            )
+            detected = diagnostic.data[DETECTION].to_numpy(dtype=bool)
+            self.tested[rows] |= bit
+            self.positive[rows[detected]] |= bit
+
+    def _has(self, bitset: np.ndarray, i: int) -> np.ndarray:
+        return (bitset & np.uint64(1 << i)) != 0
+
+    def detected_ids(self, i: int) -> List:
+        """Patients with at least one sample detected by the i-th diagnostic"""
+        return self.patients[self._has(self.positive, i)].tolist()
+
+    def summary(self) -> pd.DataFrame:
+        """Number of patients tested and positive per diagnostic"""
+        n_tested = [self._has(self.tested, i).sum() for i in range(len(self.names))]
+        n_positive = [self._has(self.positive, i).sum() for i in range(len(self.names))]
+        return pd.DataFrame(
+            {
+                "name": self.names,
+                "patients with all negative diagnostic": np.subtract(
+                    n_tested, n_positive
+                ),
+                "patients with one positive diagnostic": n_positive,
+            }
+        )
+
+    def phenotype(self) -> pd.DataFrame:
+        """PHONOTYPE of each patient: 1 when any of the diagnostics detected one of its samples"""
+        return pd.DataFrame(
+            {PATIENT_ID: self.patients, "PHONOTYPE": (self.positive != 0).astype(int)}
+        )
+
+    def count_positive_to_all(self, indices: Sequence[int]) -> int:
+        """Number of patients positive to every diagnostic of indices"""
+        mask = np.uint64(sum(1 << i for i in indices))
+        return int(((self.positive & mask) == mask).sum())
+
+    def co_occurrence(self) -> pd.DataFrame:
+        """Number of patients positive to both diagnostics, for each pair of diagnostics"""
+        n = len(self.names)
+        counts = np.array(
+            [[self.count_positive_to_all({i, j}) for j in range(n)] for i in range(n)]
+        )
+        return pd.DataFrame(counts, index=self.names, columns=self.names)
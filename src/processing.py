@@ -1,10 +1,88 @@
 """Helper class to compute diagnostics on input dataframe
+
+Streaks are computed by a run-length kernel on NumPy arrays sorted by patient and date:
+a streak starts where the patient or the detection changes, and results are broadcast
+back to rows by indexing with the streak number of each row.
 """
 from datetime import datetime
+from typing import Dict
+from typing import Optional
+from typing import Tuple
 
 import numpy as np
 import pandas as pd
 
+from src.constants import *
+
+
+def count_above(scores: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    """Number of scores strictly above each of thresholds, NaN scores are never above"""
+    scores = np.sort(scores[~np.isnan(scores)])
+    # float32 values are compared to thresholds in float32, like in run_detection
+    thresholds = np.asarray(thresholds, dtype=np.result_type(scores.dtype, np.float32))
+    return len(scores) - np.searchsorted(scores, thresholds, side="right")
+
+
+def _sort_by_patient_and_date(
+    df: pd.DataFrame, column_patient_id: str, column_date: str
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Stable order of rows by patient then date, with sorted dates and a mask of each patient's first row"""
+    dates = df[column_date].to_numpy(dtype="datetime64[ns]")
+    patient_codes, patient_ids = pd.factorize(df[column_patient_id], sort=True)
+    order = None
+
+    # a single int64 key (patient, date) sorts about twice as fast as a lexsort on both
+    ticks = dates.view(np.int64)
+    if len(dates) > 0 and not np.isnat(dates).any() and (patient_codes >= 0).all():
+        ticks = ticks - ticks.min()
+        for unit in [3600 * 10 ** 9, 60 * 10 ** 9, 10 ** 9, 1]:
+            if (ticks % unit == 0).all():
+                break
+        ticks = ticks // unit
+        span = int(ticks.max()) + 1
+        if len(patient_ids) * span < 2 ** 62:
+            order = np.argsort(patient_codes * span + ticks, kind="stable")
+    if order is None:
+        order = np.lexsort((dates, patient_codes))
+
+    sorted_codes = patient_codes[order]
+    new_patient = np.ones(len(df), dtype=bool)
+    new_patient[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    return order, dates[order], new_patient
+
+
+def _streaks(
+    new_patient: np.ndarray, detection: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """On arrays sorted by patient and date, start of each streak of successive equal detections,
+    and for each row the number of its streak (from 0)
+    """
+    start_of_streak = new_patient.copy()
+    start_of_streak[1:] |= detection[1:] != detection[:-1]
+    return np.flatnonzero(start_of_streak), np.cumsum(start_of_streak) - 1
+
+
+def _streak_durations(streak_start: np.ndarray, dates: np.ndarray) -> np.ndarray:
+    """Duration in hours of streaks starting at streak_start and ending before the next one"""
+    streak_end = np.append(streak_start[1:], len(dates)) - 1
+    return (dates[streak_end] - dates[streak_start]) / np.timedelta64(1, "h")
+
+
+def _positive_streaks_longer_than(
+    new_patient: np.ndarray,
+    detection: np.ndarray,
+    dates: np.ndarray,
+    longer_than_n_hours: float,
+) -> np.ndarray:
+    """On arrays sorted by patient and date, True for rows in a positive streak lasting more than longer_than_n_hours"""
+    if len(detection) == 0:
+        return np.zeros(0, dtype=bool)
+    streak_start, streak_of_row = _streaks(new_patient, detection)
+    long_positive_streak = detection[streak_start] & (
+        _streak_durations(streak_start, dates) > longer_than_n_hours
+    )
+    return long_positive_streak[streak_of_row]
+
 
 def compute_streaks_of_detection(
     df: pd.DataFrame,
@@ -12,12 +90,19 @@ def compute_streaks_of_detection(
     column_patient_id: str,
     column_date: datetime,
 ):
-    """Compute streaks of column_variable column"""
-    df = df.sort_values([column_patient_id, column_date])
-    df["shifted_detection"] = df.groupby(column_patient_id)[column_variable].shift(1)
-    df["start_of_streak"] = df[column_variable].ne(df[f"shifted_{column_variable}"])
-    df["streak_id"] = df.groupby(column_patient_id)["start_of_streak"].cumsum()
-    return df["streak_id"]
+    """Compute streaks of column_variable column, numbered from 1 for each patient.
+
+    Returned in order of patient and date, indexed like df.
+    """
+    order, _, new_patient = _sort_by_patient_and_date(
+        df, column_patient_id, column_date
+    )
+    _, streak_of_row = _streaks(new_patient, df[column_variable].to_numpy()[order])
+    first_row_of_patient = np.maximum.accumulate(
+        np.where(new_patient, np.arange(len(order)), 0)
+    )
+    streak_id = streak_of_row - streak_of_row[first_row_of_patient] + 1
+    return pd.Series(streak_id, index=df.index[order], name="streak_id")
 
 
 def is_streak_longer_than_duration(
@@ -32,36 +117,405 @@ def is_streak_longer_than_duration(
 
     column_variable is generally the detection variable so we see if long streak of positive diagnostic
     """
-    data = df.copy()
-    data["streak_id"] = compute_streaks_of_detection(
-        data, column_variable, column_patient_id, column_date
+    order, dates, new_patient = _sort_by_patient_and_date(
+        df, column_patient_id, column_date
+    )
+    detection = df[column_variable].fillna(False).to_numpy(dtype=bool)
+    detected = np.empty(len(df), dtype=bool)
+    detected[order] = _positive_streaks_longer_than(
+        new_patient, detection[order], dates, longer_than_n_hours
     )
+    return pd.Series(detected, index=df.index)
 
-    # Group elements in the same streak together to compute duration of streak and if it's a positive or negative one
-    group_streaks_by_patient = (
-        data.groupby([column_patient_id, "streak_id"])[[column_date, column_variable]]
-        .agg(
-            min_date=(column_date, "min"),
-            max_date=(column_date, "max"),
-            is_streak_positive=(column_variable, "first"),
-        )
-        .reset_index()
+
+def assign_infusions(
+    samples: pd.DataFrame, infusion_times: pd.DataFrame
+) -> pd.DataFrame:
+    """Assign each sample to the infusion it was taken after.
+
+    A sample belongs to the highest INFUSION_NO whose start is before or at the sample time.
+    Samples taken before any infusion get INFUSION_NO 0 and are measured against infusion 1,
+    samples without a matching patient or without infusion 1 get missing values.
+    Works for any number of infusions per patient.
+
+    Parameters
+    ----------
+    samples
+        Samples with PATIENT_ID and SAMPLE_TIME columns
+
+    infusion_times
+        One row per (PATIENT_ID, INFUSION_NO) with INF_STARTDATE
+
+    Returns
+    -------
+    pd.DataFrame
+        INFUSION_NO, INF_STARTDATE and DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE (floored hours),
+        indexed like samples
+    """
+    infusions = infusion_times[[PATIENT_ID, INFUSION_NO, INF_STARTDATE]].copy()
+    infusions[INFUSION_NO] = pd.to_numeric(infusions[INFUSION_NO], errors="coerce")
+    infusions[INF_STARTDATE] = infusions[INF_STARTDATE].astype("datetime64[ns]")
+    infusions = infusions.dropna(subset=[INFUSION_NO, INF_STARTDATE])
+    infusions = infusions[infusions[INFUSION_NO] >= 1]
+
+    # Once sorted by start, the running max of INFUSION_NO is the highest infusion already started
+    infusions = infusions.sort_values([PATIENT_ID, INF_STARTDATE, INFUSION_NO])
+    infusions["infusion_started"] = infusions.groupby(PATIENT_ID)[INFUSION_NO].cummax()
+    start_per_infusion = infusions[[PATIENT_ID, INFUSION_NO, INF_STARTDATE]].rename(
+        columns={INFUSION_NO: "infusion_started", INF_STARTDATE: "start_started"}
     )
-    group_streaks_by_patient["streak_duration"] = (
-        group_streaks_by_patient["max_date"] - group_streaks_by_patient["min_date"]
-    ) / np.timedelta64(1, "h")
-
-    group_streaks_by_patient[column_variable] = (
-        group_streaks_by_patient["streak_duration"] > longer_than_n_hours
-    ) & group_streaks_by_patient["is_streak_positive"]
-
-    # Left join the data with the table of long positive streaks
-    res = (
-        data.reset_index()
-        .merge(
-            group_streaks_by_patient, on=[column_patient_id, "streak_id"], how="left"
-        )
-        .set_index("index")
+    infusions = infusions.merge(
+        start_per_infusion, on=[PATIENT_ID, "infusion_started"], how="left"
+    ).sort_values(INF_STARTDATE)
+
+    lookup = pd.DataFrame(
+        {
+            "row": np.arange(len(samples)),
+            PATIENT_ID: samples[PATIENT_ID].to_numpy(),
+            SAMPLE_TIME: samples[SAMPLE_TIME].astype("datetime64[ns]").to_numpy(),
+        }
+    )
+    lookup = lookup.dropna(subset=[PATIENT_ID, SAMPLE_TIME])
+    lookup[PATIENT_ID] = lookup[PATIENT_ID].astype(infusions[PATIENT_ID].dtype)
+    lookup = pd.merge_asof(
+        lookup.sort_values(SAMPLE_TIME),
+        infusions[[PATIENT_ID, INF_STARTDATE, "infusion_started", "start_started"]],
+        left_on=SAMPLE_TIME,
+        right_on=INF_STARTDATE,
+        by=PATIENT_ID,
+        direction="backward",
+    )
+
+    # Samples before every infusion are counted as INFNO 0, relative to infusion 1
+    first_infusion_start = infusions.loc[
+        infusions[INFUSION_NO] == 1, [PATIENT_ID, INF_STARTDATE]
+    ].set_index(PATIENT_ID)[INF_STARTDATE]
+    before_first = lookup["infusion_started"].isnull()
+    lookup.loc[before_first, "start_started"] = lookup.loc[
+        before_first, PATIENT_ID
+    ].map(first_infusion_start)
+    lookup.loc[before_first & lookup["start_started"].notnull(), "infusion_started"] = 0
+
+    rows = lookup["row"].to_numpy()
+    infusion_no = np.full(len(samples), np.nan)
+    infusion_no[rows] = lookup["infusion_started"].to_numpy(dtype=float)
+    start_date = np.full(len(samples), np.datetime64("NaT"), dtype="datetime64[ns]")
+    start_date[rows] = lookup["start_started"].to_numpy(dtype="datetime64[ns]")
+    sample_time = samples[SAMPLE_TIME].astype("datetime64[ns]").to_numpy()
+    hour_diff = np.floor((sample_time - start_date) / np.timedelta64(1, "h"))
+
+    return pd.DataFrame(
+        {
+            INFUSION_NO: infusion_no,
+            INF_STARTDATE: start_date,
+            DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE: hour_diff,
+        },
+        index=samples.index,
     )
 
-    return res[f"{column_variable}_x"] & res[f"{column_variable}_y"]
+
+class AnalyteIndex:
+    """Samples of one analyte (P_CODE) sorted by patient then date, once for every diagnostic reading it.
+
+    Streaks, extreme values per patient and samples averaged per patient and date are derived
+    from this order instead of sorting or grouping the samples again.
+
+        crp = AnalyteIndex(samples.get("NPU19748", [PATIENT_ID, SAMPLE_TIME, VALUE]), "NPU19748")
+        highest = crp.max_per_patient()  # one value per patient of crp.patients
+    """
+
+    def __init__(self, df: pd.DataFrame, code: str):
+        self.code = code
+        self.index = df.index
+        self.order, self.dates, self.new_patient = _sort_by_patient_and_date(
+            df, PATIENT_ID, SAMPLE_TIME
+        )
+        values = df[VALUE]
+        # float32 values stay float32 so thresholds compare like on the column itself
+        dtype = np.float32 if values.dtype == np.float32 else float
+        self.values: np.ndarray = values.to_numpy(dtype=dtype)[self.order]
+        self.patient_ids: np.ndarray = df[PATIENT_ID].to_numpy()[self.order]
+        self.first_of_patient: np.ndarray = np.flatnonzero(self.new_patient)
+        self.patients: np.ndarray = self.patient_ids[self.first_of_patient]
+        self._points: Optional[pd.DataFrame] = None
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def max_per_patient(self) -> np.ndarray:
+        """Highest value of each patient of self.patients, NaN values are ignored and NaN when all are"""
+        if len(self) == 0:
+            return self.values[:0]
+        return np.fmax.reduceat(self.values, self.first_of_patient)
+
+    def min_per_patient(self) -> np.ndarray:
+        """Lowest value of each patient of self.patients, NaN values are ignored and NaN when all are"""
+        if len(self) == 0:
+            return self.values[:0]
+        return np.fmin.reduceat(self.values, self.first_of_patient)
+
+    def points(self) -> pd.DataFrame:
+        """PATIENT_ID, P_CODE, SAMPLE_TIME and VALUE of the samples averaged per patient and date,
+        sorted by date. Samples without value or date are left out.
+        """
+        if self._points is None:
+            valid = ~np.isnan(self.values) & ~np.isnat(self.dates)
+            patient_ids = self.patient_ids[valid]
+            dates = self.dates[valid]
+            values = self.values[valid]
+
+            # samples of a same patient and date are next to each other
+            new_point = np.ones(len(values), dtype=bool)
+            new_point[1:] = (patient_ids[1:] != patient_ids[:-1]) | (
+                dates[1:] != dates[:-1]
+            )
+            starts = np.flatnonzero(new_point)
+            sums = np.zeros(0)
+            if len(starts) > 0:
+                sums = np.add.reduceat(values.astype(float), starts)
+            means = (sums / np.diff(np.append(starts, len(values)))).astype(
+                values.dtype
+            )
+
+            by_date = np.argsort(dates[starts], kind="stable")
+            self._points = pd.DataFrame(
+                {
+                    PATIENT_ID: patient_ids[starts][by_date],
+                    P_CODE: self.code,
+                    SAMPLE_TIME: dates[starts][by_date],
+                    VALUE: means[by_date],
+                }
+            )
+        return self._points
+
+
+class StreakIndex:
+    """Values of a dataframe sorted by patient and date once, to detect streaks for any threshold.
+
+    Moving a threshold or a duration only compares values and finds the limits of streaks again,
+    without sorting or grouping the dataframe.
+
+        streaks = StreakIndex(df, VALUE, PATIENT_ID, SAMPLE_TIME)
+        df[DETECTION] = streaks.detect(0.5, longer_than_n_hours=240, below=True)
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        column_value: str,
+        column_patient_id: str,
+        column_date: str,
+    ):
+        self._order, self.dates, self.new_patient = _sort_by_patient_and_date(
+            df, column_patient_id, column_date
+        )
+        self.index = df.index
+        values = df[column_value]
+        # float32 values stay float32 so thresholds compare like on the column itself
+        dtype = np.float32 if values.dtype == np.float32 else float
+        self.values = values.to_numpy(dtype=dtype)[self._order]
+        self.patients = df[column_patient_id].to_numpy()[self._order][self.new_patient]
+
+    @classmethod
+    def from_analyte(
+        cls, analyte: AnalyteIndex, values: Optional[np.ndarray] = None
+    ) -> "StreakIndex":
+        """Streaks of the samples of analyte, or of values given for its rows in their original order,
+        without sorting them again
+        """
+        streaks = cls.__new__(cls)
+        streaks._order = analyte.order
+        streaks.dates = analyte.dates
+        streaks.new_patient = analyte.new_patient
+        streaks.index = analyte.index
+        streaks.values = analyte.values if values is None else values[analyte.order]
+        streaks.patients = analyte.patients
+        return streaks
+
+    def _compare(self, threshold: float, below: bool) -> np.ndarray:
+        if below:
+            return self.values < threshold
+        return self.values > threshold
+
+    def detect(
+        self, threshold: float, longer_than_n_hours: float, below: bool = True
+    ) -> pd.Series:
+        """True for rows with value below (or above) threshold for more than longer_than_n_hours in a row
+
+        Parameters
+        ----------
+        threshold
+            Value a sample is compared to
+
+        longer_than_n_hours
+            Minimum duration of the streak of positive samples
+
+        below
+            Samples are positive when value < threshold if True, value > threshold otherwise
+
+        Returns
+        -------
+        pd.Series
+            Boolean detection, indexed like the dataframe the index was built on
+        """
+        detection = self._compare(threshold, below)
+        detected = np.empty(len(detection), dtype=bool)
+        detected[self._order] = _positive_streaks_longer_than(
+            self.new_patient, detection, self.dates, longer_than_n_hours
+        )
+        return pd.Series(detected, index=self.index)
+
+    def longest_positive_streak(
+        self, threshold: float, below: bool = True
+    ) -> np.ndarray:
+        """Duration in hours of the longest positive streak of each patient in self.patients,
+        -inf for patients without positive sample.
+
+        A patient is detected by detect(threshold, n) when its longest positive streak is > n hours,
+        so one call answers for every duration.
+        """
+        if len(self.values) == 0:
+            return np.zeros(0)
+        detection = self._compare(threshold, below)
+        streak_start, _ = _streaks(self.new_patient, detection)
+        duration = np.where(
+            detection[streak_start],
+            _streak_durations(streak_start, self.dates),
+            -np.inf,
+        )
+        first_streak_of_patient = np.flatnonzero(self.new_patient[streak_start])
+        return np.fmax.reduceat(duration, first_streak_of_patient)
+
+
+class SegmentIndex:
+    """Rows grouped in segments of equal keys with offset arrays, for per group reductions without groupby.
+
+    Rows are sorted stably by keys, the first key first, so rows of a segment keep their order:
+    segment s holds rows order[offsets[s]:offsets[s + 1]], in the order of the groupby on the same keys.
+
+        treatments = SegmentIndex(patient_ids, infusion_numbers)
+        highest = treatments.max(values)  # one value per treatment
+        df["highest"] = treatments.broadcast(highest)
+    """
+
+    def __init__(self, *keys: np.ndarray):
+        n_rows = len(keys[0])
+        self.order: np.ndarray = np.lexsort(keys[::-1]) if n_rows else np.arange(0)
+        new_segment = np.zeros(n_rows, dtype=bool)
+        new_segment[:1] = True
+        for key in keys:
+            sorted_key = key[self.order]
+            new_segment[1:] |= sorted_key[1:] != sorted_key[:-1]
+        self.starts: np.ndarray = np.flatnonzero(new_segment)
+        self.offsets: np.ndarray = np.append(self.starts, n_rows)
+        self.segment_of_row: np.ndarray = np.empty(n_rows, dtype=np.intp)
+        self.segment_of_row[self.order] = np.cumsum(new_segment) - 1
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def first(self, key: np.ndarray) -> np.ndarray:
+        """Value of key for each segment"""
+        return key[self.order[self.starts]]
+
+    def max(self, values: np.ndarray) -> np.ndarray:
+        """Maximum of values in each segment, NaN values are ignored and NaN when all are"""
+        if len(self) == 0:
+            return values[:0]
+        return np.fmax.reduceat(values[self.order], self.starts)
+
+    def previous(self, values: np.ndarray) -> np.ndarray:
+        """For each row, value of the row before it in its segment, NaN for the first row of a segment"""
+        shifted = np.empty(len(values), dtype=np.result_type(values.dtype, np.float32))
+        shifted[1:] = values[self.order][:-1]
+        shifted[self.starts] = np.nan
+        previous = np.empty_like(shifted)
+        previous[self.order] = shifted
+        return previous
+
+    def broadcast(self, per_segment: np.ndarray) -> np.ndarray:
+        """Value of the segment of each row"""
+        return per_segment[self.segment_of_row]
+
+
+class SampleAlignment:
+    """Samples of several P_CODE paired in time per patient, in a long frame of one row per pair.
+
+    Each sample of anchor_code is paired with the nearest sample of every other code of the same patient,
+    drawn at most tolerance_hours before or after it. Samples of a code drawn at the same time are averaged,
+    so with a tolerance of 0 codes are paired when they share their timestamp, like a pivot on it.
+
+        points = {code: samples.analyte(code).points() for code in ["NPU19748", "NPU19652"]}
+        alignment = SampleAlignment(points, "NPU19748", tolerance_hours=2)
+        positive = alignment.values("NPU19748") > 100  # one value per anchor
+        df[DETECTION] = alignment.detect(df, positive)
+    """
+
+    def __init__(
+        self,
+        points: Dict[str, pd.DataFrame],
+        anchor_code: str,
+        tolerance_hours: float = 0,
+    ):
+        """
+        Parameters
+        ----------
+        points
+            Samples of each code averaged per patient and date and sorted by date, see AnalyteIndex.points
+
+        anchor_code
+            Code of points whose samples are paired with samples of the other codes
+
+        tolerance_hours
+            Longest time between paired samples
+        """
+        anchors = points[anchor_code]
+        anchors = anchors.assign(**{ANCHOR: np.arange(len(anchors))})
+        self.patients: np.ndarray = anchors[PATIENT_ID].to_numpy()
+
+        # merge_asof of some pandas versions fails on int32 keys with a tolerance, as after cast_to_schema
+        keys = anchors[[ANCHOR, PATIENT_ID, SAMPLE_TIME]].astype({PATIENT_ID: "int64"})
+        pairs = [anchors]
+        for code, samples in points.items():
+            if code == anchor_code:
+                continue
+            paired = pd.merge_asof(
+                keys,
+                samples.rename(columns={SAMPLE_TIME: "paired"}).astype(
+                    {PATIENT_ID: "int64"}
+                ),
+                left_on=SAMPLE_TIME,
+                right_on="paired",
+                by=PATIENT_ID,
+                tolerance=pd.Timedelta(hours=tolerance_hours),
+                direction="nearest",
+            ).dropna(subset=[VALUE])
+            pairs.append(
+                paired.drop(columns=SAMPLE_TIME).rename(columns={"paired": SAMPLE_TIME})
+            )
+        # ANCHOR, PATIENT_ID, P_CODE, SAMPLE_TIME and VALUE of each anchor and sample paired to it
+        self.pairs: pd.DataFrame = pd.concat(pairs, ignore_index=True)[
+            [ANCHOR, PATIENT_ID, P_CODE, SAMPLE_TIME, VALUE]
+        ]
+
+    def __len__(self) -> int:
+        return len(self.patients)
+
+    def values(self, code: str) -> np.ndarray:
+        """Value of code paired to each anchor, NaN for anchors without a sample of code in tolerance"""
+        pairs = self.pairs[self.pairs[P_CODE] == code]
+        # float32 values stay float32 so thresholds compare like on the column itself
+        dtype = np.result_type(pairs[VALUE].dtype, np.float32)
+        values = np.full(len(self), np.nan, dtype=dtype)
+        values[pairs[ANCHOR].to_numpy()] = pairs[VALUE].to_numpy()
+        return values
+
+    def detect(self, df: pd.DataFrame, positive: np.ndarray) -> pd.Series:
+        """True for rows of df which are an anchor positive in positive, or a sample paired to one"""
+        members = self.pairs.loc[
+            positive[self.pairs[ANCHOR].to_numpy()], [PATIENT_ID, P_CODE, SAMPLE_TIME]
+        ].drop_duplicates()
+        detected = df[[PATIENT_ID, P_CODE, SAMPLE_TIME]].merge(
+            members, on=[PATIENT_ID, P_CODE, SAMPLE_TIME], how="left", indicator=True
+        )
+        return pd.Series(detected["_merge"].to_numpy() == "both", index=df.index)
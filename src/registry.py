@@ -0,0 +1,232 @@
+"""Datasets shared by all sessions of the app, held once per process and keyed by the hash of their content.
+
+Sessions uploading the same exports get read-only views of the same frames instead of their own copy.
+A dataset is dropped when the last session holding it releases it, sessions not seen for
+MTX_SESSION_TTL_SECONDS are considered closed. With MTX_SHARED_DIR, frames are also written there as
+uncompressed Feather files and memory-mapped, so processes of a same host share their pages.
+A process removes the files of a dataset when it drops it, processes which memory-mapped them keep
+their pages and the next process needing them writes them again.
+
+    samples = SHARED_DATASETS.acquire(key, session_id, lambda: merge(samples, infusion_times))
+    partition = SHARED_DATASETS.derive(key, "partition", lambda: PCodePartition(samples))
+    SHARED_DATASETS.release(session_id, keep=[key])
+"""
+import os
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Collection
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from src import cache
+from src.instrumentation import record_cache_lookup
+
+SHARED_DIR = os.environ.get("MTX_SHARED_DIR", "")
+SESSION_TTL_SECONDS = float(os.environ.get("MTX_SESSION_TTL_SECONDS", 3600))
+
+Frames = Union[pd.DataFrame, Tuple[pd.DataFrame, ...]]
+
+
+def content_key(kind: str, *sources: cache.FileSource) -> str:
+    """Key of a dataset computed from the content of sources"""
+    hashes = [cache.file_hash(source) for source in sources]
+    return "-".join([f"{kind}-v{cache.CACHE_VERSION}"] + hashes)
+
+
+# ndarrays holding the values of pandas extension arrays: categories codes, values and mask of
+# nullable integers, datetimes with a time zone, strings
+_EXTENSION_BUFFERS = ("_ndarray", "_codes", "_data", "_mask")
+
+
+def _blocks(df: pd.DataFrame) -> List[Any]:
+    """Blocks holding the values of df, pandas has no public API to make them read-only"""
+    manager = df._mgr if hasattr(df, "_mgr") else df._data  # pandas < 1.1
+    return list(manager.blocks)
+
+
+def read_only(df: pd.DataFrame) -> pd.DataFrame:
+    """View of df sharing its values: columns set on the view stay in the view, writing shared values raises"""
+    view = df.copy(deep=False)
+    for block in _blocks(view):
+        if isinstance(block.values, np.ndarray):
+            block.values.flags.writeable = False
+            continue
+        for name in _EXTENSION_BUFFERS:
+            buffer = getattr(block.values, name, None)
+            if isinstance(buffer, np.ndarray):
+                buffer.flags.writeable = False
+    return view
+
+
+class _Entry:
+    def __init__(self, frames: Tuple[pd.DataFrame, ...]):
+        self.frames = frames
+        self.sessions: Set[Hashable] = set()
+        self.derived: Dict[Hashable, Any] = {}
+
+
+class DatasetRegistry:
+    """Frames shared by sessions, with the sessions holding each of them"""
+
+    def __init__(
+        self,
+        folder: Optional[str] = SHARED_DIR,
+        session_ttl_seconds: float = SESSION_TTL_SECONDS,
+    ):
+        self.folder = folder
+        self.session_ttl_seconds = session_ttl_seconds
+        self._entries: Dict[str, _Entry] = {}
+        self._last_seen: Dict[Hashable, float] = {}
+        # sessions run in threads of the same process
+        self._lock = threading.RLock()
+        self._building: Dict[str, threading.Lock] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def refcount(self, key: str) -> int:
+        """Number of sessions holding the dataset key"""
+        entry = self._entries.get(key)
+        return 0 if entry is None else len(entry.sessions)
+
+    def _paths(self, key: str, n_frames: int) -> List[str]:
+        return [
+            os.path.join(self.folder, f"dataset-{key}.{i}.feather")
+            for i in range(n_frames)
+        ]
+
+    def _load(
+        self, key: str, build: Callable[[], Frames], n_frames: int
+    ) -> Tuple[pd.DataFrame, ...]:
+        """Frames of key from the shared folder, written there by build() when missing"""
+        if not self.folder:
+            frames = build()
+            return (frames,) if n_frames == 1 else tuple(frames)
+
+        paths = self._paths(key, n_frames)
+        if not all(os.path.exists(p) for p in paths):
+            frames = build()
+            frames = (frames,) if n_frames == 1 else tuple(frames)
+            os.makedirs(self.folder, exist_ok=True)
+            for df, path in zip(frames, paths):
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                try:
+                    feather.write_feather(
+                        df.reset_index(drop=True), tmp_path, compression="uncompressed"
+                    )
+                    os.replace(tmp_path, path)
+                except (pa.ArrowException, OSError):
+                    # eg. object columns mixing numbers and strings, share within this process only
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    return frames
+        try:
+            # memory-mapped, pages are shared with other processes reading the same files
+            frames = tuple(
+                feather.read_table(p, memory_map=True).to_pandas(split_blocks=True)
+                for p in paths
+            )
+            for p in paths:
+                os.utime(p)
+            return frames
+        except OSError:
+            # evicted by another process meanwhile
+            frames = build()
+            return (frames,) if n_frames == 1 else tuple(frames)
+
+    def acquire(
+        self,
+        key: str,
+        session: Hashable,
+        build: Callable[[], Frames],
+        n_frames: int = 1,
+    ) -> Frames:
+        """Read-only views of the frames of key, held by session. build() returns them when not shared yet.
+
+        Parameters
+        ----------
+        key
+            Hash of the content the frames are computed from
+
+        session
+            Identifier of the session, held datasets are released with release(session)
+
+        build
+            Function returning a dataframe, or a tuple of n_frames dataframes
+
+        n_frames
+            Number of dataframes returned by build
+        """
+        self.evict()
+        with self._lock:
+            self._last_seen[session] = time.time()
+            building = self._building.setdefault(key, threading.Lock())
+        # sessions asking for the same key wait for the first one to build it
+        with building:
+            entry = self._entries.get(key)
+            hit = entry is not None
+            if not hit:
+                frames = self._load(key, build, n_frames)
+                entry = _Entry(tuple(read_only(df) for df in frames))
+            with self._lock:
+                self._entries[key] = entry
+                entry.sessions.add(session)
+        record_cache_lookup("shared dataset", hit=hit)
+
+        views = tuple(read_only(df) for df in entry.frames)
+        return views[0] if n_frames == 1 else views
+
+    def derive(self, key: str, name: Hashable, build: Callable[[], Any]) -> Any:
+        """Return build(), computed once per dataset key and name, dropped with the dataset"""
+        entry = self._entries[key]
+        if name not in entry.derived:
+            entry.derived[name] = build()
+        return entry.derived[name]
+
+    def release(self, session: Hashable, keep: Collection[str] = ()) -> None:
+        """Session stops holding datasets, except keep. Datasets no session holds are dropped"""
+        dropped = []
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if key not in keep and session in entry.sessions:
+                    entry.sessions.discard(session)
+                    if len(entry.sessions) == 0:
+                        del self._entries[key]
+                        self._building.pop(key, None)
+                        dropped.append((key, len(entry.frames)))
+            if len(keep) == 0:
+                self._last_seen.pop(session, None)
+        if self.folder:
+            for key, n_frames in dropped:
+                for path in self._paths(key, n_frames):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass  # not written, or removed by another process
+
+    def evict(self, now: Optional[float] = None) -> None:
+        """Release datasets of sessions not seen for session_ttl_seconds"""
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [
+                session
+                for session, last_seen in self._last_seen.items()
+                if now - last_seen > self.session_ttl_seconds
+            ]
+        for session in expired:
+            self.release(session)
+
+
+SHARED_DATASETS = DatasetRegistry()
@@ -0,0 +1,320 @@
+"""Diagnostics declared as data, compiled to comparisons of NumPy arrays.
+
+A rule compares the samples of analytes (P_CODE) to thresholds, for a duration in a row
+or paired with samples of other analytes drawn within a time window, and combines comparisons
+with AllOf and AnyOf. Thresholds, durations and windows are numbers or names of parameters
+of the rule, which are shown as sidebar sliders.
+
+    rule = Rule(
+        "Severe infection",
+        AllOf([Compare("NPU19748", ">", "param_crp"), Compare("NPU02902", "<", 0.5)]),
+        params=[Param("param_crp", "NPU19748 > threshold", 0, 400, 100, 10)],
+        window_hours=24,
+    )
+    evaluator = compile_rule(rule).evaluator(samples)
+    detection = evaluator.detect({"param_crp": 150})
+"""
+from typing import Callable, Dict, Hashable, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.partition import PCodePartition
+from src.processing import count_above
+from src.processing import SampleAlignment
+from src.processing import StreakIndex
+
+# a number, or the name of a parameter of the rule
+Value = Union[float, str]
+
+COMPARISONS: Dict[str, Callable] = {"<": np.less, ">": np.greater}
+COLUMNS = [PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, SEX, MP6_STOP]
+
+
+class Param(NamedTuple):
+    """Parameter of a diagnostic, stored as an attribute of the diagnostic and shown as a sidebar slider"""
+
+    name: str
+    label: str
+    min_value: float
+    max_value: float
+    value: float
+    step: Optional[float] = None
+    format: Optional[str] = None
+    key: Optional[str] = None
+
+    def grid(self) -> np.ndarray:
+        """Values evaluated by a sweep: every slider step, or 6 values without step"""
+        if self.step is None:
+            return np.linspace(self.min_value, self.max_value, 6)
+        return np.round(
+            np.arange(self.min_value, self.max_value + self.step / 2, self.step), 10
+        )
+
+
+class Compare(NamedTuple):
+    """Samples of code compared to threshold x scale with comparison, "<" or ">".
+
+    With a duration, samples are positive when the comparison holds for more than
+    duration x hours_per_unit hours in a row.
+    """
+
+    code: str
+    comparison: str
+    threshold: Value
+    scale: float = 1
+    duration: Optional[Value] = None
+    hours_per_unit: float = 1
+
+
+class AllOf(NamedTuple):
+    """Positive when all of conditions are"""
+
+    conditions: Sequence["Condition"]
+
+
+class AnyOf(NamedTuple):
+    """Positive when one of conditions is"""
+
+    conditions: Sequence["Condition"]
+
+
+Condition = Union[Compare, AllOf, AnyOf]
+
+
+class Rule(NamedTuple):
+    """Diagnostic declared as data.
+
+    A rule on one code compares each of its samples. A rule on several codes pairs each sample of anchor,
+    the first code of condition by default, with the nearest sample of each other code drawn
+    within window_hours (see SampleAlignment), and compares the paired values.
+    """
+
+    name: str
+    condition: Condition
+    params: Sequence[Param] = ()
+    anchor: Optional[str] = None
+    window_hours: Value = 0
+    # samples without value are left out of the data of the diagnostic
+    dropna: bool = False
+
+
+def _leaves(condition: Condition) -> List[Compare]:
+    if isinstance(condition, Compare):
+        return [condition]
+    return [leaf for c in condition.conditions for leaf in _leaves(c)]
+
+
+def _combine(
+    condition: Condition, leaves: List[Compare]
+) -> Callable[[List[np.ndarray]], np.ndarray]:
+    """Function of the masks of leaves returning the mask of condition"""
+    if isinstance(condition, Compare):
+        i = leaves.index(condition)
+        return lambda masks: masks[i]
+    parts = [_combine(c, leaves) for c in condition.conditions]
+    reduce = np.logical_and if isinstance(condition, AllOf) else np.logical_or
+    return lambda masks: reduce.reduce([part(masks) for part in parts])
+
+
+class CompiledRule:
+    """Evaluation plan of a rule: each distinct comparison, and how their masks combine"""
+
+    def __init__(self, rule: Rule):
+        self.rule = rule
+        self.leaves: List[Compare] = list(dict.fromkeys(_leaves(rule.condition)))
+        self.codes: List[str] = list(dict.fromkeys(leaf.code for leaf in self.leaves))
+        self.anchor: str = rule.anchor or self.codes[0]
+        # several codes are compared on paired samples instead of rows
+        self.aligned: bool = len(self.codes) > 1
+        self.combine = _combine(rule.condition, self.leaves)
+
+    def evaluator(self, samples: PCodePartition) -> "RuleEvaluator":
+        """Evaluator of the rule on samples, built once per partition"""
+        return samples.memoize(
+            ("rule", self.rule.name), lambda: RuleEvaluator(self, samples)
+        )
+
+
+def compile_rule(rule: Rule) -> CompiledRule:
+    """Check rule and compile it, raises ValueError for rules which can not be evaluated"""
+    plan = CompiledRule(rule)
+    names = {param.name for param in rule.params}
+    referenced = {rule.window_hours} | {
+        value for leaf in plan.leaves for value in [leaf.threshold, leaf.duration]
+    }
+    unknown = {value for value in referenced if isinstance(value, str)} - names
+    if len(unknown) != 0:
+        raise ValueError(f"Unknown parameters in rule {rule.name}: {sorted(unknown)}")
+    for leaf in plan.leaves:
+        if leaf.comparison not in COMPARISONS:
+            raise ValueError(
+                f"Comparison of {leaf.code} in rule {rule.name} is not one of {list(COMPARISONS)}"
+            )
+        if plan.aligned and leaf.duration is not None:
+            raise ValueError(
+                f"Durations only apply to rules on one code, rule {rule.name} has {plan.codes}"
+            )
+    if plan.anchor not in plan.codes:
+        raise ValueError(f"Anchor {plan.anchor} of rule {rule.name} is not compared")
+    return plan
+
+
+def _resolve(value: Value, params: Dict[str, float]) -> float:
+    return params[value] if isinstance(value, str) else value
+
+
+def _grid_values(value: Value, grid: Dict[str, np.ndarray]) -> np.ndarray:
+    return np.asarray(grid[value] if isinstance(value, str) else [value])
+
+
+def _arrange(
+    table: np.ndarray, axes: Sequence[Value], grid: Dict[str, np.ndarray]
+) -> np.ndarray:
+    """Table with one axis per value of axes, as an array with one axis per parameter of grid"""
+    names = list(grid)
+    shape = tuple(len(values) for values in grid.values())
+    indices = np.indices(shape, sparse=True)
+    index = tuple(indices[names.index(a)] if isinstance(a, str) else 0 for a in axes)
+    return np.broadcast_to(table[index], shape).copy()
+
+
+class RuleEvaluator:
+    """Compiled rule bound to the samples of a partition, evaluated for any parameters.
+
+    Sorted samples and alignments do not depend on thresholds, they are built once
+    and moving a slider only compares arrays again.
+    """
+
+    def __init__(self, plan: CompiledRule, samples: PCodePartition):
+        self.plan = plan
+        self.samples = samples
+        data = samples.get(plan.codes, COLUMNS)
+        if plan.rule.dropna:
+            data = data.dropna(subset=[VALUE])
+        self.data: pd.DataFrame = data
+        self._alignments: Dict[float, SampleAlignment] = {}
+        self._streaks: Optional[StreakIndex] = None
+
+    @property
+    def streaks(self) -> StreakIndex:
+        """Samples sorted by patient and date, for comparisons with a duration"""
+        if self._streaks is None:
+            if self.plan.rule.dropna:
+                self._streaks = StreakIndex(self.data, VALUE, PATIENT_ID, SAMPLE_TIME)
+            else:
+                # rows of the code in the order shared with other diagnostics reading it
+                analyte = self.samples.analyte(self.plan.codes[0])
+                self._streaks = StreakIndex.from_analyte(analyte)
+        return self._streaks
+
+    def alignment(self, window_hours: float) -> SampleAlignment:
+        """Samples of the anchor paired with samples of the other codes drawn within window_hours"""
+        window_hours = float(window_hours)
+        if window_hours not in self._alignments:
+            # samples without value are not paired, dropna does not change points
+            points = {
+                code: self.samples.analyte(code).points() for code in self.plan.codes
+            }
+            self._alignments[window_hours] = SampleAlignment(
+                points, self.plan.anchor, window_hours
+            )
+        return self._alignments[window_hours]
+
+    def _mask(
+        self,
+        leaf: Compare,
+        params: Dict[str, float],
+        memo: Optional[Dict[Hashable, np.ndarray]] = None,
+    ) -> np.ndarray:
+        """Positive rows, or anchors for aligned rules, of one comparison"""
+        threshold = _resolve(leaf.threshold, params) * leaf.scale
+        window_hours = _resolve(self.plan.rule.window_hours, params)
+        duration = None
+        if leaf.duration is not None:
+            duration = _resolve(leaf.duration, params) * leaf.hours_per_unit
+        key = (leaf, threshold, duration, window_hours)
+        if memo is not None and key in memo:
+            return memo[key]
+
+        compare = COMPARISONS[leaf.comparison]
+        if self.plan.aligned:
+            mask = compare(self.alignment(window_hours).values(leaf.code), threshold)
+        elif duration is None:
+            mask = compare(self.data[VALUE].to_numpy(), threshold)
+        else:
+            mask = self.streaks.detect(
+                threshold, duration, below=leaf.comparison == "<"
+            ).to_numpy()
+        if memo is not None:
+            memo[key] = mask
+        return mask
+
+    def _positive(
+        self,
+        params: Dict[str, float],
+        memo: Optional[Dict[Hashable, np.ndarray]] = None,
+    ) -> np.ndarray:
+        """Positive rows, or anchors for aligned rules, of the rule"""
+        return self.plan.combine(
+            [self._mask(leaf, params, memo) for leaf in self.plan.leaves]
+        )
+
+    def detect(self, params: Dict[str, float]) -> pd.Series:
+        """Boolean detection of the rows of data for params, a value per parameter of the rule"""
+        positive = self._positive(params)
+        if self.plan.aligned:
+            window_hours = _resolve(self.plan.rule.window_hours, params)
+            return self.alignment(window_hours).detect(self.data, positive)
+        return pd.Series(positive, index=self.data.index)
+
+    def count_positive_patients(self, grid: Dict[str, np.ndarray]) -> np.ndarray:
+        """Number of positive patients, with one axis per parameter of grid, in the order of the rule"""
+        grid = {
+            param.name: np.asarray(grid[param.name]) for param in self.plan.rule.params
+        }
+        if isinstance(self.plan.rule.condition, Compare):
+            return self._count_for_comparison(self.plan.rule.condition, grid)
+
+        # every combination, comparisons shared by combinations are evaluated once
+        memo: Dict[Hashable, np.ndarray] = {}
+        counts = np.zeros(tuple(len(values) for values in grid.values()), dtype=int)
+        for index in np.ndindex(*counts.shape):
+            params = {name: grid[name][i] for name, i in zip(grid, index)}
+            positive = self._positive(params, memo)
+            if self.plan.aligned:
+                window_hours = _resolve(self.plan.rule.window_hours, params)
+                patients = self.alignment(window_hours).patients
+            else:
+                patients = self.data[PATIENT_ID].to_numpy()
+            counts[index] = len(np.unique(patients[positive]))
+        return counts
+
+    def _count_for_comparison(
+        self, leaf: Compare, grid: Dict[str, np.ndarray]
+    ) -> np.ndarray:
+        """Counts of a rule of one comparison, from one value per patient instead of every combination"""
+        thresholds = _grid_values(leaf.threshold, grid) * leaf.scale
+        below = leaf.comparison == "<"
+        if leaf.duration is None:
+            # a patient is positive when its highest, or lowest, value is
+            analyte = self.samples.analyte(leaf.code)
+            if below:
+                table = count_above(-analyte.min_per_patient(), -thresholds)
+            else:
+                table = count_above(analyte.max_per_patient(), thresholds)
+            return _arrange(table[:, None], [leaf.threshold, None], grid)
+
+        # a patient is positive when its longest streak is longer than the duration
+        durations = _grid_values(leaf.duration, grid) * leaf.hours_per_unit
+        table = np.stack(
+            [
+                count_above(
+                    self.streaks.longest_positive_streak(threshold, below=below),
+                    durations,
+                )
+                for threshold in thresholds
+            ]
+        )
+        return _arrange(table, [leaf.threshold, leaf.duration], grid)
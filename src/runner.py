@@ -0,0 +1,265 @@
+"""Run diagnostics concurrently in a pool of processes.
+
+The merged samples are written once as an uncompressed Feather file in the cache folder,
+each worker memory-maps it and copies only the columns diagnostics read and the rows of the
+P_CODE of its task, keeping them between runs, so moving a slider
+only sends the class name and parameters of each diagnostic to the workers, and only
+their DETECTION column comes back. Diagnostics reading the same P_CODE run in the same
+task, so the samples they share are sorted once (see plan_groups).
+
+    run_detections(samples, diagnostics)  # or parallel=False to run in this process
+
+Workers may start before the diagnostics are built in this process, by class name and parameters:
+
+    pending = start_detections(samples, [("Diagnose1", params)])
+    diagnostics = [Diagnose1(samples)]  # built meanwhile, with the same parameters
+    pending.collect(diagnostics)
+"""
+import os
+import uuid
+import weakref
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+from src import cache
+from src.constants import *
+from src.diagnostics import DiagnosticClasses
+from src.diagnostics import DIAGNOSTICS_BY_NAME
+from src.diagnostics import DiagnoseTypes
+from src.instrumentation import stage
+from src.partition import PCodePartition
+
+# MTX_PARALLEL=0 runs diagnostics one after another in the Streamlit process
+PARALLEL = os.environ.get("MTX_PARALLEL", "1") != "0"
+MAX_WORKERS = int(os.environ.get("MTX_MAX_WORKERS", os.cpu_count() or 1))
+
+# class name and parameters of a diagnostic
+Task = Tuple[str, Dict[str, Any]]
+# DETECTION column computed by a worker, or its data when detection changed the rows,
+# None when the diagnostic detects nothing
+Result = Union[np.ndarray, pd.DataFrame, None]
+
+# pool and its number of workers
+_executor: Optional[Tuple[ProcessPoolExecutor, int]] = None
+
+# columns read by the diagnostics, the others are not copied into workers
+WORKER_COLUMNS = [
+    PATIENT_ID,
+    SAMPLE_TIME,
+    P_CODE,
+    VALUE,
+    REF_PATIENT,
+    INFUSION_NO,
+    DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE,
+    SEX,
+    MP6_STOP,
+]
+
+# partitions already read by this worker process, by path of the shared file and P_CODE read
+_worker_partitions: Dict[Tuple[str, Tuple[str, ...]], PCodePartition] = {}
+
+
+def _get_executor(max_workers: int) -> ProcessPoolExecutor:
+    """Pool kept alive between Streamlit reruns, workers keep their partitions in memory"""
+    global _executor
+    if _executor is None or _executor[1] != max_workers:
+        _shutdown_executor()
+        _executor = (ProcessPoolExecutor(max_workers=max_workers), max_workers)
+    return _executor[0]
+
+
+def _shutdown_executor() -> None:
+    """Drop the pool, the next run starts a new one, after a worker was killed for instance"""
+    global _executor
+    if _executor is not None:
+        _executor[0].shutdown(wait=False)
+        _executor = None
+
+
+def _remove_shared(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # still mapped by a worker on Windows, or never written
+
+
+def share(samples: PCodePartition) -> Optional[str]:
+    """Path of a Feather file with the data of samples, written once per partition.
+
+    The file is removed when the partition is garbage collected, after a filter change for instance.
+    Returns None when the data can not be written in Arrow format, diagnostics then run serially.
+    """
+    token = samples.memoize("shared feather", lambda: uuid.uuid4().hex)
+    path = os.path.join(cache.CACHE_DIR, f"shared-{token}.feather")
+    if os.path.exists(path):
+        return path
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache.CACHE_DIR, exist_ok=True)
+        table = pa.Table.from_pandas(samples.data, preserve_index=True)
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)
+    except (pa.ArrowException, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    weakref.finalize(samples, _remove_shared, path)
+    return path
+
+
+def plan_groups(diagnostics: List[DiagnoseTypes]) -> List[List[DiagnoseTypes]]:
+    """Diagnostics grouped when they read a same P_CODE, directly or through another diagnostic of the group.
+
+    Groups keep the order of diagnostics, by their first diagnostic.
+    """
+    groups: List[List[DiagnoseTypes]] = []
+    codes: List[Set[str]] = []
+    for diagnostic in diagnostics:
+        group, group_codes = [diagnostic], set(diagnostic.CODES)
+        shared = [i for i, other in enumerate(codes) if other & group_codes]
+        # merged into the first group sharing a code, with the other groups sharing one
+        for i in reversed(shared):
+            group = groups.pop(i) + group
+            group_codes |= codes.pop(i)
+        position = shared[0] if len(shared) != 0 else len(groups)
+        groups.insert(position, group)
+        codes.insert(position, group_codes)
+    return groups
+
+
+def read_shared(path: str, codes: List[str]) -> pd.DataFrame:
+    """Rows of P_CODE codes of a file written by share, with the columns diagnostics read.
+
+    The file is memory-mapped, only the selected rows and columns are copied in memory.
+    """
+    table = feather.read_table(path, memory_map=True)
+    index = [
+        c for c in table.schema.pandas_metadata["index_columns"] if isinstance(c, str)
+    ]
+    columns = [c for c in WORKER_COLUMNS if c in table.schema.names] + index
+    rows = pc.is_in(table[P_CODE], value_set=pa.array(codes, type=pa.string()))
+    return table.select(columns).filter(rows).to_pandas(split_blocks=True)
+
+
+def _run_in_worker(path: str, tasks: List[Task]) -> List[Result]:
+    """Detections of each diagnostic of tasks, given by class name and parameters"""
+    classes = [DIAGNOSTICS_BY_NAME[class_name] for class_name, _ in tasks]
+    codes = tuple(sorted({code for cls in classes for code in cls.CODES}))
+    key = (path, codes)
+    if key not in _worker_partitions:
+        if any(shared != path for shared, _ in _worker_partitions):
+            _worker_partitions.clear()  # only the latest dataset is kept per worker
+        _worker_partitions[key] = PCodePartition(read_shared(path, list(codes)))
+    results: List[Result] = []
+    for class_name, params in tasks:
+        diagnostic = DIAGNOSTICS_BY_NAME[class_name](_worker_partitions[key])
+        diagnostic.set_params(**params)
+        rows = diagnostic.data.index
+        diagnostic.run_detection()
+        data = diagnostic.data
+        if DETECTION not in data.columns:
+            results.append(None)
+        elif data.index.equals(rows):
+            # the diagnostic built in the parent has the same rows, only the column is sent back
+            results.append(data[DETECTION].to_numpy())
+        else:
+            results.append(data)
+    return results
+
+
+class PendingDetections:
+    """Detections started in worker processes, collected by the diagnostics of their tasks"""
+
+    def __init__(self, futures: Dict[str, Tuple[Task, "Future[List[Result]]", int]]):
+        # task, future of its group and position in the group, by class name
+        self.futures = futures
+
+    def collect(self, diagnostics: List[DiagnoseTypes]) -> None:
+        """Set the DETECTION column of diagnostics, built with the class and parameters of a task.
+
+        Diagnostics without a task, or whose worker failed, run detection in this process.
+        """
+        for diagnostic in diagnostics:
+            class_name = type(diagnostic).__name__
+            if class_name not in self.futures:
+                diagnostic.run_detection()
+                continue
+            (_, params), future, position = self.futures[class_name]
+            if params != diagnostic.get_params():
+                diagnostic.run_detection()
+                continue
+            try:
+                with stage(f"{class_name}.run_detection in worker"):
+                    result = future.result()[position]
+            except BrokenProcessPool:
+                # a worker was killed, the pool can not run tasks anymore
+                _shutdown_executor()
+                diagnostic.run_detection()
+                continue
+            except (OSError, pa.ArrowException):
+                # shared file removed meanwhile, with its partition
+                diagnostic.run_detection()
+                continue
+            if isinstance(result, pd.DataFrame):
+                diagnostic.data = result
+            elif result is None:
+                continue
+            elif len(result) == len(diagnostic.data):
+                diagnostic.data = diagnostic.data.assign(**{DETECTION: result})
+            else:
+                diagnostic.run_detection()
+
+
+def start_detections(
+    samples: PCodePartition,
+    tasks: List[Task],
+    parallel: bool = PARALLEL,
+    max_workers: int = MAX_WORKERS,
+) -> PendingDetections:
+    """Submit tasks to worker processes, one group of diagnostics reading the same P_CODE per process.
+
+    Nothing is submitted when running serially, diagnostics then run in collect.
+    """
+    tasks = [task for task in tasks if task[0] in DIAGNOSTICS_BY_NAME]
+    path = None
+    if parallel and max_workers > 1 and len(tasks) > 1 and cache.CACHE_DIR:
+        path = share(samples)
+    if path is None:
+        return PendingDetections({})
+
+    by_name = dict(tasks)
+    groups = plan_groups([DIAGNOSTICS_BY_NAME[name] for name in by_name])
+    workers = min(max_workers, len(DiagnosticClasses))
+    futures = {}
+    for group in groups:
+        group_tasks = [(cls.__name__, by_name[cls.__name__]) for cls in group]
+        try:
+            future = _get_executor(workers).submit(_run_in_worker, path, group_tasks)
+        except BrokenProcessPool:
+            _shutdown_executor()
+            future = _get_executor(workers).submit(_run_in_worker, path, group_tasks)
+        for position, task in enumerate(group_tasks):
+            futures[task[0]] = (task, future, position)
+    return PendingDetections(futures)
+
+
+def run_detections(
+    samples: PCodePartition,
+    diagnostics: List[DiagnoseTypes],
+    parallel: bool = PARALLEL,
+    max_workers: int = MAX_WORKERS,
+) -> None:
+    """Same as calling run_detection of each diagnostic, built on samples, with one group of diagnostics
+    reading the same P_CODE per process.
+    """
+    tasks = [(type(d).__name__, d.get_params()) for d in diagnostics]
+    start_detections(samples, tasks, parallel, max_workers).collect(diagnostics)
@@ -0,0 +1,368 @@
+"""Detections of past runs in a local SQLite file, reruns and new sessions read them back instead of recomputing.
+
+A run is identified by the content hash of the dataset, the class name of the diagnostic and the hash
+of its parameters. Each run stores the detection of every sample of the diagnostic data as a bitmap,
+and one row per patient and treatment number (INFNO), indexed so queries on a cohort are answered
+without running detection. Positive samples are read from the data of the diagnostic with the bitmap.
+
+    store = ResultStore("results.sqlite")
+    pending = store.restore(dataset, diagnostics)  # diagnostics without stored detection
+    run_detections(samples, pending)
+    store.save(dataset, pending)  # or save_in_background
+    store.positive_patients(dataset, "Diagnose2", params, infusion_no=(3, 5), sex=2)
+
+Runs not read back for RESULTS_MAX_AGE_DAYS, then the least recently used above RESULTS_MAX_SIZE_MB,
+are removed after each save, as the disk cache does (see cache.evict).
+Bump RESULTS_VERSION when the detection logic or the schema changes: it is kept as the user_version of the file,
+and a file of another version is emptied on opening, so results of older code are not read back.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.diagnostics import DiagnoseTypes
+from src.instrumentation import record_cache_lookup
+
+logger = logging.getLogger(__name__)
+
+RESULTS_VERSION = 2
+
+# path of the SQLite file, the store is disabled without it
+RESULTS_DB = os.environ.get("MTX_RESULTS_DB", "")
+RESULTS_MAX_SIZE_MB = float(os.environ.get("MTX_RESULTS_MAX_SIZE_MB", 1024))
+RESULTS_MAX_AGE_DAYS = float(os.environ.get("MTX_RESULTS_MAX_AGE_DAYS", 30))
+
+# one value, or an inclusive range of values
+Selection = Union[int, Tuple[int, int]]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    diagnostic TEXT NOT NULL,
+    params_hash TEXT NOT NULL,
+    params TEXT NOT NULL,
+    n_samples INTEGER NOT NULL,
+    detection BLOB NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    UNIQUE (dataset, diagnostic, params_hash)
+);
+CREATE TABLE IF NOT EXISTS patients (
+    run_id INTEGER NOT NULL REFERENCES runs ON DELETE CASCADE,
+    patient_id INTEGER NOT NULL,
+    infusion_no INTEGER,
+    sex INTEGER,
+    n_samples INTEGER NOT NULL,
+    n_positive INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS patients_positive
+    ON patients (run_id, n_positive, infusion_no, sex, patient_id);
+CREATE INDEX IF NOT EXISTS runs_last_used ON runs (last_used);
+"""
+
+
+def params_hash(params: Dict[str, Any]) -> str:
+    """Hash of parameters, the same for equal values whatever their numeric type"""
+    canonical = {
+        name: float(value) if isinstance(value, (int, float, np.number)) else value
+        for name, value in params.items()
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+def results_key(
+    dataset: str, treatments: Sequence[int] = (), streamed: bool = False
+) -> str:
+    """Key of the samples diagnostics run on: the content hash of the dataset, filtered by treatment numbers.
+    Samples read in chunks may come in another order, their detections are stored apart.
+    """
+    key = dataset + ("-streamed" if streamed else "")
+    if len(treatments) != 0:
+        key += "-INFNO-" + "-".join(str(t) for t in sorted(treatments))
+    return key
+
+
+def _between(column: str, selection: Optional[Selection]) -> Tuple[str, List[int]]:
+    """SQL condition on column for a value or an inclusive range, always true without selection"""
+    if selection is None:
+        return "1", []
+    if isinstance(selection, tuple):
+        return f"{column} BETWEEN ? AND ?", [int(selection[0]), int(selection[1])]
+    return f"{column} = ?", [int(selection)]
+
+
+def _nullable(values: pd.Series) -> List[float]:
+    """Numbers as Python floats for SQLite: NaN is bound as NULL and integer columns store 3.0 as 3"""
+    return values.to_numpy(dtype=float, na_value=np.nan).tolist()
+
+
+class ResultStore:
+    """Detections of runs of diagnostics, keyed by dataset, diagnostic class name and parameters"""
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._connect() as conn:
+            # pages of removed runs are given back to the file system, only effective on a new file
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            if version != RESULTS_VERSION:
+                conn.execute("DROP TABLE IF EXISTS patients")
+                conn.execute("DROP TABLE IF EXISTS runs")
+            conn.executescript(SCHEMA)
+            conn.execute(f"PRAGMA user_version = {RESULTS_VERSION}")
+        # one writer, saves of sessions are queued instead of waiting for the lock of the file
+        self._writer = ThreadPoolExecutor(max_workers=1)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Connection committed on exit, one per call as sessions run in several threads"""
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            # readers do not wait for a session writing its results
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            with conn:
+                yield conn
+
+    def _run_id(
+        self, conn: sqlite3.Connection, dataset: str, diagnostic: str, params: Dict
+    ) -> Optional[int]:
+        row = conn.execute(
+            "SELECT run_id FROM runs WHERE dataset = ? AND diagnostic = ? AND params_hash = ?",
+            (dataset, diagnostic, params_hash(params)),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, dataset: str, diagnostics: Sequence[DiagnoseTypes]) -> None:
+        """Store the detection of diagnostics run on the dataset, replacing runs with the same parameters"""
+        for diagnostic in diagnostics:
+            if DETECTION in diagnostic.data.columns:
+                self._save_run(
+                    dataset,
+                    type(diagnostic).__name__,
+                    diagnostic.get_params(),
+                    diagnostic.data,
+                )
+        self.evict()
+
+    def save_in_background(
+        self, dataset: str, diagnostics: Sequence[DiagnoseTypes]
+    ) -> "Future[None]":
+        """Same as save in a thread of the store, the caller does not wait for the file to be written"""
+        # data of diagnostics may be replaced by the next run, the frames of this run are kept
+        runs = [
+            (type(d).__name__, d.get_params(), d.data)
+            for d in diagnostics
+            if DETECTION in d.data.columns
+        ]
+
+        def save() -> None:
+            for diagnostic, params, data in runs:
+                self._save_run(dataset, diagnostic, params, data)
+            self.evict()
+
+        future = self._writer.submit(save)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def _save_run(
+        self, dataset: str, diagnostic: str, params: Dict[str, Any], data: pd.DataFrame
+    ) -> None:
+        detection = data[DETECTION].to_numpy(dtype=bool)
+        columns = data.reindex(columns=[PATIENT_ID, INFUSION_NO, SEX])
+        per_patient = (
+            columns.assign(**{DETECTION: detection})
+            .groupby([PATIENT_ID, INFUSION_NO], dropna=False, sort=False)
+            .agg(
+                sex=(SEX, "first"),
+                n_samples=(DETECTION, "size"),
+                n_positive=(DETECTION, "sum"),
+            )
+            .reset_index()
+        )
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM runs WHERE dataset = ? AND diagnostic = ? AND params_hash = ?",
+                (dataset, diagnostic, params_hash(params)),
+            )
+            run_id = conn.execute(
+                "INSERT INTO runs (dataset, diagnostic, params_hash, params, "
+                "n_samples, detection, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    dataset,
+                    diagnostic,
+                    params_hash(params),
+                    json.dumps(params, default=float),
+                    len(detection),
+                    np.packbits(detection).tobytes(),
+                    now,
+                    now,
+                ),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO patients VALUES (?, ?, ?, ?, ?, ?)",
+                zip(
+                    [run_id] * len(per_patient),
+                    _nullable(per_patient[PATIENT_ID]),
+                    _nullable(per_patient[INFUSION_NO]),
+                    _nullable(per_patient["sex"]),
+                    _nullable(per_patient["n_samples"]),
+                    _nullable(per_patient["n_positive"]),
+                ),
+            )
+
+    def evict(
+        self,
+        max_size_mb: float = RESULTS_MAX_SIZE_MB,
+        max_age_days: float = RESULTS_MAX_AGE_DAYS,
+    ) -> None:
+        """Remove runs not read back for max_age_days, then least recently used runs above max_size_mb"""
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM runs WHERE last_used < ?",
+                (time.time() - max_age_days * 24 * 3600,),
+            )
+            while _used_mb(conn) > max_size_mb:
+                removed = conn.execute(
+                    "DELETE FROM runs WHERE run_id = "
+                    "(SELECT run_id FROM runs ORDER BY last_used LIMIT 1)"
+                ).rowcount
+                if removed == 0:
+                    break
+        with self._connect() as conn:
+            conn.execute("PRAGMA incremental_vacuum")
+
+    def has(self, dataset: str, diagnostic: str, params: Dict[str, Any]) -> bool:
+        """Whether a run of the diagnostic with these parameters is stored for the dataset"""
+        with self._connect() as conn:
+            return self._run_id(conn, dataset, diagnostic, params) is not None
+
+    def detection(
+        self, dataset: str, diagnostic: str, params: Dict[str, Any]
+    ) -> Optional[np.ndarray]:
+        """Stored detection of each sample of the diagnostic data, None when this run is not stored"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT run_id, n_samples, detection FROM runs "
+                "WHERE dataset = ? AND diagnostic = ? AND params_hash = ?",
+                (dataset, diagnostic, params_hash(params)),
+            ).fetchone()
+            if row is None:
+                return None
+            run_id, n_samples, bitmap = row
+            # most recently used, last to be evicted
+            conn.execute(
+                "UPDATE runs SET last_used = ? WHERE run_id = ?", (time.time(), run_id)
+            )
+        bits = np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8), count=n_samples)
+        return bits.astype(bool)
+
+    def restore(
+        self, dataset: str, diagnostics: Sequence[DiagnoseTypes]
+    ) -> List[DiagnoseTypes]:
+        """Set the DETECTION column of diagnostics with a stored run, return the diagnostics still to run"""
+        pending = []
+        for diagnostic in diagnostics:
+            detection = self.detection(
+                dataset, type(diagnostic).__name__, diagnostic.get_params()
+            )
+            # the data of a diagnostic may change with its code, a stored run must match it row for row
+            hit = detection is not None and len(detection) == len(diagnostic.data)
+            record_cache_lookup("results store", hit=hit)
+            if hit:
+                diagnostic.data = diagnostic.data.assign(**{DETECTION: detection})
+            else:
+                pending.append(diagnostic)
+        return pending
+
+    def positive_patients(
+        self,
+        dataset: str,
+        diagnostic: str,
+        params: Dict[str, Any],
+        infusion_no: Optional[Selection] = None,
+        sex: Optional[Selection] = None,
+    ) -> Optional[List[int]]:
+        """Patients with a positive sample for a run, in treatments infusion_no and of sex.
+
+        Parameters
+        ----------
+        dataset
+            Content hash of the dataset the diagnostic ran on
+
+        diagnostic
+            Class name of the diagnostic, eg. "Diagnose2"
+
+        params
+            Parameters of the diagnostic, all of them as given by get_params
+
+        infusion_no, sex
+            A value or an inclusive range (low, high), all patients when None
+
+        Returns
+        -------
+        Optional[List[int]]
+            Sorted patient ids, None when this run is not stored
+        """
+        on_infusion, infusion_args = _between("infusion_no", infusion_no)
+        on_sex, sex_args = _between("sex", sex)
+        with self._connect() as conn:
+            run_id = self._run_id(conn, dataset, diagnostic, params)
+            if run_id is None:
+                return None
+            rows = conn.execute(
+                "SELECT DISTINCT patient_id FROM patients "
+                f"WHERE run_id = ? AND n_positive > 0 AND {on_infusion} AND {on_sex} "
+                "ORDER BY patient_id",
+                [run_id] + infusion_args + sex_args,
+            ).fetchall()
+        return [patient_id for (patient_id,) in rows]
+
+    def positive_samples(
+        self, dataset: str, diagnostic: DiagnoseTypes, patient_id: Optional[int] = None
+    ) -> Optional[pd.DataFrame]:
+        """Positive samples of the stored run of diagnostic, of one patient or all of them.
+
+        They are the rows of the diagnostic data selected by the stored detection,
+        None when this run is not stored or was stored for other data.
+        """
+        detection = self.detection(
+            dataset, type(diagnostic).__name__, diagnostic.get_params()
+        )
+        if detection is None or len(detection) != len(diagnostic.data):
+            return None
+        positive = diagnostic.data.loc[detection].reindex(
+            columns=[PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO]
+        )
+        if patient_id is not None:
+            positive = positive[positive[PATIENT_ID] == patient_id]
+        return positive.reset_index(drop=True)
+
+
+def _used_mb(conn: sqlite3.Connection) -> float:
+    """Size of the pages of the file holding data"""
+    (page_count,) = conn.execute("PRAGMA page_count").fetchone()
+    (free_pages,) = conn.execute("PRAGMA freelist_count").fetchone()
+    (page_size,) = conn.execute("PRAGMA page_size").fetchone()
+    return (page_count - free_pages) * page_size / 1024 / 1024
+
+
+def _log_failure(future: "Future[None]") -> None:
+    if future.exception() is not None:
+        logger.error("Detections could not be stored", exc_info=future.exception())
@@ -0,0 +1,226 @@
+"""Ingest samples exports larger than memory, chunk by chunk.
+
+Each chunk of samples is parsed, assigned to its treatment and appended to a Parquet file,
+so peak memory while parsing depends on the memory budget and not on the size of the export.
+Samples read back are held in memory, only those of the P_CODE given to read_samples_with_treatment.
+
+    path, rejected = stream_samples_to_treatment("samples.csv", infusion_times, "merged.parquet")
+    samples_with_treatment_no = read_samples_with_treatment(path, ["NPU02902", "NPU18016"])
+"""
+import hashlib
+import os
+import tempfile
+from itertools import islice
+from typing import Callable, Collection, List, Optional, Tuple
+
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src import cache
+from src.constants import *
+from src.dataset import assign_samples_to_treatment
+from src.dataset import cast_to_schema
+from src.dataset import clean_samples
+from src.dataset import is_csv
+from src.instrumentation import instrumented
+from src.instrumentation import record_cache_lookup
+
+MEMORY_BUDGET_MB = float(os.environ.get("MTX_INGEST_MEMORY_MB", 1024))
+
+# peak memory while a chunk is parsed and assigned to treatments, relative to its parsed size
+CHUNK_MEMORY_FACTOR = 8
+PROBE_ROWS = 10_000
+MIN_CHUNK_ROWS = 1_000
+# files of streamed samples in the cache folder, evicted apart from parsed entries
+STREAMED_PREFIX = "samples_with_treatment-"
+
+ChunkReader = Callable[[int], Optional[pd.DataFrame]]
+
+
+def _csv_reader(source) -> ChunkReader:
+    reader = pd.read_csv(source, dtype={SAMPLE_TIME: object}, iterator=True)
+
+    def read(n_rows: int) -> Optional[pd.DataFrame]:
+        try:
+            return reader.get_chunk(n_rows)
+        except StopIteration:
+            return None
+
+    return read
+
+
+def _xlsx_reader(source) -> ChunkReader:
+    # read_only streams the sheet instead of loading all cells
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    rows = workbook.active.iter_rows(values_only=True)
+    header = next(rows)
+    # same names as pd.read_excel for the unnamed index column
+    columns = [
+        f"Unnamed: {i}" if name is None else name for i, name in enumerate(header)
+    ]
+
+    def read(n_rows: int) -> Optional[pd.DataFrame]:
+        batch = list(islice(rows, n_rows))
+        if len(batch) == 0:
+            workbook.close()
+            return None
+        return pd.DataFrame(batch, columns=columns)
+
+    return read
+
+
+def chunk_rows_for_budget(chunk: pd.DataFrame, memory_budget_mb: float) -> int:
+    """Number of rows per chunk so a chunk like this one is processed within memory_budget_mb"""
+    bytes_per_row = chunk.memory_usage(deep=True).sum() / max(len(chunk), 1)
+    n_rows = memory_budget_mb * 1024 * 1024 / (CHUNK_MEMORY_FACTOR * bytes_per_row)
+    return max(int(n_rows), MIN_CHUNK_ROWS)
+
+
+def _to_arrow(chunk: pd.DataFrame, schema: Optional[pa.Schema]) -> pa.Table:
+    """Table of chunk with the schema of the first chunk, so all chunks can go in the same file"""
+    # text columns can hold numbers in some chunks only, store them as text
+    for column in chunk.columns[chunk.dtypes == object]:
+        chunk[column] = chunk[column].where(
+            chunk[column].isnull(), chunk[column].astype(str)
+        )
+    table = pa.Table.from_pandas(chunk, preserve_index=False)
+    if schema is not None:
+        return table.cast(schema)
+
+    # categories of each chunk differ, they are stored as text and read back as categories.
+    # Columns out of SAMPLES_SCHEMA missing or integer in the first chunk may be text or decimal later on
+    fields = []
+    for field in table.schema:
+        if pa.types.is_null(field.type) or pa.types.is_dictionary(field.type):
+            field = field.with_type(pa.string())
+        elif pa.types.is_integer(field.type) and field.name not in SAMPLES_SCHEMA:
+            field = field.with_type(pa.float64())
+        fields.append(field)
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+
+def read_samples_with_treatment(
+    path: str, codes: Optional[Collection[str]] = None
+) -> pd.DataFrame:
+    """Read samples written by stream_samples_to_treatment, in the types of SAMPLES_SCHEMA.
+
+    With codes, only samples of those P_CODE are read, so memory holds the samples diagnostics read
+    and not the whole export.
+    """
+    categories = [c for c, t in SAMPLES_SCHEMA.items() if t == "category"]
+    names = pq.read_schema(path).names
+    return pq.read_table(
+        path,
+        read_dictionary=[c for c in categories if c in names],
+        filters=None if codes is None else [(P_CODE, "in", sorted(codes))],
+    ).to_pandas()
+
+
+def stream_samples_to_treatment(
+    source,
+    infusion_times: pd.DataFrame,
+    output_path: str,
+    memory_budget_mb: float = MEMORY_BUDGET_MB,
+) -> Tuple[str, pd.DataFrame]:
+    """Same as read_samples then assign_samples_to_treatment and cast_to_schema, without holding all samples in memory.
+
+    Parameters
+    ----------
+    source
+        Path or file-like object of the samples export, xlsx or CSV
+
+    infusion_times
+        Infusion times without duplicate treatments, kept in memory
+
+    output_path
+        Parquet file receiving the samples with their treatment
+
+    memory_budget_mb
+        Approximate peak memory used to process one chunk
+
+    Returns
+    -------
+    Tuple[str, pd.DataFrame]
+        output_path, and the rows whose SAMPLE_TIME could not be parsed
+    """
+    read = _csv_reader(source) if is_csv(source) else _xlsx_reader(source)
+
+    chunk = read(PROBE_ROWS)
+    chunk_rows = None
+    writer = None
+    rejected: List[pd.DataFrame] = []
+    try:
+        while chunk is not None:
+            if chunk_rows is None:
+                chunk_rows = chunk_rows_for_budget(chunk, memory_budget_mb)
+
+            samples, unparsed = clean_samples(chunk)
+            rejected.append(unparsed)
+            table = _to_arrow(
+                cast_to_schema(
+                    assign_samples_to_treatment(samples, infusion_times)
+                ).reset_index(drop=True),
+                writer.schema if writer is not None else None,
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+
+            chunk = read(chunk_rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError("No samples found in the samples file")
+
+    return output_path, pd.concat(rejected, ignore_index=True)
+
+
+def frame_hash(df: pd.DataFrame) -> str:
+    """Hash of the values of df whatever the order of its rows, rows are sorted before hashing"""
+    rows = df.sort_values(list(df.columns)).reset_index(drop=True)
+    hashes = pd.util.hash_pandas_object(rows, index=False).to_numpy()
+    return hashlib.sha256(hashes.tobytes()).hexdigest()
+
+
+@instrumented("load_samples_with_treatment")
+def load_samples_with_treatment(
+    samples_buffer,
+    infusion_times: pd.DataFrame,
+    memory_budget_mb: float,
+    codes: Optional[Collection[str]] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Samples assigned to their treatment, streamed once per file content to a Parquet file of the disk cache.
+
+    With codes, only samples of those P_CODE are read back in memory.
+    """
+    key = "-".join(
+        [
+            f"{STREAMED_PREFIX}v{cache.CACHE_VERSION}",
+            cache.file_hash(samples_buffer),
+            frame_hash(infusion_times),
+        ]
+    )
+    folder = cache.CACHE_DIR or tempfile.gettempdir()
+    path = os.path.join(folder, f"{key}.parquet")
+    rejected_path = os.path.join(folder, f"{key}.rejected.parquet")
+    is_cached = os.path.exists(path) and os.path.exists(rejected_path)
+    record_cache_lookup("disk samples_with_treatment", hit=is_cached)
+    if not is_cached:
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            _, rejected = stream_samples_to_treatment(
+                samples_buffer, infusion_times, tmp_path, memory_budget_mb
+            )
+            rejected.astype(str).to_parquet(rejected_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            # a partial file would be left in the cache folder, as large as the export
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        cache.evict(prefix=STREAMED_PREFIX)
+    return read_samples_with_treatment(path, codes), pd.read_parquet(rejected_path)
@@ -0,0 +1,256 @@
+"""Generate a synthetic cohort, in the format of the samples and infusion times exports.
+
+Patients receive an infusion of high dose MTX every 14 days. MTX is sampled after each infusion
+and follows an elimination curve, delayed for a fraction of treatments which then also raise creatinine.
+Other analytes are sampled at random times around a typical value. The same seed gives the same files.
+
+    python -m src.synthetic --patients 500 --samples-per-analyte 40 --output-dir data/
+"""
+import argparse
+import os
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+
+MTX_CODE = "NPU02739"
+CREA_CODE = "NPU18016"
+
+# typical value of the analytes read by the diagnostics
+ANALYTES = {
+    "NPU02902": 2.0,
+    "NPU19748": 5.0,
+    "NPU19651": 40.0,
+    "NPU01684": 1.0,
+    "NPU01370": 8.0,
+    CREA_CODE: 35.0,
+    "NPU03568": 250.0,
+    "NPU19652": 60.0,
+    "NPU19653": 20.0,
+    "DNK05451": 150.0,
+    MTX_CODE: 70.0,
+}
+REFERENCE_TEXT = "<8,0"
+
+DAYS_BEFORE_FIRST_INFUSION = 14
+DAYS_BETWEEN_INFUSIONS = 14
+INFUSION_HOURS = 24
+# hours after the start of an infusion when MTX is sampled
+MTX_SAMPLE_HOURS = [23, 36, 42, 48, 66, 72, 90, 96]
+MTX_HALF_LIFE_HOURS = 3.0
+DELAYED_HALF_LIFE_FACTOR = 3.0
+
+# larger samples files are only written as CSV, xlsx files are slow to write and read
+XLSX_MAX_ROWS = 100_000
+
+
+def mtx_concentration(
+    hours: np.ndarray, peak: np.ndarray, half_life_hours: np.ndarray
+) -> np.ndarray:
+    """MTX in µmol/L hours after the start of a 24 hours infusion.
+
+    Rises to peak during the infusion, then decreases in two phases: a fast one with half_life_hours
+    and a slow one for the last 5%, 6 times slower.
+    """
+    elapsed = np.maximum(hours - INFUSION_HOURS, 0)
+    decay = 0.95 * np.exp2(-elapsed / half_life_hours) + 0.05 * np.exp2(
+        -elapsed / (6 * half_life_hours)
+    )
+    return peak * np.clip(hours / INFUSION_HOURS, 0, 1) * decay
+
+
+def creatinine_increase(hours: np.ndarray) -> np.ndarray:
+    """Fold increase of creatinine over baseline hours after an infusion with delayed elimination"""
+    return 1.2 * np.exp(-(((hours - 60) / 36) ** 2))
+
+
+def generate_cohort(
+    n_patients: int = 100,
+    n_infusions: int = 8,
+    samples_per_analyte: int = 40,
+    delayed_elimination: float = 0.05,
+    duplicate_treatments: float = 0.01,
+    seed: int = 0,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Samples and infusion times of a synthetic cohort, as read from the exports before parsing
+
+    Parameters
+    ----------
+    n_patients
+        Number of patients, all treated
+
+    n_infusions
+        Number of MTX infusions per patient
+
+    samples_per_analyte
+        Number of samples per patient for each analyte of ANALYTES
+
+    delayed_elimination
+        Fraction of treatments eliminating MTX slowly, with an increase of creatinine
+
+    duplicate_treatments
+        Fraction of patients with a repeated INFUSION_NO in infusion times
+
+    seed
+        Seed of the random generator
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame]
+        Samples with SAMPLE_TIME as text in SAMPLE_TIME_FORMAT,
+        infusion times with the date in INF_STARTDATE and the hour as text in INF_STARTHOUR
+    """
+    rng = np.random.default_rng(seed)
+    patient_ids = np.arange(n_patients) + 1000
+    first_day = pd.Timestamp("2010-01-01") + pd.to_timedelta(
+        rng.integers(0, 10 * 365, n_patients), unit="D"
+    )
+
+    # infusion starts in hours since the first day of each patient, one row per patient
+    infusion_days = (
+        DAYS_BEFORE_FIRST_INFUSION
+        + DAYS_BETWEEN_INFUSIONS * np.arange(n_infusions)
+        + rng.integers(0, 3, (n_patients, n_infusions))
+    )
+    infusion_minutes = rng.integers(8 * 60, 20 * 60, (n_patients, n_infusions))
+    infusion_hours = 24 * infusion_days + infusion_minutes / 60
+    delayed = rng.random((n_patients, n_infusions)) < delayed_elimination
+    peak = ANALYTES[MTX_CODE] * rng.lognormal(0, 0.3, (n_patients, n_infusions))
+    baseline_crea = ANALYTES[CREA_CODE] * rng.lognormal(0, 0.25, n_patients)
+
+    infusion_no = np.tile(np.arange(1, n_infusions + 1), n_patients)
+    with_duplicate = rng.random(n_patients) < duplicate_treatments
+    infusion_no[np.flatnonzero(with_duplicate) * n_infusions + n_infusions - 1] -= 1
+    infusion_start = np.repeat(first_day, n_infusions) + pd.to_timedelta(
+        infusion_days.ravel(), unit="D"
+    )
+    infusion_times = pd.DataFrame(
+        {
+            PATIENT_ID: np.repeat(patient_ids, n_infusions),
+            INFUSION_NO: infusion_no,
+            INF_STARTDATE: infusion_start,
+            SEX: np.repeat(rng.integers(1, 3, n_patients), n_infusions),
+            MP6_STOP: 0,
+            INF_STARTHOUR: [
+                f"{m // 60:02d}:{m % 60:02d}:00" for m in infusion_minutes.ravel()
+            ],
+        }
+    )
+
+    # MTX samples at the usual hours after each infusion, others at any time of the follow up
+    n_samples = n_patients * samples_per_analyte
+    patient = np.repeat(np.arange(n_patients), samples_per_analyte)
+    nth = np.tile(np.arange(samples_per_analyte), n_patients)
+    mtx_infusion = nth % n_infusions
+    mtx_after = np.take(MTX_SAMPLE_HOURS, nth // n_infusions % len(MTX_SAMPLE_HOURS))
+    mtx_after = mtx_after + rng.uniform(-1, 1, n_samples)
+    half_life = MTX_HALF_LIFE_HOURS * np.where(
+        delayed[patient, mtx_infusion], DELAYED_HALF_LIFE_FACTOR, 1
+    )
+    mtx_values = mtx_concentration(
+        mtx_after, peak[patient, mtx_infusion], half_life
+    ) * rng.lognormal(0, 0.1, n_samples)
+
+    follow_up_hours = 24 * (
+        DAYS_BEFORE_FIRST_INFUSION + DAYS_BETWEEN_INFUSIONS * (n_infusions + 1)
+    )
+    others = [code for code in ANALYTES if code != MTX_CODE]
+    n_others = n_samples * len(others)
+    other_patient = np.tile(patient, len(others))
+    other_code = np.repeat(np.arange(len(others)), n_samples)
+    other_hours = rng.uniform(0, follow_up_hours, n_others)
+    other_values = np.take([ANALYTES[code] for code in others], other_code)
+    other_values = other_values * rng.lognormal(0, 0.5, n_others)
+
+    # creatinine stays close to the baseline of the patient, unless elimination of MTX is delayed
+    is_crea = other_code == others.index(CREA_CODE)
+    crea_patient = other_patient[is_crea]
+    crea_hours = other_hours[is_crea]
+    last_infusion = np.full(len(crea_hours), -1)
+    for i in range(n_infusions):
+        last_infusion += infusion_hours[crea_patient, i] <= crea_hours
+    after_delayed = (last_infusion >= 0) & delayed[crea_patient, last_infusion]
+    since_infusion = crea_hours - infusion_hours[crea_patient, last_infusion]
+    other_values[is_crea] = (
+        baseline_crea[crea_patient]
+        * rng.lognormal(0, 0.08, len(crea_hours))
+        * (1 + np.where(after_delayed, creatinine_increase(since_infusion), 0))
+    )
+
+    all_patients = np.concatenate([patient, other_patient])
+    hours = np.concatenate(
+        [infusion_hours[patient, mtx_infusion] + mtx_after, other_hours]
+    )
+    order = np.lexsort((hours, all_patients))
+    sample_time = first_day[all_patients[order]] + pd.to_timedelta(
+        np.round(hours[order] * 60), unit="m"
+    )
+    samples = pd.DataFrame(
+        {
+            PATIENT_ID: patient_ids[all_patients[order]],
+            SAMPLE_TIME: pd.Series(sample_time).dt.strftime(SAMPLE_TIME_FORMAT),
+            P_CODE: np.concatenate(
+                [np.full(n_samples, MTX_CODE), np.take(others, other_code)]
+            )[order],
+            VALUE: np.round(np.concatenate([mtx_values, other_values])[order], 2),
+            REF_PATIENT: REFERENCE_TEXT,
+        }
+    )
+    return samples, infusion_times
+
+
+def write_cohort(
+    output_dir: str, xlsx_max_rows: int = XLSX_MAX_ROWS, **kwargs
+) -> Dict[str, str]:
+    """Write the files of generate_cohort(**kwargs) to output_dir
+
+    Returns
+    -------
+    Dict[str, str]
+        Paths of "samples" as CSV, "samples_xlsx" when at most xlsx_max_rows samples, and "infusion_times" as xlsx
+    """
+    samples, infusion_times = generate_cohort(**kwargs)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {
+        "samples": os.path.join(output_dir, "samples.csv"),
+        "infusion_times": os.path.join(output_dir, "infusion_times.xlsx"),
+    }
+    samples.to_csv(paths["samples"], index=False)
+    if len(samples) <= xlsx_max_rows:
+        paths["samples_xlsx"] = os.path.join(output_dir, "samples.xlsx")
+        samples.to_excel(paths["samples_xlsx"], index=False)
+    infusion_times.to_excel(paths["infusion_times"], index=False)
+    return paths
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--infusions", type=int, default=8)
+    parser.add_argument("--samples-per-analyte", type=int, default=40)
+    parser.add_argument(
+        "--delayed-elimination",
+        type=float,
+        default=0.05,
+        help="Fraction of treatments with delayed elimination of MTX",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default=".", help="Folder to write files to")
+    args = parser.parse_args(argv)
+
+    paths = write_cohort(
+        args.output_dir,
+        n_patients=args.patients,
+        n_infusions=args.infusions,
+        samples_per_analyte=args.samples_per_analyte,
+        delayed_elimination=args.delayed_elimination,
+        seed=args.seed,
+    )
+    for path in paths.values():
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
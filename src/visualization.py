@@ -1,19 +1,137 @@
 """Define classes that return Altair/Plotly/Matplotlib figures
+
+Charts of all samples of a diagnostic are downsampled above MTX_DOWNSAMPLE_ABOVE points,
+and drawn with WebGL by Plotly above MTX_WEBGL_ABOVE points:
+
+    MTX_DOWNSAMPLE_ABOVE=20000 MTX_WEBGL_ABOVE=10000 streamlit run app.py
+
+With MTX_LAZY_CHARTS=1, charts inside expanders are only built once their section is opened, all are built by default.
+Built charts are kept in CHARTS, the MTX_CHART_CACHE_SIZE most recently drawn ones,
+so reruns of the app for unrelated widgets do not build them again.
 """
-from typing import List
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Sequence, Union
 
 import altair as alt
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import plotly.io as pio
 
 from src.constants import *
 from src.diagnostics import DiagnoseTypes
+from src.instrumentation import instrumented
+from src.instrumentation import record_cache_lookup
+from src.partition import PCodePartition
+from src.phenotype import PhenotypeMatrix
 
 pio.templates.default = "plotly_white"
 
+# columns drawn or shown in tooltips, the others are not sent to the browser
+CHART_COLUMNS = [
+    PATIENT_ID,
+    SAMPLE_TIME,
+    P_CODE,
+    VALUE,
+    INFUSION_NO,
+    SEX,
+    MP6_STOP,
+    DETECTION,
+]
+
+DOWNSAMPLE_ABOVE = int(os.environ.get("MTX_DOWNSAMPLE_ABOVE", 5000))
+WEBGL_ABOVE = int(os.environ.get("MTX_WEBGL_ABOVE", 5000))
+LAZY_CHARTS = os.environ.get("MTX_LAZY_CHARTS", "0") == "1"
+CHART_CACHE_SIZE = int(os.environ.get("MTX_CHART_CACHE_SIZE", 64))
+
+Chart = Union[alt.Chart, go.Figure]
+
+
+class ChartCache:
+    """Charts by key, eg. (dataset, diagnostic, parameters, patient), at most max_size of them"""
+
+    def __init__(self, max_size: int = CHART_CACHE_SIZE):
+        self.max_size = max_size
+        self._charts: "OrderedDict[Hashable, Chart]" = OrderedDict()
+        # sessions run in threads of the same process
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build: Callable[[], Chart]) -> Chart:
+        """Return build(), computed once per key while it stays in the cache"""
+        with self._lock:
+            hit = key in self._charts
+            if hit:
+                self._charts.move_to_end(key)
+                chart = self._charts[key]
+        record_cache_lookup("chart", hit=hit)
+        if hit:
+            return chart
+        chart = build()
+        with self._lock:
+            self._charts[key] = chart
+            while len(self._charts) > self.max_size:
+                self._charts.popitem(last=False)
+        return chart
+
+
+CHARTS = ChartCache()
+
+
+def downsample(
+    data: pd.DataFrame, max_points: int, by: Sequence[str] = (P_CODE,)
+) -> pd.DataFrame:
+    """Keep positive samples, and the lowest and highest negative sample of each day per group of by.
+
+    The shape of curves and every detection stay visible while the number of points is bounded
+    by the number of days rather than the number of samples.
+    """
+    if len(data) <= max_points:
+        return data
+    positive = data[DETECTION].to_numpy(dtype=bool)
+    negative = np.flatnonzero(~positive & data[VALUE].notnull().to_numpy())
+
+    # positions as index, so the rows of the extremes can be taken back whatever the index of data
+    values = pd.Series(data[VALUE].to_numpy()[negative], index=negative)
+    keys = [data[column].to_numpy()[negative] for column in by]
+    keys.append(data[SAMPLE_TIME].dt.floor("D").to_numpy()[negative])
+    grouped = values.groupby(keys, sort=False)
+
+    kept = np.concatenate(
+        [
+            np.flatnonzero(positive),
+            grouped.idxmin().to_numpy(),
+            grouped.idxmax().to_numpy(),
+        ]
+    )
+    return data.iloc[np.unique(kept)]
 
-def visualize_detected(diagnostic: DiagnoseTypes) -> alt.Chart:
+
+def scatter_webgl(
+    source: pd.DataFrame, color: str, title: Optional[str] = None
+) -> go.Figure:
+    """Scatter plot of VALUE over SAMPLE_TIME with one row per P_CODE, drawn by the GPU of the browser"""
+    source = source.assign(**{color: source[color].astype(str)})
+    return px.scatter(
+        source,
+        x=SAMPLE_TIME,
+        y=VALUE,
+        color=color,
+        facet_row=P_CODE,
+        hover_data=[PATIENT_ID, INFUSION_NO, SEX, MP6_STOP],
+        render_mode="webgl",
+        title=title,
+    ).update_yaxes(matches=None)
+
+
+@instrumented("visualize_detected")
+def visualize_detected(
+    diagnostic: DiagnoseTypes,
+    downsample_above: int = DOWNSAMPLE_ABOVE,
+    webgl_above: int = WEBGL_ABOVE,
+) -> Chart:
     """Plot all records diagnosed as positive.
 
     Parameters
@@ -21,13 +139,20 @@ def visualize_detected(diagnostic: DiagnoseTypes) -> alt.Chart:
     diagnostic
         A Diagnostic class
 
+    downsample_above
+        Above this number of samples, only positives and daily extremes per P_CODE are drawn
+
+    webgl_above
+        Above this number of points, draw with Plotly WebGL instead of Altair
+
     Returns
     -------
     callable
-        An Altair chart
+        An Altair chart, or a Plotly figure for many points
     """
-    # TODO: check speed when over 5000 elements
-    source = diagnostic.data.copy()
+    source = downsample(diagnostic.data[CHART_COLUMNS], downsample_above)
+    if len(source) > webgl_above:
+        return scatter_webgl(source, DETECTION)
     chart = (
         alt.Chart(source)
         .mark_point(filled=True)
@@ -37,16 +162,28 @@ def visualize_detected(diagnostic: DiagnoseTypes) -> alt.Chart:
             color=alt.Color(f"{DETECTION}:N", scale=alt.Scale(domain=[0, 1])),
             opacity=alt.condition(alt.datum[DETECTION], alt.value(1.0), alt.value(0.2)),
             row=alt.Row(f"{P_CODE}:N", title=""),
-            tooltip=[PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, SEX, MP6_STOP],
+            tooltip=[
+                PATIENT_ID,
+                SAMPLE_TIME,
+                P_CODE,
+                VALUE,
+                INFUSION_NO,
+                SEX,
+                MP6_STOP,
+            ],
         )
         .interactive()
     )
     return chart
 
 
+@instrumented("visualize_detected_by_patient")
 def visualize_detected_by_patient(
-    diagnostic: DiagnoseTypes, detected_patient_ids: str
-) -> alt.Chart:
+    diagnostic: DiagnoseTypes,
+    detected_patient_ids: str,
+    downsample_above: int = DOWNSAMPLE_ABOVE,
+    webgl_above: int = WEBGL_ABOVE,
+) -> Chart:
     """Plot all records for the list of patient_ids. Each patient_id should all have one positive diagnostic.
 
     Parameters
@@ -57,13 +194,25 @@ def visualize_detected_by_patient(
     detected_patient_ids
         List of patient_ids with at least a positive diagnostic
 
+    downsample_above
+        Above this number of samples, only positives and daily extremes per patient and P_CODE are drawn
+
+    webgl_above
+        Above this number of points, draw with Plotly WebGL instead of Altair
+
     Returns
     -------
     callable
-        An Altair chart
+        An Altair chart, or a Plotly figure for many points
     """
-    source = diagnostic.data.copy()
-    source = source[source[PATIENT_ID].isin(detected_patient_ids)]
+    data = diagnostic.data
+    source = downsample(
+        data.loc[data[PATIENT_ID].isin(detected_patient_ids), CHART_COLUMNS],
+        downsample_above,
+        by=[PATIENT_ID, P_CODE],
+    )
+    if len(source) > webgl_above:
+        return scatter_webgl(source, PATIENT_ID)
 
     chart = (
         alt.Chart(source)
@@ -73,13 +222,22 @@ def visualize_detected_by_patient(
             y=alt.Y(f"{VALUE}:Q", title="value"),
             color=alt.Color(f"{PATIENT_ID}:N", title="Patient ID"),
             row=alt.Row(f"{P_CODE}:N", title=""),
-            tooltip=[PATIENT_ID, SAMPLE_TIME, P_CODE, VALUE, INFUSION_NO, SEX, MP6_STOP],
+            tooltip=[
+                PATIENT_ID,
+                SAMPLE_TIME,
+                P_CODE,
+                VALUE,
+                INFUSION_NO,
+                SEX,
+                MP6_STOP,
+            ],
         )
         .interactive()
     )
     return chart
 
 
+@instrumented("visualize_patient")
 def visualize_patient(diagnostic: DiagnoseTypes, patient_id: str) -> alt.Chart:
     """Plot all records for the given patient_id, with color by diagnostic result.
     The ID should have at least one positive diagnostic.
@@ -97,8 +255,8 @@ def visualize_patient(diagnostic: DiagnoseTypes, patient_id: str) -> alt.Chart:
     callable
         An Altair chart
     """
-    source = diagnostic.data.copy()
-    source = source[source[PATIENT_ID] == patient_id]
+    data = diagnostic.data
+    source = data.loc[data[PATIENT_ID] == patient_id, CHART_COLUMNS]
     base = alt.Chart(source).encode(
         x=alt.X(f"{SAMPLE_TIME}:T", title="Date"),
         y=alt.Y(f"{VALUE}:Q", title="value"),
@@ -112,35 +270,20 @@ def visualize_patient(diagnostic: DiagnoseTypes, patient_id: str) -> alt.Chart:
     return chart
 
 
-def visualize_summary_detection(diagnostics: List[DiagnoseTypes]) -> alt.Chart:
+@instrumented("visualize_summary_detection")
+def visualize_summary_detection(phenotype: PhenotypeMatrix) -> alt.Chart:
     """Plot number of positive/negative patient IDS per diagnostic
 
     Parameters
     ----------
-    diagnostics
-        A diagnostic instance.
+    phenotype
+        Phenotype matrix of the diagnostics
 
     Returns
     -------
         Altair chart
     """
-
-    def format_row(diagnostic: DiagnoseTypes):
-        n_patients = len(diagnostic.data[PATIENT_ID].unique())
-        n_patients_with_positive = len(
-            diagnostic.data.loc[diagnostic.data["detection"] == 1, PATIENT_ID].unique()
-        )
-        row = {
-            "name": diagnostic.name,
-            "patients with all negative diagnostic": n_patients
-            - n_patients_with_positive,
-            "patients with one positive diagnostic": n_patients_with_positive,
-        }
-        return row
-
-    rows = [format_row(diagnostic) for diagnostic in diagnostics]
-
-    source = pd.DataFrame(rows).melt(
+    source = phenotype.summary().melt(
         id_vars="name", var_name="type", value_name="number_of_patients"
     )
     chart = (
@@ -158,12 +301,81 @@ def visualize_summary_detection(diagnostics: List[DiagnoseTypes]) -> alt.Chart:
     return chart
 
 
-def beta_visualize_dme(samples_with_treatment_no: pd.DataFrame, nopho_nr):
-    data = samples_with_treatment_no[
-        (samples_with_treatment_no[P_CODE] == "NPU02739")
-        & (samples_with_treatment_no[PATIENT_ID] == nopho_nr)
-    ].copy()
-    data[INFUSION_NO] = data[INFUSION_NO].astype(str)
+@instrumented("visualize_co_occurrence")
+def visualize_co_occurrence(phenotype: PhenotypeMatrix) -> alt.Chart:
+    """Plot number of patients positive to both diagnostics, for each pair of diagnostics
+
+    Parameters
+    ----------
+    phenotype
+        Phenotype matrix of the diagnostics
+
+    Returns
+    -------
+        Altair chart
+    """
+    co_occurrence = phenotype.co_occurrence()
+    source = (
+        co_occurrence.rename_axis(index="first")
+        .reset_index()
+        .melt(id_vars="first", var_name="second", value_name="number_of_patients")
+    )
+    base = alt.Chart(source).encode(
+        x=alt.X("first:N", title=""),
+        y=alt.Y("second:N", title=""),
+    )
+    heatmap = base.mark_rect().encode(
+        color=alt.Color("number_of_patients:Q", title="Positive to both"),
+        tooltip=["first", "second", "number_of_patients"],
+    )
+    text = base.mark_text().encode(text="number_of_patients:Q")
+    return (heatmap + text).properties(title="Patients positive to both diagnostics")
+
+
+@instrumented("visualize_sweep")
+def visualize_sweep(sweep: pd.DataFrame, x: str, y: Optional[str] = None) -> alt.Chart:
+    """Plot number of positive patients over a grid of parameters
+
+    Parameters
+    ----------
+    sweep
+        Output of a diagnostic sweep, filtered so only x and y vary
+
+    x
+        Parameter on the x axis
+
+    y
+        Parameter on the y axis, draws a heatmap when given and a curve otherwise
+
+    Returns
+    -------
+        Altair chart
+    """
+    base = alt.Chart(sweep).properties(title="Number of positive patients")
+    tooltip = [x, "positive_patients"] if y is None else [x, y, "positive_patients"]
+    if y is None:
+        return (
+            base.mark_line(point=True)
+            .encode(
+                x=alt.X(f"{x}:Q"),
+                y=alt.Y("positive_patients:Q", title="positive patients"),
+                tooltip=tooltip,
+            )
+            .interactive()
+        )
+    return base.mark_rect().encode(
+        x=alt.X(f"{x}:O"),
+        y=alt.Y(f"{y}:O", sort="descending"),
+        color=alt.Color("positive_patients:Q", title="positive patients"),
+        tooltip=tooltip,
+    )
+
+
+def beta_visualize_dme(samples: PCodePartition, nopho_nr):
+    positions = samples.positions("NPU02739")
+    positions = positions[samples.source[PATIENT_ID].to_numpy()[positions] == nopho_nr]
+    data = samples.source.iloc[positions]
+    data = data.assign(**{INFUSION_NO: data[INFUSION_NO].astype(str)})
     fig = (
         px.scatter(
             data,
@@ -0,0 +1,43 @@
+from typing import Callable
+from typing import List
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.constants import *
+
+
+@pytest.fixture
+def make_samples() -> Callable[..., pd.DataFrame]:
+    """Factory of random samples with their treatment, of the P_CODE p_codes"""
+
+    def make(
+        p_codes: Union[str, List[str]],
+        n: int = 2000,
+        n_patients: int = 20,
+        days: int = 60,
+        hours_step: int = 1,
+        scale: float = 10.0,
+    ) -> pd.DataFrame:
+        rng = np.random.default_rng(0)
+        return pd.DataFrame(
+            {
+                PATIENT_ID: rng.integers(0, n_patients, n),
+                SAMPLE_TIME: pd.Timestamp("2020-01-01")
+                + pd.to_timedelta(
+                    hours_step * rng.integers(0, 24 * days // hours_step, n), unit="h"
+                ),
+                P_CODE: rng.choice(np.atleast_1d(p_codes), n),
+                VALUE: rng.exponential(scale, n),
+                INFUSION_NO: rng.integers(0, 3, n).astype(float),
+                DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE: rng.integers(
+                    -100, 100, n
+                ).astype(float),
+                SEX: 1,
+                MP6_STOP: 0.0,
+            }
+        )
+
+    return make
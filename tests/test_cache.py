@@ -0,0 +1,53 @@
+from io import BytesIO
+
+import pandas as pd
+
+from pandas.testing import assert_frame_equal
+
+import src.cache
+from src.cache import cached_parse
+from src.cache import evict
+from src.cache import file_hash
+
+
+def test_cached_parse_reads_back_same_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.cache, "CACHE_DIR", str(tmp_path))
+    calls = []
+
+    def parse(buffer):
+        calls.append(1)
+        return pd.DataFrame({"a": [1, 2, 3], "b": pd.to_datetime(["2020-01-01"] * 3)})
+
+    first = cached_parse(BytesIO(b"export"), "test", parse)
+    second = cached_parse(BytesIO(b"export"), "test", parse)
+    cached_parse(BytesIO(b"another export"), "test", parse)
+
+    assert len(calls) == 2
+    assert_frame_equal(first, second)
+    assert file_hash(BytesIO(b"export")) != file_hash(BytesIO(b"another export"))
+
+
+def test_evict_least_recently_used_above_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.cache, "CACHE_DIR", str(tmp_path))
+    for content in [b"old", b"new"]:
+        cached_parse(
+            BytesIO(content), "test", lambda b: pd.DataFrame({"a": range(1000)})
+        )
+    old, new = sorted(tmp_path.iterdir(), key=lambda p: p.stat().st_mtime)
+    src.cache.os.utime(old, (0, 0))
+
+    evict(max_size_mb=new.stat().st_size / 1024 / 1024, max_age_days=365)
+
+    assert not old.exists()
+    assert new.exists()
+
+
+def test_evict_leaves_files_of_other_modules(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.cache, "CACHE_DIR", str(tmp_path))
+    shared = tmp_path / "shared-0.feather"
+    shared.write_bytes(b"in use")
+    src.cache.os.utime(shared, (0, 0))
+
+    evict(max_size_mb=0, max_age_days=0)
+
+    assert shared.exists()
@@ -0,0 +1,51 @@
+import json
+
+import pandas as pd
+
+from src import cache
+from src.constants import *
+from src.cli import default_params
+from src.cli import main
+from src.synthetic import write_cohort
+
+
+def test_main_writes_phenotype_and_detections(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    paths = write_cohort(
+        str(tmp_path / "exports"), n_patients=20, samples_per_analyte=16
+    )
+    params = tmp_path / "params.json"
+    params.write_text(json.dumps({"Diagnose6": {"param_concentration": 50}}))
+    output_dir = tmp_path / "results"
+
+    main(
+        [
+            "--samples",
+            paths["samples"],
+            "--infusion-times",
+            paths["infusion_times"],
+            "--params",
+            str(params),
+            "--diagnostics",
+            "Diagnose6",
+            "DME",
+            "--serial",
+            "--output-dir",
+            str(output_dir),
+        ]
+    )
+
+    phenotype = pd.read_csv(output_dir / "phenotype.csv", sep=";")
+    assert 0 < len(phenotype) <= 20
+    assert phenotype["PHONOTYPE"].isin([0, 1]).all()
+    assert phenotype["PHONOTYPE"].sum() != 0
+    for name in ["Diagnose6", "DME"]:
+        detections = pd.read_csv(output_dir / f"detections_{name}.csv", sep=";")
+        assert len(detections) != 0 and DETECTION in detections.columns
+
+
+def test_print_params(capsys):
+    main(["--print-params"])
+    assert json.loads(capsys.readouterr().out) == json.loads(
+        json.dumps(default_params())
+    )
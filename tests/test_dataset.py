@@ -0,0 +1,64 @@
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.dataset import cast_to_schema
+from src.dataset import memory_usage_mb
+from src.dataset import merge_samples_to_treatment
+from src.instrumentation import trace_memory
+
+
+def test_cast_to_schema():
+    n = 1000
+    df = pd.DataFrame(
+        {
+            PATIENT_ID: np.arange(n) % 10,
+            P_CODE: np.where(np.arange(n) % 2 == 0, "NPU02902", "NPU18016"),
+            VALUE: np.linspace(0, 10, n),
+            REF_PATIENT: "<8,0",
+            INFUSION_NO: np.where(np.arange(n) < 10, np.nan, 1.0),
+            DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE: np.where(
+                np.arange(n) < 10, np.nan, 48.0
+            ),
+        }
+    )
+    typed = cast_to_schema(df)
+
+    assert typed.dtypes.astype(str).to_dict() == {
+        c: SAMPLES_SCHEMA[c] for c in df.columns
+    }
+    assert typed[INFUSION_NO].isnull().sum() == 10
+    assert memory_usage_mb(typed) < memory_usage_mb(df) / 4
+
+
+def test_untyped_memory_only_measured_while_tracing():
+    samples = pd.DataFrame(
+        {
+            PATIENT_ID: [1, 1],
+            SAMPLE_TIME: pd.to_datetime(["2020-01-02", "2020-01-20"]),
+            P_CODE: "NPU02902",
+            VALUE: [1.0, 2.0],
+            REF_PATIENT: "<8,0",
+        }
+    )
+    infusion_times = pd.DataFrame(
+        {
+            PATIENT_ID: [1, 1],
+            INFUSION_NO: ["1", "2"],
+            INF_STARTDATE: pd.to_datetime(["2020-01-01", "2020-01-15"]),
+            SEX: 1,
+            MP6_STOP: 0,
+        }
+    )
+    merged, untyped_memory_mb = merge_samples_to_treatment(samples, infusion_times)
+    assert merged[INFUSION_NO].tolist() == [1, 2]
+    assert untyped_memory_mb is None
+
+    trace_memory()
+    try:
+        _, untyped_memory_mb = merge_samples_to_treatment(samples, infusion_times)
+    finally:
+        tracemalloc.stop()
+    assert untyped_memory_mb > 0
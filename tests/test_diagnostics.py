@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.constants import *
+from src.diagnostics import AbstractDiagnose
+from src.diagnostics import Diagnose1
+from src.diagnostics import Diagnose3
+from src.diagnostics import Diagnose6
+from src.diagnostics import Diagnose9
+from src.diagnostics import DiagnosticClasses
+from src.partition import PCodePartition
+
+
+@pytest.fixture
+def make_partition(make_samples):
+    def make(p_code: str) -> PCodePartition:
+        return PCodePartition(make_samples(p_code, n=200, n_patients=10, scale=1.0))
+
+    return make
+
+
+@pytest.mark.parametrize(
+    "diagnostic_class", [cls for cls in DiagnosticClasses if len(cls.PARAMS) != 0]
+)
+def test_sweep_same_as_run_detection(make_samples, diagnostic_class):
+    # values around the thresholds, CRP above 100 for Diagnose9, and samples sharing hours to be paired
+    df = make_samples(
+        diagnostic_class.CODES,
+        n=400,
+        n_patients=10,
+        days=10,
+        hours_step=6,
+        scale=100.0 if diagnostic_class is Diagnose9 else 50.0,
+    )
+    samples = PCodePartition(df.assign(**{REF_PATIENT: "<8,0"}))
+    # first, last and two values in between of each slider
+    grid = {
+        param.name: param.grid()[np.linspace(0, len(param.grid()) - 1, 4).astype(int)]
+        for param in diagnostic_class.PARAMS
+    }
+    sweep = diagnostic_class(samples).sweep(grid)
+    assert len(sweep) == np.prod([len(values) for values in grid.values()])
+    assert sweep["positive_patients"].nunique() > 1
+
+    for _, row in sweep.iterrows():
+        diagnostic = diagnostic_class(samples)
+        diagnostic.set_params(**{param: row[param] for param in grid})
+        diagnostic.run_detection()
+        assert len(diagnostic.get_detected_ids()) == row["positive_patients"]
+
+
+def test_sweep_by_detection_same_as_batch_count(make_partition):
+    diagnostic = Diagnose6(make_partition("NPU18016"))
+    grid = {"param_concentration": np.array([0.5, 1.0, 2.0])}
+    counts = AbstractDiagnose._count_positive_patients(diagnostic, **grid)
+    assert counts.tolist() == diagnostic._count_positive_patients(**grid).tolist()
+    assert diagnostic.get_params() == {"param_concentration": 150}
+
+
+def test_sweep_without_params(make_partition):
+    sweep = Diagnose3(make_partition("NPU01459")).sweep()
+    assert list(sweep.columns) == ["positive_patients"]
+    assert len(sweep) == 1
+
+
+def test_set_params(make_partition):
+    diagnostic = Diagnose1(make_partition("NPU02902"))
+    assert diagnostic.get_params() == {"param_concentration": 0.5, "param_days": 10}
+
+    diagnostic.set_params(param_days=3)
+    assert diagnostic.get_params() == {"param_concentration": 0.5, "param_days": 3}
+
+    with pytest.raises(ValueError):
+        diagnostic.set_params(param_hours=3)
+
+
+def test_detection_does_not_mutate_input(make_samples):
+    df = make_samples(
+        ["NPU02902", "NPU19748", "NPU19651", "NPU01370", "NPU18016", "NPU02739"],
+        n_patients=10,
+        days=360,
+        hours_step=6,
+        scale=50.0,
+    ).assign(**{REF_PATIENT: "<8,0"})
+    expected = df.copy()
+    samples = PCodePartition(df).filter(df[INFUSION_NO] != 2)
+    for diagnostic_class in DiagnosticClasses:
+        diagnostic = diagnostic_class(samples)
+        diagnostic.run_detection()
+        diagnostic.get_detected_ids()
+    pd.testing.assert_frame_equal(df, expected)
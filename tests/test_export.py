@@ -0,0 +1,41 @@
+import gzip
+import io
+
+import numpy as np
+import pandas as pd
+
+from src.constants import *
+from src.export import export_chunks
+from src.export import iter_chunks
+
+
+def make_detail(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            PATIENT_ID: rng.integers(0, 100, n).astype("int32"),
+            P_CODE: pd.Series(rng.choice(["NPU02902", "NPU18016"], n)).astype(
+                "category"
+            ),
+            VALUE: rng.exponential(1, n).astype("float32"),
+            INFUSION_NO: pd.Series(rng.integers(0, 3, n)).astype("Int8"),
+            DETECTION: rng.random(n) < 0.1,
+        }
+    )
+
+
+def test_export_formats_read_back():
+    df = make_detail(2500)
+    for fmt in ["csv", "csv.gz", "parquet"]:
+        blocks = list(export_chunks(iter_chunks(df, chunk_rows=1000), fmt))
+        assert len(blocks) > 1
+        data = b"".join(blocks)
+        if fmt == "parquet":
+            read = pd.read_parquet(io.BytesIO(data))
+            pd.testing.assert_frame_equal(read, df, check_categorical=False)
+            continue
+        if fmt == "csv.gz":
+            data = gzip.decompress(data)
+        read = pd.read_csv(io.BytesIO(data), sep=";")
+        assert len(read) == len(df)
+        assert read[DETECTION].tolist() == df[DETECTION].tolist()
@@ -0,0 +1,62 @@
+import os
+
+import pandas as pd
+
+from src import cache
+from src.cli import main
+from src.constants import *
+from src.synthetic import generate_cohort
+
+
+def read_sorted(path: str) -> pd.DataFrame:
+    df = pd.read_csv(path, sep=";")
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def test_delta_gives_same_results_as_full_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    samples, infusion_times = generate_cohort(
+        n_patients=30, samples_per_analyte=8, duplicate_treatments=0
+    )
+    # last week only brought samples of a few patients, moved an infusion and corrected a value
+    is_old = ~samples[PATIENT_ID].isin(samples[PATIENT_ID].unique()[:3])
+    is_old |= samples.index % 5 != 0
+    old_samples = samples[is_old].copy()
+    old_samples.loc[old_samples.index[0], VALUE] += 1000
+    moved = infusion_times.copy()
+    moved.loc[len(moved) - 1, INF_STARTHOUR] = "20:00:00"
+    paths = {
+        name: str(tmp_path / name)
+        for name in ["old.csv", "all.csv", "old.xlsx", "all.xlsx"]
+    }
+    old_samples.to_csv(paths["old.csv"], index=False)
+    samples.to_csv(paths["all.csv"], index=False)
+    infusion_times.to_excel(paths["old.xlsx"], index=False)
+    moved.to_excel(paths["all.xlsx"], index=False)
+
+    state_dir = str(tmp_path / "state")
+    for samples_path, infusions_path, output_dir, options in [
+        ("old.csv", "old.xlsx", "weekly", ["--state-dir", state_dir]),
+        ("all.csv", "all.xlsx", "weekly", ["--state-dir", state_dir, "--append"]),
+        ("all.csv", "all.xlsx", "full", []),
+    ]:
+        main(
+            [
+                "--samples",
+                paths[samples_path],
+                "--infusion-times",
+                paths[infusions_path],
+                "--output-dir",
+                str(tmp_path / output_dir),
+                "--serial",
+            ]
+            + options
+        )
+
+    files = os.listdir(tmp_path / "full")
+    assert "detections_DME.csv" in files
+    for name in files:
+        pd.testing.assert_frame_equal(
+            read_sorted(str(tmp_path / "weekly" / name)),
+            read_sorted(str(tmp_path / "full" / name)),
+        )
@@ -0,0 +1,63 @@
+import tracemalloc
+
+import pandas as pd
+
+from src.constants import *
+from src.diagnostics import Diagnose1
+from src.instrumentation import CACHE_HIT
+from src.instrumentation import CACHE_MISS
+from src.instrumentation import events
+from src.instrumentation import instrumented
+from src.instrumentation import record_cache_miss
+from src.instrumentation import stage
+from src.instrumentation import start_run
+from src.instrumentation import trace_memory
+from src.partition import PCodePartition
+
+
+def test_stages_and_cache_lookups_are_recorded():
+    trace_memory()
+    start_run()
+    computed = {}
+
+    @instrumented("double", cached=True)
+    def double(df: pd.DataFrame) -> pd.DataFrame:
+        if id(df) in computed:
+            return computed[id(df)]
+        record_cache_miss()
+        computed[id(df)] = pd.concat([df, df])
+        return computed[id(df)]
+
+    df = pd.DataFrame({VALUE: range(10)})
+    double(df)
+    double(df)
+    with stage("block", rows_in=3) as record:
+        record.rows_out = 1
+
+    recorded = [(e.name, e.kind, e.rows_in, e.rows_out) for e in events()]
+    assert recorded == [
+        ("double", "stage", 10, 20),
+        ("double", CACHE_MISS, None, None),
+        ("double", "stage", 10, 20),
+        ("double", CACHE_HIT, None, None),
+        ("block", "stage", 3, 1),
+    ]
+    assert events()[0].traced_memory_change_mb is not None
+
+    # a new run, of another session for instance, keeps tracing memory
+    start_run()
+    assert events() == []
+    assert tracemalloc.is_tracing()
+    tracemalloc.stop()
+
+
+def test_detections_are_recorded(make_samples):
+    start_run()
+    samples = PCodePartition(make_samples("NPU02902", n=3))
+    Diagnose1(samples).run_detection()
+    (event,) = events()
+    assert (event.name, event.rows_in, event.rows_out) == (
+        "Diagnose1.run_detection",
+        3,
+        3,
+    )
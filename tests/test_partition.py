@@ -0,0 +1,57 @@
+import pandas as pd
+
+from pandas.testing import assert_frame_equal
+
+from src import partition
+from src.constants import *
+from src.partition import PCodePartition
+
+
+def test_partition_get_same_as_scan():
+    df = pd.DataFrame(
+        {
+            PATIENT_ID: [0, 0, 1, 1, 2, 2, 3],
+            P_CODE: ["B", "A", "C", "A", None, "B", "A"],
+            VALUE: [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0],
+        },
+        index=[7, 3, 5, 1, 2, 4, 6],
+    )
+    samples = PCodePartition(df)
+
+    assert samples.codes == ["A", "B", "C"]
+    assert_frame_equal(samples.get("A"), df.loc[df[P_CODE] == "A"])
+    assert_frame_equal(
+        samples.get(["C", "A"], [PATIENT_ID, VALUE]),
+        df.loc[df[P_CODE].isin(["C", "A"]), [PATIENT_ID, VALUE]],
+    )
+    assert len(samples.get("unknown")) == 0
+
+    mask = df[VALUE] > 2
+    filtered = samples.filter(mask)
+    assert filtered.codes == ["A", "B", "C"]
+    assert_frame_equal(filtered.get(["A", "B"]), df[mask & df[P_CODE].isin(["A", "B"])])
+
+    assert filtered.source is df
+    assert_frame_equal(filtered.data, df[mask])
+
+    mask_of_filtered = filtered.data[PATIENT_ID] != 3
+    refiltered = filtered.filter(mask_of_filtered)
+    assert refiltered.codes == ["A", "B", "C"]
+    assert len(refiltered) == 4
+    assert_frame_equal(
+        refiltered.get("A"), df[mask & (df[PATIENT_ID] != 3) & (df[P_CODE] == "A")]
+    )
+
+
+def test_memoize_keeps_most_recently_used(monkeypatch):
+    monkeypatch.setattr(partition, "MEMO_MAX_ENTRIES", 2)
+    samples = PCodePartition(pd.DataFrame({P_CODE: ["A", "B"], VALUE: [1.0, 2.0]}))
+    builds = []
+
+    def build(key):
+        builds.append(key)
+        return key
+
+    for key in ["first", "second", "first", "third", "first", "second"]:
+        assert samples.memoize(key, lambda: build(key)) == key
+    assert builds == ["first", "second", "third", "second"]
@@ -0,0 +1,32 @@
+import pandas as pd
+
+from src.constants import *
+from src.phenotype import PhenotypeMatrix
+
+
+class FakeDiagnostic:
+    def __init__(self, name: str, patient_ids, detections):
+        self.name = name
+        self.data = pd.DataFrame({PATIENT_ID: patient_ids, DETECTION: detections})
+
+
+def test_phenotype_matrix():
+    neutropenia = FakeDiagnostic(
+        "neutropenia", [3, 3, 1, 5], [False, True, False, True]
+    )
+    infection = FakeDiagnostic("infection", [1, 3, 7], [True, True, False])
+    phenotype = PhenotypeMatrix([neutropenia, infection])
+
+    assert phenotype.detected_ids(0) == [3, 5]
+    assert phenotype.detected_ids(1) == [1, 3]
+    assert phenotype.summary().to_dict("list") == {
+        "name": ["neutropenia", "infection"],
+        "patients with all negative diagnostic": [1, 1],
+        "patients with one positive diagnostic": [2, 2],
+    }
+    assert phenotype.phenotype().to_dict("list") == {
+        PATIENT_ID: [1, 3, 5, 7],
+        "PHONOTYPE": [1, 1, 1, 0],
+    }
+    assert phenotype.count_positive_to_all([0, 1]) == 1
+    assert phenotype.co_occurrence().to_numpy().tolist() == [[2, 1], [1, 2]]
@@ -1,10 +1,16 @@
+import numpy as np
 import pandas as pd
 
 from pandas.testing import assert_series_equal
 
 from src.constants import *
+from src.processing import AnalyteIndex
+from src.processing import assign_infusions
 from src.processing import compute_streaks_of_detection
 from src.processing import is_streak_longer_than_duration
+from src.processing import SampleAlignment
+from src.processing import SegmentIndex
+from src.processing import StreakIndex
 
 
 def test_compute_streaks():
@@ -58,7 +64,178 @@ def test_is_streak_longer_than_duration():
     )
     assert_series_equal(
         long_streaks,
+        pd.Series([True, True, True, True, False, True, True, False, True, True]),
+        check_names=False,
+    )
+
+
+def test_assign_infusions():
+    infusion_times = pd.DataFrame(
+        {
+            PATIENT_ID: [0, 0, 0, 1, 1],
+            INFUSION_NO: ["1", "2", "9", "2", "3"],
+            INF_STARTDATE: [
+                pd.Timestamp("1970-01-02 00:00:00"),
+                pd.Timestamp("1970-01-03 00:00:00"),
+                pd.Timestamp("1970-01-09 00:00:00"),
+                pd.Timestamp("1970-01-03 00:00:00"),
+                pd.Timestamp("1970-01-04 00:00:00"),
+            ],
+        }
+    )
+    samples = pd.DataFrame(
+        {
+            PATIENT_ID: [0, 0, 0, 0, 0, 1, 1, 2],
+            SAMPLE_TIME: [
+                # Patient 0
+                pd.Timestamp("1970-01-01 22:30:00"),  # before infusion 1
+                pd.Timestamp("1970-01-02 00:00:00"),  # start of infusion 1
+                pd.Timestamp("1970-01-03 01:30:00"),  # infusion 2
+                pd.Timestamp("1970-01-10 00:00:00"),  # infusion 9
+                pd.NaT,
+                # Patient 1 has no infusion 1
+                pd.Timestamp("1970-01-02 00:00:00"),
+                pd.Timestamp("1970-01-04 06:00:00"),  # infusion 3
+                # Patient 2 has no infusion
+                pd.Timestamp("1970-01-02 00:00:00"),
+            ],
+        },
+        index=[10, 11, 12, 13, 14, 15, 16, 17],
+    )
+    res = assign_infusions(samples, infusion_times)
+
+    assert_series_equal(
+        res[INFUSION_NO],
+        pd.Series([0, 1, 2, 9, None, None, 3, None], index=samples.index, dtype=float),
+        check_names=False,
+    )
+    assert_series_equal(
+        res[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE],
         pd.Series(
-            [True, True, True, True, False, True, True, False, True, True]
-        ), check_names=False
+            [-2, 0, 1, 24, None, None, 6, None], index=samples.index, dtype=float
+        ),
+        check_names=False,
+    )
+    assert res.loc[10, INF_STARTDATE] == pd.Timestamp("1970-01-02 00:00:00")
+    assert res.loc[16, INF_STARTDATE] == pd.Timestamp("1970-01-04 00:00:00")
+    assert pd.isnull(res.loc[15, INF_STARTDATE])
+
+
+def test_streak_index_same_as_is_streak_longer_than_duration():
+    df = pd.DataFrame(
+        {
+            PATIENT_ID: [1, 0, 0, 1, 0, 1, 0, 1, 0, 1],
+            VALUE: [0.2, 0.1, 0.3, 0.9, 0.2, 0.1, 0.8, 0.4, 0.1, 0.3],
+            SAMPLE_TIME: pd.to_datetime("1970-01-01")
+            + pd.to_timedelta([0, 0, 5, 4, 1, 8, 9, 9, 2, 13], unit="h"),
+        },
+        index=list("abcdefghij"),
+    )
+    streaks = StreakIndex(df, VALUE, PATIENT_ID, SAMPLE_TIME)
+
+    for threshold in [0.15, 0.35, 0.5, 1.0]:
+        for hours in [0, 2, 4]:
+            expected = is_streak_longer_than_duration(
+                df.assign(**{DETECTION: df[VALUE] < threshold}),
+                DETECTION,
+                PATIENT_ID,
+                SAMPLE_TIME,
+                hours,
+            )
+            assert_series_equal(
+                streaks.detect(threshold, hours, below=True),
+                expected.astype(bool),
+                check_names=False,
+            )
+
+
+def test_segment_index_same_as_groupby():
+    df = pd.DataFrame(
+        {
+            PATIENT_ID: [1, 0, 0, 1, 0, 1, 0, 1],
+            INFUSION_NO: [1, 2, 1, 1, 2, 2, 1, 1],
+            VALUE: [0.2, None, 0.3, 0.9, None, 0.1, 0.8, 0.4],
+        }
+    )
+    segments = SegmentIndex(df[PATIENT_ID].to_numpy(), df[INFUSION_NO].to_numpy())
+    grouped = df.groupby([PATIENT_ID, INFUSION_NO])[VALUE]
+    values = df[VALUE].to_numpy()
+
+    assert (segments.first(df[PATIENT_ID].to_numpy()) == [0, 0, 1, 1]).all()
+    assert_series_equal(
+        pd.Series(segments.max(values)),
+        grouped.max().reset_index(drop=True),
+        check_names=False,
+    )
+    assert_series_equal(
+        pd.Series(segments.previous(values)), grouped.shift(), check_names=False
+    )
+    assert_series_equal(
+        pd.Series(segments.broadcast(segments.max(values))),
+        grouped.transform("max"),
+        check_names=False,
+    )
+
+
+def test_sample_alignment_pairs_nearest_sample_in_tolerance():
+    hours = pd.to_datetime("1970-01-01") + pd.to_timedelta(
+        [0, 0, 0, 3, 10, 10, 0, 1], unit="h"
+    )
+    df = pd.DataFrame(
+        {
+            PATIENT_ID: [0, 0, 0, 0, 0, 0, 1, 1],
+            P_CODE: ["A", "B", "B", "C", "A", "B", "A", "C"],
+            SAMPLE_TIME: hours,
+            VALUE: [1.0, 2.0, 4.0, 5.0, 6.0, None, 7.0, 8.0],
+        },
+        index=list("abcdefgh"),
+    )
+
+    points = {
+        code: AnalyteIndex(df[df[P_CODE] == code], code).points()
+        for code in ["A", "B", "C"]
+    }
+
+    # same timestamp only, samples of a code at the same time are averaged
+    exact = SampleAlignment(points, "A", tolerance_hours=0)
+    assert list(exact.patients) == [0, 1, 0]
+    assert np.allclose(exact.values("A"), [1.0, 7.0, 6.0])
+    assert np.allclose(exact.values("B"), [3.0, np.nan, np.nan], equal_nan=True)
+    assert np.isnan(exact.values("C")).all()
+
+    aligned = SampleAlignment(points, "A", tolerance_hours=3)
+    assert np.allclose(aligned.values("C"), [5.0, 8.0, np.nan], equal_nan=True)
+
+    # rows of positive anchors and of samples paired to them
+    detection = aligned.detect(df, np.array([True, False, False]))
+    assert list(detection.index) == list(df.index)
+    assert list(detection) == [True, True, True, True, False, False, False, False]
+
+
+def test_analyte_index_same_as_groupby():
+    df = pd.DataFrame(
+        {
+            PATIENT_ID: [1, 0, 0, 1, 0, 1, 0],
+            SAMPLE_TIME: pd.to_datetime("1970-01-01")
+            + pd.to_timedelta([0, 5, 2, 0, 5, 8, 9], unit="h"),
+            VALUE: [0.2, None, 0.3, 0.9, 0.5, 0.1, 0.8],
+        },
+        index=list("abcdefg"),
     )
+    analyte = AnalyteIndex(df, "A")
+    grouped = df.groupby(PATIENT_ID)[VALUE]
+
+    assert list(analyte.patients) == [0, 1]
+    assert np.allclose(analyte.max_per_patient(), grouped.max())
+    assert np.allclose(analyte.min_per_patient(), grouped.min())
+
+    # streaks in the order of the analyte, same as sorting the dataframe again
+    streaks = StreakIndex(df, VALUE, PATIENT_ID, SAMPLE_TIME)
+    assert_series_equal(
+        StreakIndex.from_analyte(analyte).detect(0.6, 2), streaks.detect(0.6, 2)
+    )
+
+    points = analyte.points()
+    assert list(points[SAMPLE_TIME].dt.hour) == [0, 2, 5, 8, 9]
+    assert list(points[PATIENT_ID]) == [1, 0, 0, 1, 0]
+    assert np.allclose(points[VALUE], [0.55, 0.3, 0.5, 0.1, 0.8])
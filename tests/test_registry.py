@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from src.constants import *
+from src.registry import DatasetRegistry
+
+
+def make_samples() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            PATIENT_ID: [0, 0, 1],
+            P_CODE: pd.Series(["NPU02902", "NPU18016", "NPU02902"], dtype="category"),
+            VALUE: [0.1, 40.0, 2.0],
+            INFUSION_NO: pd.array([1, None, 2], dtype="Int64"),
+        }
+    )
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_sessions_share_read_only_views(tmp_path, on_disk):
+    registry = DatasetRegistry(folder=str(tmp_path) if on_disk else "")
+    builds = []
+
+    def build():
+        builds.append(1)
+        return make_samples()
+
+    first = registry.acquire("key", "session 1", build)
+    second = registry.acquire("key", "session 2", build)
+    assert len(builds) == 1
+    assert registry.refcount("key") == 2
+    pd.testing.assert_frame_equal(first, make_samples())
+
+    for column, value in [(VALUE, 10.0), (P_CODE, "NPU18016"), (INFUSION_NO, 3)]:
+        with pytest.raises(ValueError):
+            first.iloc[0, first.columns.get_loc(column)] = value
+    pd.testing.assert_frame_equal(second, make_samples())
+    first[DETECTION] = True
+    assert DETECTION not in second.columns
+
+    registry.release("session 1")
+    assert registry.refcount("key") == 1
+    registry.release("session 2")
+    assert "key" not in registry
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sessions_expire():
+    registry = DatasetRegistry(folder="", session_ttl_seconds=60)
+    registry.acquire("first", "session", make_samples)
+    registry.acquire("second", "session", make_samples)
+    registry.release("session", keep=["second"])
+    assert "first" not in registry and registry.refcount("second") == 1
+
+    registry.evict(now=pd.Timestamp.now().timestamp() + 120)
+    assert "second" not in registry
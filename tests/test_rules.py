@@ -0,0 +1,125 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.constants import *
+from src.dataset import cast_to_schema
+from src.partition import PCodePartition
+from src.rules import AllOf
+from src.rules import AnyOf
+from src.rules import Compare
+from src.rules import compile_rule
+from src.rules import Param
+from src.rules import Rule
+
+
+def test_sweep_same_as_detection(make_samples):
+    def partition(p_codes: List[str]) -> PCodePartition:
+        return PCodePartition(
+            make_samples(
+                p_codes, n=300, n_patients=10, days=10, hours_step=6, scale=1.0
+            )
+        )
+
+    days = Param("param_days", "Days", 0, 4, 1, 2)
+    low = Param("param_low", "Low", 0.5, 1.5, 1.0, 0.5)
+    high = Param("param_high", "High", 1.0, 3.0, 2.0, 1.0)
+    window = Param("param_window", "Window", 0, 12, 0, 12)
+    for rule, samples in [
+        # duration declared before the threshold
+        (
+            Rule(
+                "streak",
+                Compare(
+                    "A", "<", "param_low", duration="param_days", hours_per_unit=24
+                ),
+                [days, low],
+            ),
+            partition(["A"]),
+        ),
+        (
+            Rule(
+                "streak or high",
+                AnyOf(
+                    [
+                        Compare("A", ">", "param_high"),
+                        Compare("A", "<", "param_low", duration=24),
+                    ]
+                ),
+                [low, high],
+            ),
+            partition(["A"]),
+        ),
+        (
+            Rule(
+                "paired",
+                AllOf(
+                    [
+                        Compare("A", ">", "param_high"),
+                        Compare("B", "<", "param_low", scale=2),
+                    ]
+                ),
+                [high, low, window],
+                window_hours="param_window",
+            ),
+            partition(["A", "B", "C"]),
+        ),
+    ]:
+        evaluator = compile_rule(rule).evaluator(samples)
+        grid = {param.name: param.grid() for param in rule.params}
+        counts = evaluator.count_positive_patients(grid)
+        assert counts.shape == tuple(len(values) for values in grid.values())
+
+        for index in np.ndindex(*counts.shape):
+            params = {name: grid[name][i] for name, i in zip(grid, index)}
+            detection = evaluator.detect(params)
+            assert detection.index.equals(evaluator.data.index)
+            positive_patients = evaluator.data.loc[detection, PATIENT_ID].nunique()
+            assert positive_patients == counts[index]
+
+
+def test_paired_samples_within_window():
+    rule = Rule(
+        "paired",
+        AllOf([Compare("A", ">", 100), Compare("B", "<", 0.5)]),
+        window_hours="param_window",
+        params=[Param("param_window", "Window", 0, 24, 0, 1)],
+    )
+    df = pd.DataFrame(
+        {
+            PATIENT_ID: [1, 1, 2, 2],
+            SAMPLE_TIME: pd.Timestamp("2020-01-01")
+            + pd.to_timedelta([0, 10, 0, 48], unit="h"),
+            P_CODE: ["A", "B", "A", "B"],
+            VALUE: [200, 0.1, 200, 0.1],
+            INFUSION_NO: 1.0,
+            SEX: 1,
+            MP6_STOP: 0.0,
+        }
+    )
+    evaluator = compile_rule(rule).evaluator(PCodePartition(df))
+
+    assert not evaluator.detect({"param_window": 0}).any()
+    assert list(evaluator.detect({"param_window": 12})) == [True, True, False, False]
+
+    # samples as loaded by the app, with int32 patient ids
+    typed = compile_rule(rule).evaluator(PCodePartition(cast_to_schema(df)))
+    assert list(typed.detect({"param_window": 12})) == [True, True, False, False]
+    grid = {"param_window": np.array([0, 12])}
+    assert list(typed.count_positive_patients(grid)) == [0, 1]
+
+
+def test_compile_rule_rejects_rules_it_can_not_evaluate():
+    with pytest.raises(ValueError, match="param_unknown"):
+        compile_rule(Rule("unknown", Compare("A", ">", "param_unknown")))
+    with pytest.raises(ValueError, match="Durations"):
+        compile_rule(
+            Rule(
+                "streak",
+                AllOf([Compare("A", ">", 1, duration=24), Compare("B", ">", 1)]),
+            )
+        )
+    with pytest.raises(ValueError, match="Comparison"):
+        compile_rule(Rule("equal", Compare("A", "==", 1)))
@@ -0,0 +1,79 @@
+import gc
+
+import pandas as pd
+import pytest
+
+from src import cache
+from src.dataset import cast_to_schema
+from src.diagnostics import Diagnose1
+from src.diagnostics import Diagnose2
+from src.diagnostics import Diagnose6
+from src.diagnostics import Diagnose8
+from src.diagnostics import Diagnose9
+from src.diagnostics import DME
+from src.partition import PCodePartition
+from src.runner import plan_groups
+from src.runner import run_detections
+from src.runner import share
+from src.runner import start_detections
+
+
+@pytest.fixture
+def samples(make_samples) -> PCodePartition:
+    df = make_samples(["NPU02902", "NPU18016", "NPU03568", "NPU02739"])
+    return PCodePartition(cast_to_schema(df))
+
+
+def test_parallel_same_as_serial(samples, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    classes = [Diagnose1, Diagnose6, Diagnose8, DME]
+
+    serial = [cls(samples) for cls in classes]
+    run_detections(samples, serial, parallel=False)
+    parallel = [cls(samples) for cls in classes]
+    run_detections(samples, parallel, parallel=True, max_workers=2)
+    assert len(list(tmp_path.glob("shared-*.feather"))) == 1
+
+    for s, p in zip(serial, parallel):
+        pd.testing.assert_frame_equal(s.data, p.data)
+
+
+def test_shared_file_removed_with_its_partition(make_samples, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    samples = PCodePartition(cast_to_schema(make_samples("NPU18016")))
+    path = share(samples)
+    assert share(samples) == path
+    assert len(list(tmp_path.glob("shared-*.feather"))) == 1
+
+    del samples
+    gc.collect()
+    assert len(list(tmp_path.glob("shared-*.feather"))) == 0
+
+
+def test_diagnostics_reading_same_codes_grouped():
+    # NPU19748 read by Diagnose2 and Diagnose9, NPU18016 by Diagnose6 and DME
+    groups = plan_groups([Diagnose1, Diagnose2, Diagnose6, Diagnose9, DME])
+    assert groups == [[Diagnose1], [Diagnose2, Diagnose9], [Diagnose6, DME]]
+
+
+def test_started_before_diagnostics_are_built(samples, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    classes = [Diagnose1, Diagnose6, DME]
+    params = {"Diagnose6": {"param_concentration": 10}}
+
+    serial = [cls(samples) for cls in classes]
+    for diagnostic in serial:
+        diagnostic.set_params(**params.get(type(diagnostic).__name__, {}))
+    run_detections(samples, serial, parallel=False)
+
+    tasks = [(type(d).__name__, d.get_params()) for d in serial]
+    pending = start_detections(samples, tasks, parallel=True, max_workers=2)
+    parallel = [cls(samples) for cls in classes]
+    for diagnostic in parallel:
+        diagnostic.set_params(**params.get(type(diagnostic).__name__, {}))
+        # detections must come from the workers
+        monkeypatch.setattr(diagnostic, "run_detection", pytest.fail)
+    pending.collect(parallel)
+
+    for s, p in zip(serial, parallel):
+        pd.testing.assert_frame_equal(s.data, p.data)
@@ -0,0 +1,77 @@
+import pandas as pd
+
+import src.store
+from src.constants import *
+from src.dataset import cast_to_schema
+from src.diagnostics import Diagnose1
+from src.diagnostics import Diagnose6
+from src.partition import PCodePartition
+from src.store import ResultStore
+
+
+def test_stored_detections_read_back_and_queried(make_samples, tmp_path):
+    samples = PCodePartition(
+        cast_to_schema(make_samples(["NPU02902", "NPU18016", "NPU03568", "NPU02739"]))
+    )
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    diagnostics = [Diagnose1(samples), Diagnose6(samples)]
+    diagnostics[1].set_params(param_concentration=20)
+    assert store.restore("dataset", diagnostics) == diagnostics
+    for diagnostic in diagnostics:
+        diagnostic.run_detection()
+    store.save("dataset", diagnostics)
+
+    restored = [Diagnose1(samples), Diagnose6(samples)]
+    restored[1].set_params(param_concentration=20.0)
+    assert store.restore("dataset", restored) == []
+    for s, r in zip(diagnostics, restored):
+        pd.testing.assert_frame_equal(s.data, r.data)
+
+    # other parameters or dataset are not stored
+    assert store.restore("other dataset", [Diagnose6(samples)]) != []
+    assert store.restore("dataset", [Diagnose6(samples)]) != []
+
+    data = diagnostics[1].data
+    selected = data[
+        data[DETECTION] & data[INFUSION_NO].between(1, 2) & (data[SEX] == 1)
+    ]
+    params = diagnostics[1].get_params()
+    assert store.positive_patients(
+        "dataset", "Diagnose6", params, infusion_no=(1, 2), sex=1
+    ) == sorted(selected[PATIENT_ID].unique().tolist())
+    assert store.positive_patients("dataset", "Diagnose6", params, infusion_no=7) == []
+    assert store.positive_patients("other dataset", "Diagnose6", params) is None
+
+    patient = selected[PATIENT_ID].iloc[0]
+    positive = store.positive_samples("dataset", restored[1], patient)
+    assert len(positive) == (data[DETECTION] & (data[PATIENT_ID] == patient)).sum()
+    assert store.positive_samples("other dataset", restored[1]) is None
+
+
+def test_saved_in_background_and_evicted(make_samples, tmp_path):
+    samples = PCodePartition(cast_to_schema(make_samples("NPU18016")))
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    diagnostics = [Diagnose6(samples)]
+    diagnostics[0].run_detection()
+    store.save_in_background("dataset", diagnostics).result()
+    assert store.has("dataset", "Diagnose6", diagnostics[0].get_params())
+
+    store.evict(max_age_days=30)
+    assert store.has("dataset", "Diagnose6", diagnostics[0].get_params())
+    store.evict(max_size_mb=0)
+    assert not store.has("dataset", "Diagnose6", diagnostics[0].get_params())
+
+
+def test_runs_of_another_version_not_restored(make_samples, tmp_path, monkeypatch):
+    samples = PCodePartition(cast_to_schema(make_samples("NPU18016")))
+    path = str(tmp_path / "results.sqlite")
+    diagnostics = [Diagnose6(samples)]
+    diagnostics[0].run_detection()
+    monkeypatch.setattr(src.store, "RESULTS_VERSION", src.store.RESULTS_VERSION - 1)
+    ResultStore(path).save("dataset", diagnostics)
+    assert ResultStore(path).has("dataset", "Diagnose6", diagnostics[0].get_params())
+
+    monkeypatch.undo()
+    store = ResultStore(path)
+    assert not store.has("dataset", "Diagnose6", diagnostics[0].get_params())
+    assert store.restore("dataset", [Diagnose6(samples)]) != []
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import streaming
+from src.constants import *
+from src.dataset import assign_samples_to_treatment
+from src.dataset import cast_to_schema
+from src.dataset import read_samples
+from src.streaming import read_samples_with_treatment
+from src.streaming import stream_samples_to_treatment
+
+
+def make_exports(n_rows: int):
+    rng = np.random.default_rng(0)
+    sample_time = pd.Timestamp("2020-01-01") + pd.to_timedelta(
+        rng.integers(0, 24 * 60, n_rows), unit="h"
+    )
+    samples = pd.DataFrame(
+        {
+            PATIENT_ID: rng.integers(0, 50, n_rows),
+            SAMPLE_TIME: sample_time.strftime(SAMPLE_TIME_FORMAT),
+            P_CODE: rng.choice(["NPU02902", "NPU18016"], n_rows),
+            VALUE: rng.exponential(10, n_rows),
+            REF_PATIENT: "<8,0",
+        }
+    )
+    samples.loc[::97, SAMPLE_TIME] = "not a date"
+    infusion_times = pd.DataFrame(
+        {
+            PATIENT_ID: np.repeat(np.arange(50), 2),
+            INFUSION_NO: np.tile(["1", "2"], 50),
+            SEX: 1,
+            MP6_STOP: 0,
+            INF_STARTDATE: pd.Timestamp("2020-01-10")
+            + pd.to_timedelta(np.tile([0, 14], 50), unit="D"),
+        }
+    )
+    return samples, infusion_times
+
+
+def test_stream_same_as_in_memory(tmp_path, monkeypatch):
+    # several chunks of MIN_CHUNK_ROWS
+    monkeypatch.setattr(streaming, "PROBE_ROWS", 700)
+    samples, infusion_times = make_exports(5000)
+    for file_name in ["samples.csv", "samples.xlsx"]:
+        path = str(tmp_path / file_name)
+        if file_name.endswith(".csv"):
+            samples.to_csv(path, index=False)
+        else:
+            samples.to_excel(path)
+
+        expected, expected_rejected = read_samples(path)
+        expected = cast_to_schema(assign_samples_to_treatment(expected, infusion_times))
+
+        output, rejected = stream_samples_to_treatment(
+            path, infusion_times, str(tmp_path / "merged.parquet"), memory_budget_mb=0
+        )
+        streamed = read_samples_with_treatment(output)
+
+        assert len(rejected) == len(expected_rejected)
+        pd.testing.assert_frame_equal(
+            streamed, expected.reset_index(drop=True), check_categorical=False
+        )
+
+
+def test_read_back_codes(tmp_path):
+    samples, infusion_times = make_exports(2000)
+    path = str(tmp_path / "samples.csv")
+    samples.to_csv(path, index=False)
+    output, _ = stream_samples_to_treatment(
+        path, infusion_times, str(tmp_path / "merged.parquet")
+    )
+
+    streamed = read_samples_with_treatment(output)
+    codes = read_samples_with_treatment(output, ["NPU18016"])
+    pd.testing.assert_frame_equal(
+        codes,
+        streamed[streamed[P_CODE] == "NPU18016"].reset_index(drop=True),
+        check_categorical=False,
+    )
+
+
+def test_partial_file_removed_on_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(streaming.cache, "CACHE_DIR", str(tmp_path))
+    samples, infusion_times = make_exports(2000)
+    path = str(tmp_path / "samples.csv")
+    samples.to_csv(path, index=False)
+
+    def fail(*args, **kwargs):
+        open(args[2], "w").close()
+        raise MemoryError
+
+    monkeypatch.setattr(streaming, "stream_samples_to_treatment", fail)
+    with open(path, "rb") as samples_buffer:
+        with pytest.raises(MemoryError):
+            streaming.load_samples_with_treatment(samples_buffer, infusion_times, 0)
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_loaded_once_and_read_back_for_codes(tmp_path, monkeypatch):
+    monkeypatch.setattr(streaming.cache, "CACHE_DIR", str(tmp_path))
+    samples, infusion_times = make_exports(2000)
+    path = str(tmp_path / "samples.csv")
+    samples.to_csv(path, index=False)
+
+    loaded, _ = streaming.load_samples_with_treatment(
+        path, infusion_times, 64, ["NPU18016"]
+    )
+    # same infusion times in another order
+    shuffled = infusion_times.sample(frac=1, random_state=0)
+    streaming.load_samples_with_treatment(path, shuffled, 64)
+    assert set(loaded[P_CODE]) == {"NPU18016"}
+    assert len(list(tmp_path.glob("samples_with_treatment-*.rejected.parquet"))) == 1
+    assert streaming.frame_hash(infusion_times) != streaming.frame_hash(
+        infusion_times.assign(**{SEX: 2})
+    )
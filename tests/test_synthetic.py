@@ -0,0 +1,52 @@
+import pytest
+
+from pandas.testing import assert_frame_equal
+
+from src.constants import *
+from src.dataset import assign_samples_to_treatment
+from src.dataset import drop_patients_with_duplicate_treatments
+from src.dataset import read_infusion_times
+from src.dataset import read_samples
+from src.diagnostics import DME
+from src.partition import PCodePartition
+from src.synthetic import generate_cohort
+from src.synthetic import MTX_CODE
+from src.synthetic import write_cohort
+
+
+def test_generate_cohort_is_deterministic():
+    first = generate_cohort(n_patients=20, seed=1)
+    second = generate_cohort(n_patients=20, seed=1)
+    for a, b in zip(first, second):
+        assert_frame_equal(a, b)
+    assert not first[0].equals(generate_cohort(n_patients=20, seed=2)[0])
+
+
+def test_written_cohort_goes_through_the_pipeline(tmp_path):
+    paths = write_cohort(
+        str(tmp_path), n_patients=30, samples_per_analyte=40, duplicate_treatments=0.1
+    )
+    samples, unparsed = read_samples(paths["samples"])
+    assert len(unparsed) == 0
+    assert_frame_equal(read_samples(paths["samples_xlsx"])[0], samples)
+
+    infusion_times, _ = read_infusion_times(paths["infusion_times"])
+    with pytest.raises(ValueError, match="duplicate treatments"):
+        assign_samples_to_treatment(samples, infusion_times)
+    infusion_times, removed = drop_patients_with_duplicate_treatments(infusion_times)
+    assert len(removed) != 0
+    assert not infusion_times[PATIENT_ID].isin(removed).any()
+    assert not infusion_times.duplicated([PATIENT_ID, INFUSION_NO]).any()
+
+    merged = assign_samples_to_treatment(samples, infusion_times)
+    assert not merged.duplicated([PATIENT_ID, SAMPLE_TIME, P_CODE]).any()
+    treated = merged[merged[INFUSION_NO].notnull()]
+    assert not treated[PATIENT_ID].isin(removed).any()
+    mtx = treated[treated[P_CODE] == MTX_CODE]
+    # MTX decreases after the end of the infusion
+    hours = mtx[DIFFERENCE_SAMPLETIME_TO_INF_STARTDATE]
+    assert mtx.loc[hours < 30, VALUE].median() > mtx.loc[hours > 40, VALUE].median()
+
+    diagnostic = DME(PCodePartition(merged))
+    diagnostic.run_detection()
+    assert 0 < len(diagnostic.get_detected_ids()) < treated[PATIENT_ID].nunique()
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import pytest
+
+from src.constants import *
+from src.visualization import ChartCache
+from src.visualization import downsample
+from src.visualization import visualize_detected
+
+
+class FakeDiagnostic:
+    name = "fake"
+
+    def __init__(self, data: pd.DataFrame):
+        self.data = data
+
+
+@pytest.fixture
+def make_detections(make_samples):
+    def make(n: int) -> pd.DataFrame:
+        rng = np.random.default_rng(0)
+        data = make_samples(
+            ["NPU02902", "NPU18016"], n=n, n_patients=100, days=30, scale=1.0
+        )
+        data[DETECTION] = rng.random(n) < 0.01
+        data.index = rng.permutation(n) + 1000
+        return data
+
+    return make
+
+
+def test_downsample_keeps_positives_and_extremes(make_detections):
+    data = make_detections(20000)
+    sampled = downsample(data, max_points=1000)
+
+    assert len(sampled) <= data[DETECTION].sum() + 2 * 2 * 30
+    assert sampled[DETECTION].sum() == data[DETECTION].sum()
+    day = data[SAMPLE_TIME].dt.floor("D")
+    negatives = data[~data[DETECTION]]
+    for agg in ["min", "max"]:
+        extremes = negatives.groupby([P_CODE, day[negatives.index]])[VALUE].agg(agg)
+        assert (
+            negatives.loc[negatives[VALUE].isin(extremes)]
+            .index.isin(sampled.index)
+            .all()
+        )
+
+    assert downsample(data, max_points=len(data)) is data
+
+
+def test_large_charts_use_webgl(make_detections):
+    diagnostic = FakeDiagnostic(make_detections(20000))
+    assert isinstance(
+        visualize_detected(diagnostic, downsample_above=10 ** 6, webgl_above=5000),
+        go.Figure,
+    )
+    assert not isinstance(visualize_detected(diagnostic), go.Figure)
+
+
+def test_chart_cache_builds_once_per_key():
+    cache = ChartCache(max_size=2)
+    builds = []
+
+    def build(key):
+        builds.append(key)
+        return go.Figure()
+
+    first = cache.get("a", lambda: build("a"))
+    assert cache.get("a", lambda: build("a")) is first
+    cache.get("b", lambda: build("b"))
+    cache.get("a", lambda: build("a"))
+    # b is the least recently used
+    cache.get("c", lambda: build("c"))
+    cache.get("a", lambda: build("a"))
+    cache.get("b", lambda: build("b"))
+    assert builds == ["a", "b", "c", "b"]